@@ -6,8 +6,10 @@ import json
 import os
 import pickle
 import re
+import time
 from models import (TransportNetwork, ImprovedRLAgent, 
-                    ImprovedRoutePlanner, LogisticsOptimizer, TrafficState)
+                    ImprovedRoutePlanner, LogisticsOptimizer, TrafficState,
+                    FleetTourBuilder, Vehicle, TransportAllocation, TraceMatcher)
 
 # Set proper encoding for stdout/stderr to handle Unicode characters
 import io
@@ -78,6 +80,8 @@ def find_route(data_file):
             data = json.load(f)
         
         print(f"Loaded data file content: {safe_json_dumps(data)}", file=sys.stderr)
+        # Optional latency bound for the whole request, in seconds
+        deadline = time.time() + float(data['time_budget']) if data.get('time_budget') else None
         
         # Check for different data formats
         if 'routes' in data:
@@ -106,19 +110,10 @@ def find_route(data_file):
                 
                 try:
                     # Call find_multi_stop_route which returns a single RouteResult
-                    route = planner.find_multi_stop_route(source, destinations)
-                    
-                    # Clean street path of problematic Unicode characters
-                    clean_street_path = [str(s).replace('\u2192', '->') for s in route.street_path]
+                    route = planner.find_multi_stop_route(source, destinations, deadline=deadline)
                     
-                    source_result = {
-                        "source": source,
-                        "destinations": destinations,
-                        "distance": route.total_distance,
-                        "time": route.total_time,
-                        "streets": clean_street_path,
-                        "traffic": serialize_traffic_distribution(route.traffic_distribution)
-                    }
+                    source_result = {"source": source, "destinations": destinations}
+                    source_result.update(route.to_dict())
                     
                     results.append(source_result)
                     
@@ -173,35 +168,17 @@ def find_route(data_file):
                     print(f"\nProcessing multi-destination request from '{source}' to {len(destinations)} destinations", file=sys.stderr)
                     
                     # Call find_multi_stop_route which returns a single RouteResult
-                    route = planner.find_multi_stop_route(source, destinations)
+                    route = planner.find_multi_stop_route(source, destinations, deadline=deadline)
                     
-                    # Clean street path of problematic Unicode characters
-                    clean_street_path = [str(s).replace('\u2192', '->') for s in route.street_path]
-                    
-                    result = {
-                        "source": source,
-                        "destinations": destinations,
-                        "distance": route.total_distance,
-                        "time": route.total_time,
-                        "streets": clean_street_path,
-                        "traffic": serialize_traffic_distribution(route.traffic_distribution)
-                    }
+                    result = {"source": source, "destinations": destinations}
+                    result.update(route.to_dict())
                 else:
                     print(f"\nProcessing single destination request from '{source}' to '{destinations[0]}'", file=sys.stderr)
                     # Use the standard find_route method for single destination
-                    route = planner.find_route(source, destinations[0])
-                    
-                    # Clean street path of problematic Unicode characters
-                    clean_street_path = [str(s).replace('\u2192', '->') for s in route.street_path]
+                    route = planner.find_route(source, destinations[0], deadline=deadline)
                     
-                    result = {
-                        "source": source,
-                        "destination": destinations[0],
-                        "distance": route.total_distance,
-                        "time": route.total_time,
-                        "streets": clean_street_path,
-                        "traffic": serialize_traffic_distribution(route.traffic_distribution)
-                    }
+                    result = {"source": source, "destination": destinations[0]}
+                    result.update(route.to_dict())
                 
                 print("Route Result:", file=sys.stderr)
                 print(safe_json_dumps(result), file=sys.stderr)
@@ -258,82 +235,98 @@ def find_route(data_file):
         print(safe_json_dumps(error_result), file=sys.stderr)
         return error_result
 
+def parse_optimization_data(data):
+    """Convert any supported optimization data format into LogisticsRequest/LogisticsDestination lists."""
+    # Check which format the data is in and convert if necessary
+    if "source" in data and "destinations" in data and data.get("isMultiDestination", False):
+        # For grouped routes, need capacity info for source and demand info for destinations
+        if "capacity" not in data:
+            raise KeyError("Missing 'capacity' for source in grouped data format")
+            
+        sources = [{"source_street": data["source"], "capacity": data["capacity"]}]
+        
+        # Check if destinations have demand values
+        destinations = []
+        for i, dest in enumerate(data["destinations"]):
+            if isinstance(dest, dict) and "street" in dest and "demand" in dest:
+                destinations.append({"dest_street": dest["street"], "demand": dest["demand"]})
+            else:
+                raise KeyError(f"Destination {i+1} is missing 'street' or 'demand' fields")
+        
+        print(f"Converted grouped data: 1 source, {len(destinations)} destinations", file=sys.stderr)
+        
+    elif "source" in data and "destination" in data and not data.get("isMultiDestination", False):
+        # For single pair format, need capacity and demand info
+        if "capacity" not in data:
+            raise KeyError("Missing 'capacity' for source in single pair format")
+        if "demand" not in data:
+            raise KeyError("Missing 'demand' for destination in single pair format")
+            
+        sources = [{"source_street": data["source"], "capacity": data["capacity"]}]
+        destinations = [{"dest_street": data["destination"], "demand": data["demand"]}]
+        
+        print(f"Converted single pair data: 1 source, 1 destination", file=sys.stderr)
+        
+    elif "sources" in data and "destinations" in data:
+        # Data is already in the expected format
+        sources = data["sources"]
+        destinations = data["destinations"]
+        
+        # Validate each source has required fields
+        for i, source in enumerate(sources):
+            if "source_street" not in source or "capacity" not in source:
+                raise KeyError(f"Source {i+1} is missing 'source_street' or 'capacity' fields")
+        
+        # Validate each destination has required fields
+        for i, dest in enumerate(destinations):
+            if "dest_street" not in dest or "demand" not in dest:
+                raise KeyError(f"Destination {i+1} is missing 'dest_street' or 'demand' fields")
+        
+        print(f"Data loaded successfully: {len(sources)} sources, {len(destinations)} destinations", file=sys.stderr)
+    else:
+        raise KeyError("Data must contain either 'sources'/'destinations' keys or 'source'/'destinations' for grouped data")
+    
+    source_requests = []
+    for i, source in enumerate(sources):
+        try:
+            source_requests.append(LogisticsRequest(source["source_street"], source["capacity"]))
+            print(f"Added source {i+1}: {source['source_street']} with capacity {source['capacity']}", file=sys.stderr)
+        except Exception as e:
+            print(f"Error adding source {i+1}: {str(e)}", file=sys.stderr)
+    
+    destination_requests = []
+    for i, dest in enumerate(destinations):
+        try:
+            destination_requests.append(LogisticsDestination(dest["dest_street"], dest["demand"]))
+            print(f"Added destination {i+1}: {dest['dest_street']} with demand {dest['demand']}", file=sys.stderr)
+        except Exception as e:
+            print(f"Error adding destination {i+1}: {str(e)}", file=sys.stderr)
+    
+    return source_requests, destination_requests
+
 def optimize_transport(data_path):
     """Run the logistics optimization using the provided data."""
     try:
         print(f"Optimizing transport allocation from data: {data_path}", file=sys.stderr)
         with open(data_path, 'r', encoding='utf-8') as f:
             data = json.load(f)
+        # Optional latency bound in seconds; training returns its best allocation when it expires
+        deadline = time.time() + float(data['time_budget']) if data.get('time_budget') else None
         
-        # Check which format the data is in and convert if necessary
-        if "source" in data and "destinations" in data and data.get("isMultiDestination", False):
-            # For grouped routes, need capacity info for source and demand info for destinations
-            if "capacity" not in data:
-                raise KeyError("Missing 'capacity' for source in grouped data format")
-                
-            sources = [{"source_street": data["source"], "capacity": data["capacity"]}]
-            
-            # Check if destinations have demand values
-            destinations = []
-            for i, dest in enumerate(data["destinations"]):
-                if isinstance(dest, dict) and "street" in dest and "demand" in dest:
-                    destinations.append({"dest_street": dest["street"], "demand": dest["demand"]})
-                else:
-                    raise KeyError(f"Destination {i+1} is missing 'street' or 'demand' fields")
-            
-            print(f"Converted grouped data: 1 source, {len(destinations)} destinations", file=sys.stderr)
-            
-        elif "source" in data and "destination" in data and not data.get("isMultiDestination", False):
-            # For single pair format, need capacity and demand info
-            if "capacity" not in data:
-                raise KeyError("Missing 'capacity' for source in single pair format")
-            if "demand" not in data:
-                raise KeyError("Missing 'demand' for destination in single pair format")
-                
-            sources = [{"source_street": data["source"], "capacity": data["capacity"]}]
-            destinations = [{"dest_street": data["destination"], "demand": data["demand"]}]
-            
-            print(f"Converted single pair data: 1 source, 1 destination", file=sys.stderr)
-            
-        elif "sources" in data and "destinations" in data:
-            # Data is already in the expected format
-            sources = data["sources"]
-            destinations = data["destinations"]
-            
-            # Validate each source has required fields
-            for i, source in enumerate(sources):
-                if "source_street" not in source or "capacity" not in source:
-                    raise KeyError(f"Source {i+1} is missing 'source_street' or 'capacity' fields")
-            
-            # Validate each destination has required fields
-            for i, dest in enumerate(destinations):
-                if "dest_street" not in dest or "demand" not in dest:
-                    raise KeyError(f"Destination {i+1} is missing 'dest_street' or 'demand' fields")
-            
-            print(f"Data loaded successfully: {len(sources)} sources, {len(destinations)} destinations", file=sys.stderr)
-        else:
-            raise KeyError("Data must contain either 'sources'/'destinations' keys or 'source'/'destinations' for grouped data")
-        
-        source_requests = []
-        for i, source in enumerate(sources):
-            try:
-                source_requests.append(LogisticsRequest(source["source_street"], source["capacity"]))
-                print(f"Added source {i+1}: {source['source_street']} with capacity {source['capacity']}", file=sys.stderr)
-            except Exception as e:
-                print(f"Error adding source {i+1}: {str(e)}", file=sys.stderr)
-        
-        destination_requests = []
-        for i, dest in enumerate(destinations):
-            try:
-                destination_requests.append(LogisticsDestination(dest["dest_street"], dest["demand"]))
-                print(f"Added destination {i+1}: {dest['dest_street']} with demand {dest['demand']}", file=sys.stderr)
-            except Exception as e:
-                print(f"Error adding destination {i+1}: {str(e)}", file=sys.stderr)
+        source_requests, destination_requests = parse_optimization_data(data)
         
         print(f"Starting optimization with {len(source_requests)} sources and {len(destination_requests)} destinations", file=sys.stderr)
         
         try:
-            allocations = logistics_optimizer.optimize_transport_allocation(source_requests, destination_requests)
+            if data.get('sparse_k'):
+                # Large problems: only the k nearest sources are candidates per destination
+                allocations = logistics_optimizer.optimize_sparse_allocation(
+                    source_requests, destination_requests, k=int(data['sparse_k']), deadline=deadline)
+            else:
+                # "coarse_costs": street-overlay estimates instead of one route search per pair
+                allocations = logistics_optimizer.optimize_transport_allocation(
+                    source_requests, destination_requests, deadline=deadline,
+                    coarse_costs=bool(data.get('coarse_costs')))
             print(f"Optimization complete, generated {len(allocations)} allocations", file=sys.stderr)
         except Exception as e:
             print(f"Error during optimization process: {str(e)}", file=sys.stderr)
@@ -348,7 +341,8 @@ def optimize_transport(data_path):
                 "quantity": alloc.quantity
             })
       
-        result = {"allocations": allocation_results}
+        result = {"allocations": allocation_results,
+                  "converged": logistics_optimizer.last_allocation_converged}
         print(f"Route Result: {safe_json_dumps(result)}", file=sys.stderr) 
         
         return result
@@ -363,6 +357,691 @@ def optimize_transport(data_path):
             "allocations": []
         }
 
+def optimize_batch(data_path):
+    """Optimize a list of allocation problems against one shared travel-time table."""
+    try:
+        with open(data_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        problems = data.get('problems')
+        if not isinstance(problems, list) or not problems:
+            return {"error": "Data must contain a non-empty 'problems' list"}
+
+        results = [None] * len(problems)
+        parsed = []
+        parsed_indices = []
+        for index, problem in enumerate(problems):
+            problem_id = problem.get('id', index)
+            try:
+                parsed.append(parse_optimization_data(problem))
+                parsed_indices.append(index)
+            except KeyError as e:
+                results[index] = {"id": problem_id, "error": str(e), "allocations": []}
+
+        workers = data.get('workers')
+        solved = logistics_optimizer.optimize_batch(parsed, int(workers) if workers else None) if parsed else []
+        for index, outcome in zip(parsed_indices, solved):
+            problem_id = problems[index].get('id', index)
+            if isinstance(outcome, Exception):
+                results[index] = {"id": problem_id, "error": f"Optimization process error: {str(outcome)}",
+                                  "allocations": []}
+            else:
+                results[index] = {"id": problem_id, "allocations": [
+                    {"source": alloc.source_street, "destination": alloc.dest_street, "quantity": alloc.quantity}
+                    for alloc in outcome]}
+
+        print(f"Batch complete: {sum('error' not in r for r in results)}/{len(results)} problems solved", file=sys.stderr)
+        return {"results": results}
+
+    except Exception as e:
+        traceback_info = traceback.format_exc()
+        print(f"Batch optimization error: {str(e)}", file=sys.stderr)
+        return {"error": f"Batch optimization error: {str(e)}", "traceback": traceback_info, "results": []}
+
+def reachable_streets(data_file):
+    """Streets reachable from a source street within a time limit (one bounded search)."""
+    try:
+        with open(data_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        source = data.get('source')
+        if not source:
+            return {"error": "Missing source in data file"}
+        if 'time_limit' in data:
+            time_limit = float(data['time_limit'])
+        elif 'minutes' in data:
+            time_limit = float(data['minutes']) * 60
+        else:
+            return {"error": "Missing 'time_limit' (seconds) or 'minutes' in data file"}
+        targets = data.get('streets')
+
+        arrivals = planner.reachable_streets(source, time_limit, targets)
+        reachable = [{"street": street, "time": arrival}
+                     for street, arrival in sorted(arrivals.items(), key=lambda item: item[1])]
+        result = {"source": source, "time_limit": time_limit, "reachable": reachable}
+        if targets is not None:
+            result["unreachable"] = [street for street in targets if street not in arrivals]
+        return result
+    except ValueError as e:
+        return {"error": str(e).replace('\u2192', '->')}
+    except Exception as e:
+        return {"error": f"Unexpected error: {str(e)}", "traceback": traceback.format_exc()}
+
+def assign_depots(data_path):
+    """Partition destinations among source depots by travel time.
+
+    Data: optimize-style sources/destinations, optional "capacity_aware" (default
+    true) and "streets" to also report the nearest depot of arbitrary streets.
+    This is a read-only query: the partition stays in this process's optimizer and is
+    only persisted when a maintenance command (prewarm, match_traces --apply) saves it.
+    """
+    try:
+        with open(data_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        source_requests, destination_requests = parse_optimization_data(data)
+        depots = [source.source_street for source in source_requests]
+        allocations, unassigned = logistics_optimizer.assign_to_depots(
+            source_requests, destination_requests, capacity_aware=data.get('capacity_aware', True))
+        partition = logistics_optimizer.depot_partition(depots)
+
+        nearest = {}
+        for street in [dest.dest_street for dest in destination_requests] + list(data.get('streets') or []):
+            depot, arrival = partition.depot_of(street)
+            nearest[street] = {"depot": depot, "time": arrival}
+
+        return {
+            "allocations": [{"source": a.source_street, "destination": a.dest_street, "quantity": a.quantity}
+                            for a in allocations],
+            "nearest": nearest,
+            "unassigned": unassigned
+        }
+    except (KeyError, ValueError) as e:
+        return {"error": str(e).replace('\u2192', '->')}
+    except Exception as e:
+        return {"error": f"Depot assignment error: {str(e)}", "traceback": traceback.format_exc()}
+
+def route_to_dict(route, source, destinations):
+    """Serialize a RouteResult in the find_route output shape (single or multi-destination)."""
+    result = {"source": source}
+    if len(destinations) == 1:
+        result["destination"] = destinations[0]
+    else:
+        result["destinations"] = destinations
+    result.update(route.to_dict())
+    return result
+
+def route_from_coordinates(data_path):
+    """Route between positions, e.g. TrackerData Locations, snapped to their nearest streets."""
+    try:
+        with open(data_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        points = [data.get('start')] + (data.get('destinations') or [data.get('end')])
+        if any(not point for point in points):
+            return {"error": "Missing 'start' and 'end' (or 'destinations') in data file"}
+        # Lat/lon positions unless every point is given in network x/y
+        net_coordinates = all('x' in point and 'y' in point for point in points)
+        if net_coordinates:
+            coords = [(float(point['x']), float(point['y'])) for point in points]
+        else:
+            coords = [(float(point['latitude']), float(point['longitude'])) for point in points]
+        max_snap_distance = float(data.get('max_snap_distance', 200.0))
+        deadline = time.time() + float(data['time_budget']) if data.get('time_budget') else None
+
+        route, snaps = planner.route_from_coordinates(coords[0], coords[1:], net_coordinates,
+                                                      max_snap_distance, deadline)
+        result = route_to_dict(route, snaps[0].street_name, [snap.street_name for snap in snaps[1:]])
+        result["snapped"] = [{"street": snap.street_name, "from": snap.from_node, "to": snap.to_node,
+                              "distance": snap.distance, "position": snap.position}
+                             for snap in snaps]
+        return result
+    except ValueError as e:
+        return {"error": str(e).replace('\u2192', '->')}
+    except Exception as e:
+        return {"error": f"Unexpected error: {str(e)}", "traceback": traceback.format_exc()}
+
+def match_traces(data_path):
+    """Map-match driver Location pings and derive per-edge observed traffic.
+
+    Data: {"pings": [{"driver", "latitude", "longitude", "timestamp"}, ...],
+           "apply": bool, optional matcher settings such as "gps_sigma"}.
+    With "apply" the observed traffic is written into every saved network.
+    """
+    import pandas as pd
+    try:
+        with open(data_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        pings = pd.DataFrame(data.get('pings') or [])
+        required = {'driver', 'timestamp'}
+        if pings.empty or not required.issubset(pings.columns) or not (
+                {'latitude', 'longitude'}.issubset(pings.columns) or {'x', 'y'}.issubset(pings.columns)):
+            return {"error": "Missing 'pings' with driver, latitude, longitude and timestamp"}
+        settings = {key: float(data[key]) for key in ('gps_sigma', 'beta', 'search_radius', 'max_speed', 'max_gap')
+                    if key in data}
+        matcher = TraceMatcher(planner.network, **settings)
+        start_time = time.time()
+        matched, traffic = matcher.match_traffic(pings)
+        print(f"Matched {len(matched)} of {len(pings)} pings in {time.time() - start_time:.1f}s", file=sys.stderr)
+
+        applied = False
+        if data.get('apply') and not traffic.empty:
+            for target in {id(n): n for n in (planner.network, logistics_optimizer.network, network)}.values():
+                target.update_traffic(traffic)
+            save_pickle(planner, pickle_files['saved_route_planner.pkl'])
+            save_pickle(logistics_optimizer, pickle_files['saved_logistics_optimizer.pkl'])
+            save_pickle(network, pickle_files['saved_network_updated.pkl'])
+            applied = True
+
+        return {
+            "pings": len(pings),
+            "matched": len(matched),
+            "segments": int(matched['segment'].nunique()) if len(matched) else 0,
+            "edges": traffic.to_dict(orient='records'),
+            "applied": applied
+        }
+    except ValueError as e:
+        return {"error": str(e).replace('\u2192', '->')}
+    except Exception as e:
+        return {"error": f"Unexpected error: {str(e)}", "traceback": traceback.format_exc()}
+
+def run_pipeline(data_path, grouped=True):
+    """Solve the allocation and route every non-zero allocation in the same process.
+
+    Routing goes through the optimizer's own route planner, whose route cache already
+    holds the searches made while building the cost matrix, so pairs routed for the
+    costs are not searched again. With grouped=True each source visits all of its
+    allocated destinations in one multi-stop route, as the Node grouped flow does.
+    """
+    try:
+        with open(data_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        source_requests, destination_requests = parse_optimization_data(data)
+        deadline = time.time() + float(data['time_budget']) if data.get('time_budget') else None
+    except Exception as e:
+        return {
+            "error": f"Optimization error: {str(e)}",
+            "traceback": traceback.format_exc(),
+            "allocations": [],
+            "routes": []
+        }
+    return allocate_and_route(source_requests, destination_requests, grouped, deadline)
+
+def allocate_and_route(source_requests, destination_requests, grouped=True, deadline=None):
+    """Allocation followed by routing of the non-zero allocations (see run_pipeline).
+
+    With a deadline, allocation may use half of the remaining time and routing the rest.
+    """
+    try:
+        allocation_deadline = None
+        if deadline is not None:
+            allocation_deadline = time.time() + max(0.0, deadline - time.time()) / 2
+        allocations = logistics_optimizer.optimize_transport_allocation(
+            source_requests, destination_requests, deadline=allocation_deadline)
+    except Exception as e:
+        return {
+            "error": f"Optimization error: {str(e)}",
+            "traceback": traceback.format_exc(),
+            "allocations": [],
+            "routes": []
+        }
+
+    allocation_results = [{
+        "source": alloc.source_street,
+        "destination": alloc.dest_street,
+        "quantity": alloc.quantity
+    } for alloc in allocations]
+
+    # Group non-zero allocations by source, keeping the allocation order
+    source_groups = {}
+    for alloc in allocations:
+        if alloc.quantity > 0:
+            source_groups.setdefault(alloc.source_street, []).append(alloc)
+
+    route_planner = logistics_optimizer.route_planner
+    routes = []
+    errors = []
+    for source, group in source_groups.items():
+        jobs = [group] if grouped else [[alloc] for alloc in group]
+        for job in jobs:
+            destinations = [alloc.dest_street for alloc in job]
+            try:
+                if len(destinations) == 1:
+                    route = route_planner.find_route(source, destinations[0], deadline=deadline)
+                else:
+                    route = route_planner.find_multi_stop_route(source, destinations, deadline=deadline)
+                route_result = route_to_dict(route, source, destinations)
+                route_result["quantities"] = {alloc.dest_street: alloc.quantity for alloc in job}
+                routes.append(route_result)
+            except ValueError as e:
+                errors.append({
+                    "source": source,
+                    "destinations": destinations,
+                    "error": str(e).replace('\u2192', '->')
+                })
+
+    cache = route_planner.route_cache
+    print(f"Pipeline routed {len(routes)} jobs ({len(errors)} failed), route cache hits: {cache.hits}, misses: {cache.misses}", file=sys.stderr)
+    return {"allocations": allocation_results, "routes": routes, "errors": errors,
+            "converged": logistics_optimizer.last_allocation_converged and all(r["converged"] for r in routes)}
+
+def build_fleet_tours(data_path):
+    """Allocate (or take given allocations) and build capacitated per-vehicle tours.
+
+    Data file: optimize-style sources/destinations or an "allocations" list of
+    {source, destination, quantity}, plus "fleet": {source_street: [{"id", "capacity"}]}
+    and optional "time_budget" (seconds) and "return_to_depot". With "assignment":
+    "nearest_depot" each destination goes whole to its nearest depot with capacity left
+    instead of through the allocation optimizer.
+    """
+    try:
+        with open(data_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        fleet_data = data.get('fleet')
+        if not fleet_data:
+            return {"error": "Missing 'fleet' in data file"}
+        fleets = {}
+        for source, vehicles in fleet_data.items():
+            fleets[source] = []
+            for i, v in enumerate(vehicles):
+                vehicle_id = str(v.get('id', f"{source}-{i+1}"))
+                try:
+                    capacity = float(v['capacity'])
+                except (TypeError, ValueError):
+                    raise ValueError(f"Vehicle '{vehicle_id}' has a non-numeric capacity: {v['capacity']!r}")
+                if not capacity > 0:
+                    raise ValueError(f"Vehicle '{vehicle_id}' needs a positive capacity, got {v['capacity']!r}")
+                fleets[source].append(Vehicle(vehicle_id, capacity))
+
+        if 'allocations' in data:
+            allocations = [TransportAllocation(a['source'], a['destination'], a['quantity'])
+                           for a in data['allocations']]
+        elif data.get('assignment') == 'nearest_depot':
+            # Whole destinations to their nearest depot with room (one multi-source search)
+            source_requests, destination_requests = parse_optimization_data(data)
+            allocations, _ = logistics_optimizer.assign_to_depots(source_requests, destination_requests)
+        else:
+            source_requests, destination_requests = parse_optimization_data(data)
+            allocations = logistics_optimizer.optimize_transport_allocation(source_requests, destination_requests)
+
+        builder = FleetTourBuilder(planner.network, planner)
+        tours = builder.build_tours(allocations, fleets,
+                                    time_budget=float(data.get('time_budget', 5.0)),
+                                    return_to_depot=data.get('return_to_depot', True))
+    except (KeyError, ValueError) as e:
+        return {"error": str(e).replace('\u2192', '->')}
+    except Exception as e:
+        return {"error": f"Tour building error: {str(e)}", "traceback": traceback.format_exc()}
+
+    tour_results = []
+    for tour in tours:
+        tour_result = route_to_dict(tour.route, tour.source_street, tour.stops)
+        tour_result.update({
+            "vehicle": tour.vehicle_id,
+            "trip": tour.trip,
+            "stops": [{"destination": street, "quantity": quantity}
+                      for street, quantity in zip(tour.stops, tour.quantities)],
+            "load": tour.load
+        })
+        tour_result.pop("destination", None)
+        tour_result.pop("destinations", None)
+        tour_results.append(tour_result)
+
+    return {
+        "allocations": [{"source": a.source_street, "destination": a.dest_street, "quantity": a.quantity}
+                        for a in allocations],
+        "tours": tour_results
+    }
+
+def job_path(job_id):
+    """Pickle path for a stored allocation job (ids are restricted to safe file names)."""
+    if not re.fullmatch(r'[A-Za-z0-9_.-]+', str(job_id)):
+        raise ValueError(f"Invalid job id: {job_id}")
+    jobs_dir = os.path.join(parent_dir, 'allocation_jobs')
+    os.makedirs(jobs_dir, exist_ok=True)
+    return os.path.join(jobs_dir, f"{job_id}.pkl")
+
+def job_to_dict(job):
+    return {
+        "job_id": job.job_id,
+        "allocations": [{"source": a.source_street, "destination": a.dest_street, "quantity": a.quantity}
+                        for a in job.allocations()],
+        "total_cost": job.total_cost(),
+        "unmet_demand": job.unmet_demand(),
+        "pivots": job.pivots
+    }
+
+def start_allocation_job(data_path):
+    """Solve an allocation and keep it under a job id for incremental updates."""
+    try:
+        with open(data_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if 'job_id' not in data:
+            return {"error": "Missing 'job_id' in data file"}
+        path = job_path(data['job_id'])
+        source_requests, destination_requests = parse_optimization_data(data)
+        job = logistics_optimizer.start_allocation_job(str(data['job_id']), source_requests, destination_requests)
+        save_pickle(job, path)
+        return job_to_dict(job)
+    except (KeyError, ValueError) as e:
+        return {"error": str(e)}
+    except Exception as e:
+        return {"error": f"Allocation job error: {str(e)}", "traceback": traceback.format_exc()}
+
+def update_allocation_job(data_path):
+    """Apply capacity/demand deltas to a stored job and repair its allocation."""
+    try:
+        with open(data_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if 'job_id' not in data:
+            return {"error": "Missing 'job_id' in data file"}
+        path = job_path(data['job_id'])
+        if not os.path.exists(path):
+            return {"error": f"Unknown job id: {data['job_id']}"}
+        with open(path, 'rb') as f:
+            job = pickle.load(f)
+        job = logistics_optimizer.update_allocation_job(job, data.get('capacity_deltas'), data.get('demand_deltas'))
+        save_pickle(job, path)
+        return job_to_dict(job)
+    except (KeyError, ValueError) as e:
+        return {"error": str(e)}
+    except Exception as e:
+        return {"error": f"Allocation job error: {str(e)}", "traceback": traceback.format_exc()}
+
+def find_column(columns, name):
+    """Find a column by name, ignoring case, surrounding spaces and non-letters (as routes/model.js does)."""
+    wanted = re.sub(r'[^a-zA-Z]', '', name).lower()
+    for column in columns:
+        if column is None:
+            continue
+        column_str = str(column)
+        if column_str.strip().lower() == name.lower() or re.sub(r'[^a-zA-Z]', '', column_str).lower() == wanted:
+            return column
+    return None
+
+def load_history_pairs(paths):
+    """Count street pairs across historical request JSON files and Excel uploads.
+
+    Allocation problems (sources/destinations) contribute every source x destination
+    pair, since the optimizer needs the full cost matrix; route requests contribute
+    their explicit pairs.
+    """
+    pair_counts = {}
+    files_read = 0
+
+    def add_pair(source, destination):
+        if not source or not destination:
+            return
+        key = (str(source).strip(), str(destination).strip())
+        pair_counts[key] = pair_counts.get(key, 0) + 1
+
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path)))
+        else:
+            files.append(path)
+
+    for file_path in files:
+        try:
+            if file_path.endswith('.json'):
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if 'sources' in data and 'destinations' in data:
+                    for source in data['sources']:
+                        for dest in data['destinations']:
+                            add_pair(source.get('source_street'), dest.get('dest_street'))
+                elif 'routes' in data:
+                    for route in data['routes']:
+                        add_pair(route.get('source'), route.get('destination'))
+                elif 'routePairs' in data:
+                    for pair in data['routePairs']:
+                        add_pair(pair.get('source'), pair.get('destination'))
+                elif 'source' in data:
+                    destinations = data.get('destinations') or [data.get('destination')]
+                    for dest in destinations:
+                        add_pair(data['source'], dest.get('street') if isinstance(dest, dict) else dest)
+            elif file_path.endswith('.xlsx'):
+                import pandas as pd  # Reading .xlsx also needs openpyxl installed
+                df = pd.read_excel(file_path)
+                source_col = find_column(df.columns, 'source')
+                dest_col = find_column(df.columns, 'destination')
+                if source_col is None or dest_col is None:
+                    continue
+                sources = df[source_col].dropna().astype(str).str.strip().unique()
+                destinations = df[dest_col].dropna().astype(str).str.strip().unique()
+                for source in sources:
+                    for dest in destinations:
+                        add_pair(source, dest)
+            else:
+                continue
+            files_read += 1
+        except Exception as e:
+            print(f"Skipping history file {file_path}: {str(e)}", file=sys.stderr)
+
+    return pair_counts, files_read
+
+CUSTOMER_KEYWORDS = ['customer', 'client', 'retailer', 'distributor']
+
+def stream_excel_rows(xlsx_path, column_names):
+    """Yield one dict per non-empty sheet row, keyed by the logical names in column_names.
+
+    column_names maps logical fields (source, destination, capacity, demand, customer)
+    to sheet header names. The workbook is opened read-only, so rows are streamed
+    instead of loading the whole sheet into memory.
+    """
+    from openpyxl import load_workbook  # Optional dependency, only needed for Excel ingestion
+    workbook = load_workbook(xlsx_path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        header = [str(h) if h is not None else None for h in header]
+        positions = {}
+        for field, name in column_names.items():
+            column = find_column(header, name) if name else None
+            if column is not None:
+                positions[field] = header.index(column)
+        missing = [f for f in ('source', 'destination') if f not in positions]
+        if missing:
+            raise KeyError(f"Missing required columns: {', '.join(missing)}")
+        if 'customer' not in positions and 'customer' not in column_names:
+            # Same keyword detection the upload route uses
+            for i, h in enumerate(header):
+                if h and any(keyword in h.strip().lower() for keyword in CUSTOMER_KEYWORDS):
+                    positions['customer'] = i
+                    break
+        for row in rows:
+            record = {}
+            for field, i in positions.items():
+                value = row[i] if i < len(row) else None
+                if isinstance(value, str):
+                    value = value.strip()
+                record[field] = value if value != '' else None
+            if any(value is not None for value in record.values()):
+                yield record
+    finally:
+        workbook.close()
+
+def ingest_excel(xlsx_path, column_names, mode='pipeline', repeated_sources='sum'):
+    """Read an uploaded workbook and run allocation and/or routing on it in this process.
+
+    Rows are grouped the way routes/model.js does: any row with a source and capacity
+    is a source, any row with a destination and demand is a destination. Node passes
+    every source row to the optimizer, so by default (repeated_sources='sum') a depot
+    listed on several rows gets the sum of their capacities; 'max' keeps its largest
+    capacity instead. A destination listed on several rows has its demands summed and
+    its customers collected. Memory is bounded by the number of distinct streets, not rows.
+    The capacity rule applied is reported as "repeated_sources" in the result.
+
+    Modes: 'pipeline' allocates then routes, 'allocate' only allocates, and 'routes'
+    routes each row's source -> destination pair, grouped by source.
+    """
+    if repeated_sources not in ('sum', 'max'):
+        raise ValueError(f"Unknown repeated_sources rule '{repeated_sources}' (expected 'sum' or 'max')")
+    capacities = {}
+    demands = {}
+    customers = {}
+    route_groups = {}
+    row_count = 0
+    for record in stream_excel_rows(xlsx_path, column_names):
+        row_count += 1
+        source = record.get('source')
+        destination = record.get('destination')
+        if source and record.get('capacity') is not None:
+            capacity = float(record['capacity'])
+            if repeated_sources == 'max':
+                capacities[str(source)] = max(capacities.get(str(source), 0), capacity)
+            else:
+                capacities[str(source)] = capacities.get(str(source), 0) + capacity
+        if destination and record.get('demand') is not None:
+            demands[str(destination)] = demands.get(str(destination), 0) + float(record['demand'])
+            if record.get('customer'):
+                customer_list = customers.setdefault(str(destination), [])
+                if str(record['customer']) not in customer_list:
+                    customer_list.append(str(record['customer']))
+        if source and destination:
+            group = route_groups.setdefault(str(source), [])
+            if str(destination) not in group:
+                group.append(str(destination))
+    print(f"Streamed {row_count} rows: {len(capacities)} sources, {len(demands)} destinations", file=sys.stderr)
+
+    if mode == 'routes':
+        routes = []
+        errors = []
+        for source, destinations in route_groups.items():
+            try:
+                if len(destinations) == 1:
+                    route = planner.find_route(source, destinations[0])
+                else:
+                    route = planner.find_multi_stop_route(source, destinations)
+                routes.append(route_to_dict(route, source, destinations))
+            except ValueError as e:
+                errors.append({"source": source, "destinations": destinations,
+                               "error": str(e).replace('\u2192', '->')})
+        return {"routes": routes, "errors": errors, "rows": row_count}
+
+    if not capacities or not demands:
+        return {"error": "Both sources and destinations are required for optimization.",
+                "allocations": [], "rows": row_count, "repeated_sources": repeated_sources}
+
+    source_requests = [LogisticsRequest(street, capacity) for street, capacity in capacities.items()]
+    destination_requests = [LogisticsDestination(street, demand) for street, demand in demands.items()]
+    if mode == 'allocate':
+        allocations = logistics_optimizer.optimize_transport_allocation(source_requests, destination_requests)
+        result = {"allocations": [{
+            "source": alloc.source_street,
+            "destination": alloc.dest_street,
+            "quantity": alloc.quantity
+        } for alloc in allocations]}
+    else:
+        result = allocate_and_route(source_requests, destination_requests)
+
+    # Attach customers the same way the upload route merges them into allocations
+    for allocation in result.get("allocations", []):
+        if allocation["destination"] in customers:
+            allocation["destination_customer"] = ", ".join(customers[allocation["destination"]])
+    result["rows"] = row_count
+    result["repeated_sources"] = repeated_sources
+    return result
+
+def save_pickle(obj, path):
+    """Write a pickle atomically so a crash never leaves a truncated model file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(obj, f)
+    os.replace(tmp_path, path)
+
+def rebuild_network(net_path):
+    """Reload the network from its net.xml and re-save all three pickles around it.
+
+    Networks pickled before chain contraction and edge geometry keep routing on
+    the full graph and cannot snap positions; this migrates them. Traffic states
+    and the trained Q-table carry over, graph-derived caches are dropped.
+    """
+    global network
+    start_time = time.time()
+    previous = {id(n): n for n in (planner.network, logistics_optimizer.route_planner.network,
+                                   logistics_optimizer.network, network)}.values()
+    rebuilt = TransportNetwork()
+    rebuilt.load_network(net_path)
+    copied = rebuilt.adopt_traffic(network)
+    rebuilt.traffic_version = max(n.traffic_version for n in previous) + 1
+
+    planner.use_network(rebuilt)
+    logistics_optimizer.route_planner.use_network(rebuilt)
+    logistics_optimizer.network = rebuilt
+    logistics_optimizer.costs_cache.clear()
+    logistics_optimizer.depot_partitions.clear()
+    network = rebuilt
+
+    save_pickle(planner, pickle_files['saved_route_planner.pkl'])
+    save_pickle(logistics_optimizer, pickle_files['saved_logistics_optimizer.pkl'])
+    save_pickle(network, pickle_files['saved_network_updated.pkl'])
+
+    return {
+        "nodes": rebuilt.full_graph.number_of_nodes(),
+        "edges": rebuilt.full_graph.number_of_edges(),
+        "routing_nodes": rebuilt.graph.number_of_nodes(),
+        "routing_edges": rebuilt.graph.number_of_edges(),
+        "geometry_edges": len(rebuilt.geometry),
+        "traffic_edges_copied": copied,
+        "elapsed": time.time() - start_time
+    }
+
+def prewarm_caches(paths, time_budget=300.0, top_n=50):
+    """Precompute routes and travel-time costs for the most frequent historical street pairs."""
+    start_time = time.time()
+    deadline = start_time + time_budget
+    pair_counts, files_read = load_history_pairs(paths)
+    ranked = sorted(pair_counts.items(), key=lambda item: item[1], reverse=True)
+    print(f"Read {files_read} history files, found {len(ranked)} distinct street pairs", file=sys.stderr)
+
+    warmed = []
+    skipped = []
+    failed = []
+    for (source, destination), count in ranked[:top_n]:
+        if time.time() >= deadline:
+            print("Prewarm time budget exhausted", file=sys.stderr)
+            break
+        if source not in planner.network.street_to_nodes or destination not in planner.network.street_to_nodes:
+            skipped.append({"source": source, "destination": destination, "count": count})
+            continue
+        try:
+            route = planner.find_route(source, destination, deadline=deadline)
+            # The optimizer routes through its own planner: warm its route cache and
+            # travel-time row too (only converged routes are cached)
+            logistics_optimizer._estimate_transport_cost(source, destination, deadline=deadline)
+            warmed.append({"source": source, "destination": destination, "count": count,
+                           "time": route.total_time, "converged": route.converged})
+        except ValueError as e:
+            failed.append({"source": source, "destination": destination, "count": count,
+                           "error": str(e).replace('\u2192', '->')})
+
+    # Persist the warmed caches for later processes
+    save_pickle(planner, pickle_files['saved_route_planner.pkl'])
+    save_pickle(logistics_optimizer, pickle_files['saved_logistics_optimizer.pkl'])
+
+    return {
+        "files_read": files_read,
+        "distinct_pairs": len(ranked),
+        "warmed": warmed,
+        "skipped": skipped,
+        "failed": failed,
+        "elapsed": time.time() - start_time
+    }
+
+def parse_options(args, defaults):
+    """Split `--name value` options from positional arguments."""
+    options = dict(defaults)
+    positional = []
+    i = 0
+    while i < len(args):
+        if args[i].startswith('--') and i + 1 < len(args):
+            options[args[i][2:]] = args[i + 1]
+            i += 2
+        else:
+            positional.append(args[i])
+            i += 1
+    return positional, options
+
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         print(safe_json_dumps({"error": "Missing command argument"}))
@@ -414,17 +1093,7 @@ if __name__ == "__main__":
                     
                 try:
                     route = planner.find_route(source, destination)
-                    # Clean street path of problematic Unicode characters
-                    clean_street_path = [str(s).replace('\u2192', '->') for s in route.street_path]
-                    
-                    results.append({
-                        "source": source,
-                        "destination": destination,
-                        "distance": route.total_distance,
-                        "time": route.total_time,
-                        "streets": clean_street_path,
-                        "traffic": serialize_traffic_distribution(route.traffic_distribution)
-                    })
+                    results.append(route_to_dict(route, source, [destination]))
                 except ValueError as e:
                     error_msg = str(e).replace('\u2192', '->')
                     errors.append({
@@ -461,6 +1130,116 @@ if __name__ == "__main__":
         result = optimize_transport(data_path)
         print(safe_json_dumps(result))
         
+    elif command == "optimize_batch":
+        if len(sys.argv) < 3:
+            print(safe_json_dumps({"error": "Missing data path argument"}))
+            sys.exit(1)
+        result = optimize_batch(sys.argv[2])
+        print(safe_json_dumps(result))
+
+    elif command == "isochrone":
+        # Data file: {"source": street, "time_limit": seconds | "minutes": n, "streets": [optional targets]}
+        if len(sys.argv) < 3:
+            print(safe_json_dumps({"error": "Missing data file path"}))
+            sys.exit(1)
+        result = reachable_streets(sys.argv[2])
+        print(safe_json_dumps(result))
+
+    elif command == "assign_depots":
+        if len(sys.argv) < 3:
+            print(safe_json_dumps({"error": "Missing data path argument"}))
+            sys.exit(1)
+        result = assign_depots(sys.argv[2])
+        print(safe_json_dumps(result))
+
+    elif command == "route_coords":
+        # Data file: {"start": {"latitude", "longitude"} | {"x", "y"}, "end": {...} | "destinations": [...]}
+        if len(sys.argv) < 3:
+            print(safe_json_dumps({"error": "Missing data file path"}))
+            sys.exit(1)
+        result = route_from_coordinates(sys.argv[2])
+        print(safe_json_dumps(result))
+
+    elif command == "match_traces":
+        if len(sys.argv) < 3:
+            print(safe_json_dumps({"error": "Missing data file path"}))
+            sys.exit(1)
+        result = match_traces(sys.argv[2])
+        print(safe_json_dumps(result))
+
+    elif command == "start_job":
+        if len(sys.argv) < 3:
+            print(safe_json_dumps({"error": "Missing data path argument"}))
+            sys.exit(1)
+        result = start_allocation_job(sys.argv[2])
+        print(safe_json_dumps(result))
+
+    elif command == "update_job":
+        if len(sys.argv) < 3:
+            print(safe_json_dumps({"error": "Missing data path argument"}))
+            sys.exit(1)
+        result = update_allocation_job(sys.argv[2])
+        print(safe_json_dumps(result))
+
+    elif command == "build_tours":
+        if len(sys.argv) < 3:
+            print(safe_json_dumps({"error": "Missing data path argument"}))
+            sys.exit(1)
+        result = build_fleet_tours(sys.argv[2])
+        print(safe_json_dumps(result))
+
+    elif command == "pipeline":
+        # Usage: app.py pipeline <data path> [--grouped true|false]
+        paths, options = parse_options(sys.argv[2:], {"grouped": "true"})
+        if not paths:
+            print(safe_json_dumps({"error": "Missing data path argument"}))
+            sys.exit(1)
+        result = run_pipeline(paths[0], grouped=options["grouped"].lower() != "false")
+        print(safe_json_dumps(result))
+
+    elif command == "ingest_excel":
+        # Usage: app.py ingest_excel <xlsx path> [--mode pipeline|allocate|routes]
+        #        [--source Source] [--destination Destination] [--capacity Capacity]
+        #        [--demand Demand] [--customer <column>] [--repeated-sources sum|max]
+        paths, options = parse_options(sys.argv[2:], {
+            "mode": "pipeline", "source": "Source", "destination": "Destination",
+            "capacity": "Capacity", "demand": "Demand", "repeated-sources": "sum"})
+        if not paths:
+            print(safe_json_dumps({"error": "Missing Excel file path"}))
+            sys.exit(1)
+        mode = options.pop("mode")
+        repeated_sources = options.pop("repeated-sources")
+        try:
+            result = ingest_excel(paths[0], options, mode, repeated_sources)
+            print(safe_json_dumps(result))
+        except Exception as e:
+            print(safe_json_dumps({"error": f"Excel ingestion error: {str(e)}", "traceback": traceback.format_exc()}))
+            sys.exit(1)
+
+    elif command == "prewarm":
+        # Usage: app.py prewarm [history paths...] [--budget seconds] [--top pairs]
+        paths, options = parse_options(sys.argv[2:], {"budget": "300", "top": "50"})
+        if not paths:
+            paths = [os.path.join(parent_dir, 'temp'), os.path.join(parent_dir, 'uploads')]
+        try:
+            result = prewarm_caches(paths, float(options["budget"]), int(options["top"]))
+            print(safe_json_dumps(result))
+        except Exception as e:
+            print(safe_json_dumps({"error": f"Prewarm error: {str(e)}", "traceback": traceback.format_exc()}))
+            sys.exit(1)
+
+    elif command == "rebuild_network":
+        # Usage: app.py rebuild_network <net.xml path>
+        if len(sys.argv) < 3:
+            print(safe_json_dumps({"error": "Missing net file path"}))
+            sys.exit(1)
+        try:
+            result = rebuild_network(sys.argv[2])
+            print(safe_json_dumps(result))
+        except Exception as e:
+            print(safe_json_dumps({"error": f"Rebuild error: {str(e)}", "traceback": traceback.format_exc()}))
+            sys.exit(1)
+
     else:
         print(safe_json_dumps({"error": f"Unknown command: {command}"}))
         sys.exit(1)
@@ -2,7 +2,7 @@
 from collections import defaultdict
 import random
 import numpy as np
-from typing import List,Optional,Dict,Tuple,Set
+from typing import List,Optional,Dict,Tuple,Set,Union,Hashable
 from enum import IntEnum
 from dataclasses import dataclass
 import xml.etree.ElementTree as ET
@@ -11,9 +11,18 @@ import networkx as nx
 import sys
 import re
 import concurrent.futures
-from collections import deque
+import multiprocessing
+import os
+from collections import deque, OrderedDict
 import time
 import random
+import heapq
+import threading
+import queue
+import contextlib
+import copy
+import functools
+import hashlib
 
 class TrafficState(IntEnum):
     LIGHT = 0
@@ -21,24 +30,656 @@ class TrafficState(IntEnum):
     HEAVY = 2
     SEVERE = 3
 
-@dataclass
 class RouteSegment:
-    from_node: str
-    to_node: str
-    street_name: str
-    length: float
-    traffic_state: TrafficState
-    estimated_time: float
+    """One traversed edge. Routes keep their edges in columns (RouteSegments);
+    these records are only built when a caller indexes or iterates them."""
+    __slots__ = ('from_node', 'to_node', 'street_name', 'length', 'traffic_state', 'estimated_time')
+
+    def __init__(self, from_node: str, to_node: str, street_name: str, length: float,
+                 traffic_state: 'TrafficState', estimated_time: float):
+        self.from_node = from_node
+        self.to_node = to_node
+        self.street_name = street_name
+        self.length = length
+        self.traffic_state = traffic_state
+        self.estimated_time = estimated_time
+
+    def __repr__(self):
+        return (f"RouteSegment(from_node={self.from_node!r}, to_node={self.to_node!r}, "
+                f"street_name={self.street_name!r}, length={self.length!r}, "
+                f"traffic_state={self.traffic_state!r}, estimated_time={self.estimated_time!r})")
+
+    def __eq__(self, other):
+        if not isinstance(other, RouteSegment):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+
+class RouteSegments:
+    """Columnar per-edge data of a route with lazy RouteSegment views.
+
+    Node, edge and street ids index shared tables (normally the planner's
+    StateEncoder), so a route costs a few small arrays instead of one object
+    and dict per edge. Pickling swaps the shared tables for route-local ones.
+    Edge i runs from node_ids[i] to node_ids[i + 1] unless from_index is set,
+    which happens when joined legs leave a gap (a leg starting away from where
+    the previous one ended); edge i then starts at node_ids[from_index[i]].
+    """
+    __slots__ = ('nodes', 'streets', 'node_ids', 'edge_ids', 'street_ids', 'lengths', 'times', 'traffic',
+                 'from_index')
+
+    def __init__(self, nodes: List[str], streets: List[str], node_ids: np.ndarray, edge_ids: np.ndarray,
+                 street_ids: np.ndarray, lengths: np.ndarray, times: np.ndarray, traffic: np.ndarray,
+                 from_index: Optional[np.ndarray] = None):
+        self.nodes = nodes
+        self.streets = streets
+        self.node_ids = node_ids  # int32 node sequence, one more than the edges when there are no gaps
+        self.edge_ids = edge_ids  # int32
+        self.street_ids = street_ids  # int32
+        self.lengths = lengths  # float64 metres
+        self.times = times  # float64 seconds
+        self.traffic = traffic  # int8 TrafficState values
+        self.from_index = from_index  # int32 position in node_ids of each edge's start, None if contiguous
+
+    def __len__(self) -> int:
+        return len(self.edge_ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("route segment index out of range")
+        if self.from_index is not None:
+            index_from = int(self.from_index[index])
+        else:
+            index_from = index
+        return RouteSegment(
+            from_node=self.nodes[self.node_ids[index_from]],
+            to_node=self.nodes[self.node_ids[index_from + 1]],
+            street_name=self.streets[self.street_ids[index]],
+            length=float(self.lengths[index]),
+            traffic_state=TrafficState(int(self.traffic[index])),
+            estimated_time=float(self.times[index])
+        )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def node_pairs(self) -> List[Tuple[str, str]]:
+        """(from_node, to_node) of every edge without building segment records."""
+        names = [self.nodes[i] for i in self.node_ids.tolist()]
+        if self.from_index is not None:
+            return [(names[i], names[i + 1]) for i in self.from_index.tolist()]
+        return list(zip(names[:-1], names[1:]))
+
+    def _from_positions(self) -> np.ndarray:
+        if self.from_index is not None:
+            return self.from_index
+        return np.arange(len(self), dtype=np.int32)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in self.__slots__[2:]
+                   if getattr(self, name) is not None)
+
+    @classmethod
+    def concat(cls, parts: List['RouteSegments']) -> Union['RouteSegments', list]:
+        """Join the segments of consecutive legs.
+
+        A leg's first node is dropped when it is where the previous leg ended;
+        otherwise the whole leg is kept and from_index records the gap.
+        """
+        parts = [part for part in parts if isinstance(part, RouteSegments) and len(part)]
+        if not parts:
+            return []
+        first = parts[0]
+        if any(part.nodes is not first.nodes or part.streets is not first.streets for part in parts):
+            # Legs from different tables: intern them all into new route-local tables
+            nodes, streets = [], []
+            node_index, street_index = {}, {}
+            parts = [part._rebased(nodes, streets, node_index, street_index) for part in parts]
+            first = parts[0]
+        node_ids = [first.node_ids]
+        from_index = [first._from_positions()]
+        gapped = first.from_index is not None
+        offset = len(first.node_ids)
+        for previous, part in zip(parts, parts[1:]):
+            gapped = gapped or part.from_index is not None
+            if part.node_ids[0] == previous.node_ids[-1]:
+                node_ids.append(part.node_ids[1:])
+                from_index.append(part._from_positions() + (offset - 1))
+                offset += len(part.node_ids) - 1
+            else:
+                gapped = True
+                node_ids.append(part.node_ids)
+                from_index.append(part._from_positions() + offset)
+                offset += len(part.node_ids)
+        return cls(first.nodes, first.streets, np.concatenate(node_ids),
+                   *(np.concatenate([getattr(part, name) for part in parts])
+                     for name in ('edge_ids', 'street_ids', 'lengths', 'times', 'traffic')),
+                   from_index=np.concatenate(from_index).astype(np.int32) if gapped else None)
+
+    def _rebased(self, nodes: List[str], streets: List[str],
+                 node_index: Dict[str, int], street_index: Dict[str, int]) -> 'RouteSegments':
+        def intern(table, index, name):
+            if name not in index:
+                index[name] = len(table)
+                table.append(name)
+            return index[name]
+
+        node_ids = np.array([intern(nodes, node_index, self.nodes[i]) for i in self.node_ids.tolist()], dtype=np.int32)
+        street_ids = np.array([intern(streets, street_index, self.streets[i]) for i in self.street_ids.tolist()],
+                              dtype=np.int32)
+        return RouteSegments(nodes, streets, node_ids, self.edge_ids, street_ids,
+                             self.lengths, self.times, self.traffic, self.from_index)
+
+    def __getstate__(self):
+        # Only ship the table entries this route uses
+        used_nodes, node_ids = np.unique(self.node_ids, return_inverse=True)
+        used_streets, street_ids = np.unique(self.street_ids, return_inverse=True)
+        return ([self.nodes[i] for i in used_nodes.tolist()], [self.streets[i] for i in used_streets.tolist()],
+                node_ids.astype(np.int32), self.edge_ids, street_ids.astype(np.int32),
+                self.lengths, self.times, self.traffic, self.from_index)
+
+    def __setstate__(self, state):
+        # Routes pickled before from_index existed are always contiguous
+        (self.nodes, self.streets, self.node_ids, self.edge_ids,
+         self.street_ids, self.lengths, self.times, self.traffic) = state[:8]
+        self.from_index = state[8] if len(state) > 8 else None
+
 
-@dataclass
 class RouteResult:
-    path: List[str]
-    street_path: List[str]
-    total_distance: float
-    total_time: float
-    success: bool
-    traffic_distribution: dict
-    segments: List[RouteSegment]
+    """A planned route. `segments` is a columnar RouteSegments (or [] for failed
+    routes) and `path` is decoded from its node ids on first access."""
+    __slots__ = ('_path', 'street_path', 'total_distance', 'total_time', 'success',
+                 'traffic_distribution', 'segments', 'converged')
+
+    def __init__(self, path: Optional[List[str]], street_path: List[str], total_distance: float,
+                 total_time: float, success: bool, traffic_distribution: dict,
+                 segments: Union['RouteSegments', List[RouteSegment]], converged: bool = True):
+        self._path = path
+        self.street_path = street_path
+        self.total_distance = total_distance
+        self.total_time = total_time
+        self.success = success
+        self.traffic_distribution = traffic_distribution
+        self.segments = segments
+        self.converged = converged  # False when a deadline cut the search short
+
+    @property
+    def path(self) -> List[str]:
+        if self._path is None:
+            nodes = self.segments.nodes
+            self._path = [nodes[i] for i in self.segments.node_ids.tolist()]
+        return self._path
+
+    @path.setter
+    def path(self, path: List[str]) -> None:
+        self._path = path
+
+    def __repr__(self):
+        return (f"RouteResult(nodes={len(self.path)}, streets={self.street_path!r}, "
+                f"total_distance={self.total_distance!r}, total_time={self.total_time!r}, "
+                f"success={self.success!r}, converged={self.converged!r})")
+
+    def to_dict(self) -> dict:
+        """The route fields of the find_route JSON output (distance, time, streets, traffic, converged)."""
+        return {
+            "distance": float(self.total_distance),
+            "time": float(self.total_time),
+            "streets": [str(street).replace('\u2192', '->') for street in self.street_path],
+            "traffic": {str(state): float(value) for state, value in self.traffic_distribution.items()},
+            "converged": self.converged
+        }
+
+class CompactQTable:
+    """Bounded Q-value store keyed by packed integer states and integer actions.
+
+    Each state owns one row of preallocated NumPy arrays holding its action keys,
+    Q-values, visit count and last-use tick. When the table is full the least
+    recently used (or least visited) rows are evicted, and pickling writes a
+    compacted copy containing only the live rows.
+    """
+
+    def __init__(self, max_states: int = 200000, row_width: int = 8,
+                 eviction: str = 'lru', evict_fraction: float = 0.125):
+        if eviction not in ('lru', 'visits'):
+            raise ValueError(f"Unknown eviction policy: {eviction}")
+        self.max_states = max_states
+        self.eviction = eviction
+        self.evict_fraction = evict_fraction
+        self._rows: Dict[int, int] = {}  # packed state -> row index
+        self._free_rows: List[int] = []
+        self._tick = 0
+        self._allocate(min(1024, max_states), row_width)
+
+    def _allocate(self, num_rows: int, row_width: int) -> None:
+        self._states = np.full(num_rows, -1, dtype=np.int64)
+        self._actions = np.full((num_rows, row_width), -1, dtype=np.int64)
+        self._values = np.zeros((num_rows, row_width), dtype=np.float32)
+        self._visits = np.zeros(num_rows, dtype=np.uint32)
+        self._last_used = np.zeros(num_rows, dtype=np.int64)
+        self._next_row = 0
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, state: int) -> bool:
+        return state in self._rows
+
+    @property
+    def nbytes(self) -> int:
+        return (self._states.nbytes + self._actions.nbytes + self._values.nbytes +
+                self._visits.nbytes + self._last_used.nbytes)
+
+    def _grow_rows(self) -> None:
+        new_size = min(self.max_states, max(1, len(self._states)) * 2)
+        extra = new_size - len(self._states)
+        width = self._actions.shape[1]
+        self._states = np.concatenate([self._states, np.full(extra, -1, dtype=np.int64)])
+        self._actions = np.vstack([self._actions, np.full((extra, width), -1, dtype=np.int64)])
+        self._values = np.vstack([self._values, np.zeros((extra, width), dtype=np.float32)])
+        self._visits = np.concatenate([self._visits, np.zeros(extra, dtype=np.uint32)])
+        self._last_used = np.concatenate([self._last_used, np.zeros(extra, dtype=np.int64)])
+
+    def _grow_width(self) -> None:
+        rows, width = self._actions.shape
+        self._actions = np.hstack([self._actions, np.full((rows, width), -1, dtype=np.int64)])
+        self._values = np.hstack([self._values, np.zeros((rows, width), dtype=np.float32)])
+
+    def _row_for(self, state: int, create: bool) -> int:
+        """Return the row index for a state, allocating (and evicting) if needed."""
+        row = self._rows.get(state)
+        if row is None:
+            if not create:
+                return -1
+            if self._free_rows:
+                row = self._free_rows.pop()
+            else:
+                if self._next_row >= len(self._states):
+                    if len(self._states) < self.max_states:
+                        self._grow_rows()
+                    else:
+                        self.evict(max(1, int(self.max_states * self.evict_fraction)))
+                        return self._row_for(state, create)
+                row = self._next_row
+                self._next_row += 1
+            self._rows[state] = row
+            self._states[row] = state
+            self._actions[row] = -1
+            self._values[row] = 0.0
+            self._visits[row] = 0
+        self._tick += 1
+        self._last_used[row] = self._tick
+        return row
+
+    def _column_for(self, row: int, action: int, create: bool) -> int:
+        row_actions = self._actions[row]
+        hits = np.flatnonzero(row_actions == action)
+        if len(hits):
+            return int(hits[0])
+        if not create:
+            return -1
+        empty = np.flatnonzero(row_actions == -1)
+        if not len(empty):
+            self._grow_width()
+            return self._column_for(row, action, create)
+        col = int(empty[0])
+        self._actions[row, col] = action
+        return col
+
+    def get(self, state: int, action: int) -> float:
+        """Get the Q-value for a state-action pair (0.0 if unseen)."""
+        row = self._rows.get(state)
+        if row is None:
+            return 0.0
+        col = self._column_for(row, action, create=False)
+        return float(self._values[row, col]) if col >= 0 else 0.0
+
+    def get_many(self, state: int, actions: List[int]) -> np.ndarray:
+        """Get Q-values for several actions of one state as a float array."""
+        result = np.zeros(len(actions), dtype=np.float64)
+        row = self._rows.get(state)
+        if row is None:
+            return result
+        matches = self._actions[row][None, :] == np.asarray(actions, dtype=np.int64)[:, None]
+        found = matches.any(axis=1)
+        result[found] = self._values[row][matches.argmax(axis=1)[found]]
+        return result
+
+    def set(self, state: int, action: int, value: float) -> None:
+        """Store a Q-value, counting the write as a visit to the state."""
+        row = self._row_for(state, create=True)
+        col = self._column_for(row, action, create=True)
+        self._values[row, col] = value
+        self._visits[row] += 1
+
+    def _lookup_rows(self, states: np.ndarray) -> np.ndarray:
+        rows = self._rows
+        return np.fromiter((rows.get(int(state), -1) for state in states),
+                           dtype=np.int64, count=len(states))
+
+    def _gather(self, rows: np.ndarray, actions: np.ndarray) -> np.ndarray:
+        """Q-values for a (batch, k) action matrix; -1 actions and unseen pairs read 0."""
+        safe_rows = np.where(rows >= 0, rows, 0)
+        row_actions = np.where((rows >= 0)[:, None], self._actions[safe_rows], -1)
+        matches = ((actions[:, :, None] == row_actions[:, None, :]) &
+                   (actions[:, :, None] >= 0))
+        cols = matches.argmax(axis=2)
+        values = np.take_along_axis(self._values[safe_rows], cols, axis=1)
+        return np.where(matches.any(axis=2), values, 0.0).astype(np.float64)
+
+    def get_batch(self, states: np.ndarray, actions: np.ndarray) -> np.ndarray:
+        """Q-values for parallel arrays of states and actions."""
+        rows = self._lookup_rows(states)
+        return self._gather(rows, np.asarray(actions, dtype=np.int64)[:, None])[:, 0]
+
+    def max_batch(self, states: np.ndarray, actions: np.ndarray) -> np.ndarray:
+        """Max Q-value per state over a -1 padded (batch, k) action matrix (0 if none)."""
+        actions = np.asarray(actions, dtype=np.int64)
+        values = self._gather(self._lookup_rows(states), actions)
+        values = np.where(actions >= 0, values, -np.inf)
+        best = values.max(axis=1) if actions.shape[1] else np.full(len(states), -np.inf)
+        return np.where(np.isfinite(best), best, 0.0)
+
+    def _columns_for(self, rows: np.ndarray, actions: np.ndarray) -> np.ndarray:
+        """Column of each (row, action) pair, creating columns only for the pairs not yet stored."""
+        matches = self._actions[rows] == actions[:, None]
+        cols = matches.argmax(axis=1)
+        for i in np.flatnonzero(~matches.any(axis=1)).tolist():
+            cols[i] = self._column_for(int(rows[i]), int(actions[i]), create=True)
+        return cols
+
+    def set_batch(self, states: np.ndarray, actions: np.ndarray, values: np.ndarray) -> None:
+        """Store parallel arrays of Q-values like repeated set() calls (a later duplicate pair wins)."""
+        states = np.asarray(states, dtype=np.int64)
+        actions = np.asarray(actions, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        if not len(states):
+            return
+        rows = self._lookup_rows(states)
+        # Touch the batch's existing rows first so creating the missing ones cannot evict them
+        self._tick += 1
+        self._last_used[rows[rows >= 0]] = self._tick
+        for state in dict.fromkeys(states[rows < 0].tolist()):
+            self._row_for(state, create=True)
+        rows = self._lookup_rows(states)
+        if (rows < 0).any():
+            # A batch larger than one eviction round: fall back to one write at a time
+            for state, action, value in zip(states.tolist(), actions.tolist(), values.tolist()):
+                self.set(state, action, value)
+            return
+        cols = self._columns_for(rows, actions)
+        cells = rows * self._values.shape[1] + cols
+        _, last = np.unique(cells[::-1], return_index=True)
+        last = len(cells) - 1 - last
+        self._values[rows[last], cols[last]] = values[last]
+        np.add.at(self._visits, rows, 1)
+
+    def export_rows(self, states) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Copy the rows of the given states as (states, actions, values) arrays."""
+        known = [state for state in states if state in self._rows]
+        rows = np.array([self._rows[state] for state in known], dtype=np.int64)
+        return (np.array(known, dtype=np.int64), self._actions[rows].copy(),
+                self._values[rows].copy())
+
+    def import_rows(self, states: np.ndarray, actions: np.ndarray, values: np.ndarray) -> None:
+        """Write rows produced by export_rows back into the table."""
+        actions = np.asarray(actions, dtype=np.int64)
+        present = actions >= 0
+        self.set_batch(np.repeat(np.asarray(states, dtype=np.int64), present.sum(axis=1)),
+                       actions[present], np.asarray(values)[present])
+
+    def evict(self, count: int) -> int:
+        """Evict up to `count` rows according to the eviction policy."""
+        live = np.array(list(self._rows.values()), dtype=np.int64)
+        if len(live) == 0 or count <= 0:
+            return 0
+        count = min(count, len(live))
+        scores = self._last_used[live] if self.eviction == 'lru' else self._visits[live]
+        victims = live[np.argpartition(scores, count - 1)[:count]]
+        for row in victims:
+            row = int(row)
+            del self._rows[int(self._states[row])]
+            self._states[row] = -1
+            self._free_rows.append(row)
+        return count
+
+    def compact(self, min_visits: int = 0) -> int:
+        """Repack live rows contiguously, trimming unused capacity and width.
+
+        Rows visited fewer than `min_visits` times are dropped. Returns the
+        number of rows kept.
+        """
+        live = sorted(row for row in self._rows.values() if self._visits[row] >= min_visits)
+        live = np.array(live, dtype=np.int64)
+        used_width = 1
+        if len(live):
+            used_width = max(1, int((self._actions[live] != -1).sum(axis=1).max()))
+        states = self._states[live]
+        actions = self._actions[live][:, :used_width]
+        values = self._values[live][:, :used_width]
+        visits = self._visits[live]
+        last_used = self._last_used[live]
+        self._allocate(len(live), used_width)
+        self._states[:] = states
+        self._actions[:] = actions
+        self._values[:] = values
+        self._visits[:] = visits
+        self._last_used[:] = last_used
+        self._next_row = len(live)
+        self._free_rows = []
+        self._rows = {int(state): row for row, state in enumerate(states)}
+        return len(live)
+
+    def __getstate__(self):
+        # Pickle a compacted copy so saved planners only carry live rows
+        live = np.array(sorted(self._rows.values()), dtype=np.int64)
+        used_width = 1
+        if len(live):
+            used_width = max(1, int((self._actions[live] != -1).sum(axis=1).max()))
+        return {
+            'max_states': self.max_states,
+            'eviction': self.eviction,
+            'evict_fraction': self.evict_fraction,
+            'states': self._states[live],
+            'actions': self._actions[live][:, :used_width],
+            'values': self._values[live][:, :used_width],
+            'visits': self._visits[live],
+            'last_used': self._last_used[live],
+            'tick': self._tick,
+        }
+
+    def __setstate__(self, state):
+        self.max_states = state['max_states']
+        self.eviction = state['eviction']
+        self.evict_fraction = state['evict_fraction']
+        self._tick = state['tick']
+        self._free_rows = []
+        self._states = state['states']
+        self._actions = state['actions']
+        self._values = state['values']
+        self._visits = state['visits']
+        self._last_used = state['last_used']
+        self._next_row = len(self._states)
+        self._rows = {int(s): row for row, s in enumerate(self._states)}
+
+
+class ScratchQTable:
+    """Copy-on-write view of a shared CompactQTable for one routing query.
+
+    Reads fall through to the shared table (under `lock`) unless this query has
+    written the pair itself; writes stay in a per-query dict, so concurrent queries
+    never touch the shared arrays. commit() replays the writes into the shared table.
+    """
+
+    def __init__(self, base: CompactQTable, lock):
+        self.base = base
+        self.lock = lock
+        self.values: Dict[Tuple[int, int], float] = {}
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def get(self, state: int, action: int) -> float:
+        value = self.values.get((state, action))
+        if value is not None:
+            return value
+        with self.lock:
+            return self.base.get(state, action)
+
+    def get_many(self, state: int, actions: List[int]) -> np.ndarray:
+        with self.lock:
+            result = self.base.get_many(state, actions)
+        if self.values:
+            for i, action in enumerate(actions):
+                value = self.values.get((state, action))
+                if value is not None:
+                    result[i] = value
+        return result
+
+    def set(self, state: int, action: int, value: float) -> None:
+        self.values[(state, action)] = float(value)
+
+    def export_rows(self, states) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Rows of the given states as seen by this query, in CompactQTable.export_rows form."""
+        states = set(states)
+        with self.lock:
+            base_states, base_actions, base_values = self.base.export_rows(states)
+        rows: Dict[int, Dict[int, float]] = {}
+        for state, row_actions, row_values in zip(base_states.tolist(), base_actions, base_values):
+            rows[state] = {action: value for action, value in zip(row_actions.tolist(), row_values.tolist())
+                           if action >= 0}
+        for (state, action), value in self.values.items():
+            if state in states:
+                rows.setdefault(state, {})[action] = value
+        width = max((len(row) for row in rows.values()), default=1)
+        actions = np.full((len(rows), width), -1, dtype=np.int64)
+        values = np.zeros((len(rows), width), dtype=np.float32)
+        for i, row in enumerate(rows.values()):
+            actions[i, :len(row)] = list(row.keys())
+            values[i, :len(row)] = list(row.values())
+        return np.array(list(rows), dtype=np.int64), actions, values
+
+    def import_rows(self, states: np.ndarray, actions: np.ndarray, values: np.ndarray) -> None:
+        for state, row_actions, row_values in zip(states.tolist(), actions, values):
+            for action, value in zip(row_actions.tolist(), row_values.tolist()):
+                if action >= 0:
+                    self.values[(state, action)] = value
+
+    def commit(self) -> int:
+        """Write this query's Q-values into the shared table; returns the pairs written."""
+        if not self.values:
+            return 0
+        keys = list(self.values)
+        states = np.fromiter((state for state, _ in keys), dtype=np.int64, count=len(keys))
+        actions = np.fromiter((action for _, action in keys), dtype=np.int64, count=len(keys))
+        values = np.fromiter(self.values.values(), dtype=np.float64, count=len(keys))
+        with self.lock:
+            self.base.set_batch(states, actions, values)
+        self.values.clear()
+        return len(keys)
+
+
+class PrioritizedReplayBuffer:
+    """Fixed-capacity ring buffer of experiences with sum-tree prioritized sampling.
+
+    Experiences are stored column-wise in preallocated NumPy arrays, so memory is
+    fixed at construction (next-action lists are -1 padded and only widen when a
+    longer list arrives). Insertion overwrites the oldest slot and updates the
+    sum-tree in O(log n); sampling draws a stratified batch proportional to
+    priority = (|td_error| + eps) ** alpha.
+    """
+
+    def __init__(self, capacity: int = 1000, max_next_actions: int = 8,
+                 alpha: float = 0.6, eps: float = 1e-3):
+        self.capacity = capacity
+        self.alpha = alpha
+        self.eps = eps
+        self.states = np.zeros(capacity, dtype=np.int64)
+        self.actions = np.zeros(capacity, dtype=np.int64)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.next_states = np.zeros(capacity, dtype=np.int64)
+        self.next_actions = np.full((capacity, max_next_actions), -1, dtype=np.int64)
+        # Sum-tree over a power-of-two leaf count: internal nodes in [1, leaves),
+        # leaves in [leaves, 2 * leaves)
+        self.leaves = 1 << max(0, (capacity - 1).bit_length())
+        self.tree = np.zeros(2 * self.leaves, dtype=np.float64)
+        self.max_priority = 1.0
+        self.position = 0
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _set_priority(self, slot: int, priority: float) -> None:
+        node = slot + self.leaves
+        self.tree[node] = priority
+        node //= 2
+        while node >= 1:
+            self.tree[node] = self.tree[2 * node] + self.tree[2 * node + 1]
+            node //= 2
+
+    def add(self, state: int, action: int, reward: float, next_state: int,
+            next_actions: List[int]) -> None:
+        slot = self.position
+        if len(next_actions) > self.next_actions.shape[1]:
+            extra = len(next_actions) - self.next_actions.shape[1]
+            self.next_actions = np.hstack([
+                self.next_actions, np.full((self.capacity, extra), -1, dtype=np.int64)])
+        self.states[slot] = state
+        self.actions[slot] = action
+        self.rewards[slot] = reward
+        self.next_states[slot] = next_state
+        self.next_actions[slot] = -1
+        self.next_actions[slot, :len(next_actions)] = next_actions
+        # New experiences get the highest priority seen so they are replayed at least once
+        self._set_priority(slot, self.max_priority)
+        self.position = (slot + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def sample(self, batch_size: int, beta: float = 0.4):
+        """Sample slots proportionally to priority.
+
+        Returns (slots, importance_weights) where the weights are normalised so
+        the largest is 1.
+        """
+        total = self.tree[1]
+        segment = total / batch_size
+        targets = (np.arange(batch_size) + np.random.uniform(0, 1, batch_size)) * segment
+        # Descend all samples through the tree together, one level at a time
+        nodes = np.ones(batch_size, dtype=np.int64)
+        while nodes[0] < self.leaves:
+            left = 2 * nodes
+            left_sums = self.tree[left]
+            go_right = targets > left_sums
+            targets = np.where(go_right, targets - left_sums, targets)
+            nodes = np.where(go_right, left + 1, left)
+        slots = np.minimum(nodes - self.leaves, self.size - 1)
+        probs = self.tree[slots + self.leaves] / total
+        weights = (self.size * np.maximum(probs, 1e-12)) ** (-beta)
+        return slots, weights / weights.max()
+
+    def update_priorities(self, slots: np.ndarray, td_errors: np.ndarray) -> None:
+        priorities = (np.abs(td_errors) + self.eps) ** self.alpha
+        # Write the leaves (a later duplicate slot wins), then refresh the touched
+        # internal nodes level by level up to the root
+        slots = np.asarray(slots, dtype=np.int64)
+        _, last = np.unique(slots[::-1], return_index=True)
+        last = len(slots) - 1 - last
+        nodes = slots[last] + self.leaves
+        self.tree[nodes] = priorities[last]
+        nodes = np.unique(nodes // 2)
+        while nodes[0] >= 1:
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+            if nodes[0] == 1:
+                break
+            nodes = np.unique(nodes // 2)
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+
 
 class ImprovedRLAgent:
     @staticmethod
@@ -49,49 +690,79 @@ class ImprovedRLAgent:
                  discount_factor: float = 0.9,
                  epsilon: float = 1.0,
                  epsilon_decay: float = 0.995,
-                 epsilon_min: float = 0.01):
+                 epsilon_min: float = 0.01,
+                 max_states: int = 200000,
+                 eviction: str = 'lru'):
         self.learning_rate = learning_rate
         self.discount_factor = discount_factor
         self.epsilon = epsilon
         self.epsilon_decay = epsilon_decay
         self.epsilon_min = epsilon_min
-        # Use the static method from the class to initialize the q_table
-        self.q_table = defaultdict(ImprovedRLAgent.default_dict_float)
-        self.replay_buffer = []
+        # Q-values keyed by packed integer states and integer actions (node indices)
+        self.q_table = CompactQTable(max_states=max_states, eviction=eviction)
         self.buffer_size = 1000
         self.batch_size = 32
+        self.replay_buffer = PrioritizedReplayBuffer(capacity=self.buffer_size)
+        self.replay_beta = 0.4  # Importance-sampling correction strength
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Older pickles stored a string-keyed defaultdict. Packing its keys needs the
+        # planner's StateEncoder and graph, so keep it aside for the planner to migrate
+        if not isinstance(self.q_table, CompactQTable):
+            self.legacy_q_table = {state: dict(row) for state, row in self.q_table.items()}
+            self.q_table = CompactQTable()
+        if not isinstance(self.replay_buffer, PrioritizedReplayBuffer):
+            self.replay_buffer = PrioritizedReplayBuffer(capacity=self.buffer_size)
+        self.__dict__.setdefault('replay_beta', 0.4)
+
+    def compact(self, min_visits: int = 0) -> int:
+        """Compact the Q-table before saving; returns the number of states kept."""
+        return self.q_table.compact(min_visits)
 
     def store_experience(self, state, action, reward, next_state, next_actions):
-        """Store experience in replay buffer"""
-        self.replay_buffer.append((state, action, reward, next_state, next_actions))
-        if len(self.replay_buffer) > self.buffer_size:
-            self.replay_buffer.pop(0)
+        """Store experience in replay buffer (overwrites the oldest once full)"""
+        self.replay_buffer.add(state, action, reward, next_state, next_actions)
 
     def experience_replay(self, batch_size=None, experience_buffer=None):
         """Learn from stored experiences with optional custom batch size and buffer"""
         if batch_size is None:
             batch_size = self.batch_size
-            
-        buffer = experience_buffer if experience_buffer is not None else self.replay_buffer
 
-        if len(buffer) < batch_size:
+        if experience_buffer is not None:
+            # Plain lists of experience tuples are replayed uniformly, one update at a time
+            if len(experience_buffer) < batch_size:
+                return
+            for state, action, reward, next_state, next_actions in random.sample(experience_buffer, batch_size):
+                self.update(state, action, reward, next_state, next_actions)
             return
 
-        batch = random.sample(buffer, batch_size)
-        for state, action, reward, next_state, next_actions in batch:
-            self.update(state, action, reward, next_state, next_actions)
+        buffer = self.replay_buffer
+        if len(buffer) < batch_size:
+            return
 
-    def choose_action(self, state, available_actions, is_training=True, temperature=1.0):
-        """Choose action with numerical stability improvements"""
+        # Prioritized sample, then one vectorized Q-learning step over the whole batch
+        slots, weights = buffer.sample(batch_size, self.replay_beta)
+        states = buffer.states[slots]
+        actions = buffer.actions[slots]
+        current_q = self.q_table.get_batch(states, actions)
+        next_q = self.q_table.max_batch(buffer.next_states[slots], buffer.next_actions[slots])
+        td_errors = buffer.rewards[slots] + self.discount_factor * next_q - current_q
+        new_q = np.clip(current_q + self.learning_rate * weights * td_errors, -1000, 1000)
+        self.q_table.set_batch(states, actions, new_q)
+        buffer.update_priorities(slots, td_errors)
+
+    def choose_action(self, state, available_actions, is_training=True, temperature=1.0, epsilon=None):
+        """Choose action with numerical stability improvements (epsilon overrides self.epsilon)"""
         if not available_actions:
             raise ValueError("No available actions to choose from")
 
         # Exploration phase
-        if is_training and random.random() < self.epsilon:
+        if is_training and random.random() < (self.epsilon if epsilon is None else epsilon):
             return random.choice(available_actions)
 
         # Exploitation phase with numerical stability improvements
-        q_values = np.array([self.get_q_value(state, action) for action in available_actions])
+        q_values = self.q_table.get_many(state, available_actions)
 
         # Apply numerical stability techniques
         if len(q_values) > 0:
@@ -119,7 +790,7 @@ class ImprovedRLAgent:
                     return available_actions[np.argmax(q_values)]
 
                 # Choose based on probability distribution
-                return np.random.choice(available_actions, p=probs)
+                return available_actions[np.random.choice(len(available_actions), p=probs)]
 
             except Exception as e:
                 print(f"Error in probability calculation: {str(e)}")
@@ -133,8 +804,7 @@ class ImprovedRLAgent:
         if not next_actions:
             next_q_value = 0
         else:
-            next_q_values = [self.get_q_value(next_state, a) for a in next_actions]
-            next_q_value = max(next_q_values) if next_q_values else 0
+            next_q_value = float(np.max(self.q_table.get_many(next_state, next_actions)))
 
         # Get current Q value
         current_q = self.get_q_value(state, action)
@@ -146,19 +816,347 @@ class ImprovedRLAgent:
         new_q = np.clip(new_q, -1000, 1000)
 
         # Store in Q-table
-        self.q_table[state][action] = new_q
+        self.q_table.set(state, action, new_q)
     def get_q_value(self, state, action):
         """Get Q-value for a state-action pair"""
-        return self.q_table[state][action]
+        return self.q_table.get(state, action)
     
+# ----------------------- Geometry -----------------------
+class NetLocation:
+    """Maps WGS84 latitude/longitude to network coordinates.
+
+    Mirrors a SUMO <location> element: points are projected with projParameter
+    (UTM is supported; "!" means the net is not georeferenced) and then shifted
+    by netOffset, which keeps network coordinates small enough for float32.
+    """
+    WGS84_A = 6378137.0
+    WGS84_F = 1 / 298.257223563
+    UTM_K0 = 0.9996
+
+    def __init__(self, net_offset: Tuple[float, float] = (0.0, 0.0), proj_parameter: str = '!'):
+        self.net_offset = net_offset
+        self.proj_parameter = proj_parameter
+        self.utm_zone = None
+        self.utm_south = False
+        if proj_parameter and proj_parameter != '!':
+            params = dict(part.lstrip('+').split('=', 1) if '=' in part else (part.lstrip('+'), True)
+                          for part in proj_parameter.split())
+            if params.get('proj') != 'utm' or 'zone' not in params:
+                raise ValueError(f"Unsupported network projection: {proj_parameter}")
+            self.utm_zone = int(params['zone'])
+            self.utm_south = 'south' in params
+
+    @classmethod
+    def from_element(cls, element: Optional[ET.Element]) -> 'NetLocation':
+        if element is None:
+            return cls()
+        x, y = (float(v) for v in element.get('netOffset', '0,0').split(','))
+        return cls((x, y), element.get('projParameter', '!'))
+
+    @property
+    def georeferenced(self) -> bool:
+        return self.utm_zone is not None
+
+    def to_net(self, lat, lon) -> Tuple[np.ndarray, np.ndarray]:
+        """Project latitude/longitude (scalars or arrays, degrees) to network x/y."""
+        if not self.georeferenced:
+            raise ValueError("Network has no projection; use network coordinates instead of lat/lon")
+        lat = np.radians(np.asarray(lat, dtype=np.float64))
+        lon = np.radians(np.asarray(lon, dtype=np.float64))
+        a, f, k0 = self.WGS84_A, self.WGS84_F, self.UTM_K0
+        e2 = f * (2 - f)
+        ep2 = e2 / (1 - e2)
+        lon0 = np.radians((self.utm_zone - 1) * 6 - 180 + 3)
+
+        # Transverse Mercator series (Snyder, Map Projections p. 61)
+        sin_lat, cos_lat, tan_lat = np.sin(lat), np.cos(lat), np.tan(lat)
+        n = a / np.sqrt(1 - e2 * sin_lat ** 2)
+        t = tan_lat ** 2
+        c = ep2 * cos_lat ** 2
+        big_a = cos_lat * (lon - lon0)
+        m = a * ((1 - e2 / 4 - 3 * e2 ** 2 / 64 - 5 * e2 ** 3 / 256) * lat
+                 - (3 * e2 / 8 + 3 * e2 ** 2 / 32 + 45 * e2 ** 3 / 1024) * np.sin(2 * lat)
+                 + (15 * e2 ** 2 / 256 + 45 * e2 ** 3 / 1024) * np.sin(4 * lat)
+                 - (35 * e2 ** 3 / 3072) * np.sin(6 * lat))
+        x = k0 * n * (big_a + (1 - t + c) * big_a ** 3 / 6
+                      + (5 - 18 * t + t ** 2 + 72 * c - 58 * ep2) * big_a ** 5 / 120) + 500000.0
+        y = k0 * (m + n * tan_lat * (big_a ** 2 / 2 + (5 - t + 9 * c + 4 * c ** 2) * big_a ** 4 / 24
+                                     + (61 - 58 * t + t ** 2 + 600 * c - 330 * ep2) * big_a ** 6 / 720))
+        if self.utm_south:
+            y = y + 10000000.0
+        return x + self.net_offset[0], y + self.net_offset[1]
+
+
+class EdgeGeometry:
+    """Polyline shapes of the graph edges packed into float32 arrays.
+
+    Edge i is edges[i] (from_node, to_node) and its shape is
+    points[starts[i]:starts[i + 1]] in network coordinates.
+    """
+
+    def __init__(self, location: NetLocation, edges: List[Tuple[str, str]],
+                 shapes: List[List[Tuple[float, float]]]):
+        self.location = location
+        self.edges = edges
+        self.edge_index = {edge: i for i, edge in enumerate(edges)}
+        lengths = np.array([len(shape) for shape in shapes], dtype=np.int64)
+        self.starts = np.zeros(len(edges) + 1, dtype=np.int32)
+        np.cumsum(lengths, out=self.starts[1:])
+        self.points = np.array([point for shape in shapes for point in shape],
+                               dtype=np.float32).reshape(-1, 2)
+
+    def __len__(self) -> int:
+        return len(self.edges)
+
+    def shape(self, edge: Tuple[str, str]) -> np.ndarray:
+        i = self.edge_index[edge]
+        return self.points[self.starts[i]:self.starts[i + 1]]
+
+    @property
+    def nbytes(self) -> int:
+        return self.points.nbytes + self.starts.nbytes
+
+
+@dataclass
+class EdgeSnap:
+    """A point snapped onto the closest edge."""
+    from_node: str
+    to_node: str
+    street_name: str
+    distance: float  # metres from the query point to the edge
+    position: float  # 0..1 along the edge shape
+    x: float  # snapped point, network coordinates
+    y: float
+
+
+class EdgeSpatialIndex:
+    """Uniform grid over the straight pieces of all edge shapes.
+
+    Each piece is filed under every cell its bounding box touches (CSR layout:
+    cell_starts / cell_pieces). A nearest query scans a block of cells around the
+    point, doubling its radius until the best piece is closer than any unscanned cell.
+    """
+
+    def __init__(self, geometry: EdgeGeometry, cell_size: Optional[float] = None):
+        self.geometry = geometry
+        points = geometry.points.astype(np.float64)
+        starts = geometry.starts
+        # A piece joins consecutive points of the same edge
+        piece_start = np.arange(len(points) - 1) if len(points) > 1 else np.zeros(0, dtype=np.int64)
+        edge_of_point = np.repeat(np.arange(len(geometry)), np.diff(starts))
+        keep = edge_of_point[piece_start] == edge_of_point[piece_start + 1] if len(piece_start) else piece_start.astype(bool)
+        piece_start = piece_start[keep]
+        self.a = points[piece_start]
+        self.b = points[piece_start + 1]
+        self.piece_edge = edge_of_point[piece_start].astype(np.int32)
+        # Cumulative length up to each piece, for the position along the edge
+        piece_length = np.hypot(*(self.b - self.a).T)
+        self.piece_length = piece_length
+        self.piece_offset = np.zeros(len(piece_length))
+        edge_total = np.zeros(len(geometry))
+        np.add.at(edge_total, self.piece_edge, piece_length)
+        self.edge_length = edge_total
+        if len(piece_length):
+            csum = np.cumsum(piece_length)
+            first = np.searchsorted(self.piece_edge, self.piece_edge, side='left')
+            before = np.concatenate([[0.0], csum[:-1]])
+            self.piece_offset = before - before[first]
+
+        if cell_size is None:
+            cell_size = max(10.0, 2 * float(np.median(piece_length))) if len(piece_length) else 100.0
+        self.cell_size = cell_size
+        lo = np.minimum(self.a, self.b).min(axis=0) if len(piece_length) else np.zeros(2)
+        hi = np.maximum(self.a, self.b).max(axis=0) if len(piece_length) else np.zeros(2)
+        self.origin = lo
+        self.shape = (np.floor((hi - lo) / cell_size).astype(int) + 1)
+
+        c0 = np.floor((np.minimum(self.a, self.b) - lo) / cell_size).astype(np.int64)
+        c1 = np.floor((np.maximum(self.a, self.b) - lo) / cell_size).astype(np.int64)
+        cells, pieces = [], []
+        single = (c0 == c1).all(axis=1)
+        index = np.flatnonzero(single)
+        cells.append(c0[index, 0] * self.shape[1] + c0[index, 1])
+        pieces.append(index)
+        for i in np.flatnonzero(~single).tolist():
+            xs = np.arange(c0[i, 0], c1[i, 0] + 1)
+            ys = np.arange(c0[i, 1], c1[i, 1] + 1)
+            covered = (xs[:, None] * self.shape[1] + ys[None, :]).ravel()
+            cells.append(covered)
+            pieces.append(np.full(len(covered), i))
+        cells = np.concatenate(cells)
+        pieces = np.concatenate(pieces)
+        order = np.argsort(cells, kind='stable')
+        self.cell_pieces = pieces[order].astype(np.int32)
+        self.cell_starts = np.searchsorted(cells[order], np.arange(self.shape[0] * self.shape[1] + 1)).astype(np.int32)
+
+    def _block(self, cx: int, cy: int, r: int) -> np.ndarray:
+        """Pieces filed under the (2r+1)^2 cells around (cx, cy); each grid row is one CSR slice."""
+        nx_, ny_ = self.shape
+        y0, y1 = max(cy - r, 0), min(cy + r, ny_ - 1)
+        if y0 > y1:
+            return self.cell_pieces[:0]
+        rows = range(max(cx - r, 0), min(cx + r, nx_ - 1) + 1)
+        slices = [self.cell_pieces[self.cell_starts[x * ny_ + y0]:self.cell_starts[x * ny_ + y1 + 1]] for x in rows]
+        if len(slices) == 1:
+            return slices[0]
+        return np.concatenate(slices) if slices else self.cell_pieces[:0]
+
+    def nearest(self, x: float, y: float, max_distance: Optional[float] = None):
+        """(edge index, distance, position along edge, snapped x, snapped y) or None."""
+        if not len(self.piece_edge):
+            return None
+        cx = int((x - self.origin[0]) // self.cell_size)
+        cy = int((y - self.origin[1]) // self.cell_size)
+        # Radius (in cells) that reaches the whole grid from the query cell
+        full = max(abs(cx), abs(cy), abs(cx - self.shape[0] + 1), abs(cy - self.shape[1] + 1))
+        r = 1
+        while True:
+            pieces = self._block(cx, cy, r)
+            if len(pieces):
+                a, b = self.a[pieces], self.b[pieces]
+                ab = b - a
+                ap_x, ap_y = x - a[:, 0], y - a[:, 1]
+                denom = ab[:, 0] * ab[:, 0] + ab[:, 1] * ab[:, 1]
+                t = np.clip((ap_x * ab[:, 0] + ap_y * ab[:, 1]) / np.maximum(denom, 1e-12), 0.0, 1.0)
+                dx = ap_x - ab[:, 0] * t
+                dy = ap_y - ab[:, 1] * t
+                dist2 = dx * dx + dy * dy
+                k = int(np.argmin(dist2))
+                distance = float(np.sqrt(dist2[k]))
+                # Unscanned cells are at least r cells away, so a hit that close is final
+                if distance <= r * self.cell_size or r >= full:
+                    break
+            elif r >= full:
+                return None
+            if max_distance is not None and r * self.cell_size >= max_distance:
+                if not len(pieces):
+                    return None
+                break
+            r = min(r * 2, full)
+
+        if max_distance is not None and distance > max_distance:
+            return None
+        piece = pieces[k]
+        edge = int(self.piece_edge[piece])
+        along = self.piece_offset[piece] + t[k] * self.piece_length[piece]
+        position = along / self.edge_length[edge] if self.edge_length[edge] > 0 else 0.0
+        return edge, distance, float(position), float(a[k, 0] + ab[k, 0] * t[k]), float(a[k, 1] + ab[k, 1] * t[k])
+
+    def candidates(self, xs: np.ndarray, ys: np.ndarray, radius: float,
+                   k: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Up to k closest edges within radius of each point, for many points at once.
+
+        Returns flat arrays (point, edge, distance, position) sorted by point and then
+        distance; every edge appears at most once per point.
+        """
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0), np.zeros(0))
+        if not len(self.piece_edge) or not len(xs):
+            return empty
+        nx_, ny_ = self.shape
+        cx = np.floor((xs - self.origin[0]) / self.cell_size).astype(np.int64)
+        cy = np.floor((ys - self.origin[1]) / self.cell_size).astype(np.int64)
+        reach = int(np.ceil(radius / self.cell_size))
+        point_parts, piece_parts = [], []
+        for dx in range(-reach, reach + 1):
+            for dy in range(-reach, reach + 1):
+                x, y = cx + dx, cy + dy
+                inside = np.flatnonzero((x >= 0) & (x < nx_) & (y >= 0) & (y < ny_))
+                key = x[inside] * ny_ + y[inside]
+                starts = self.cell_starts[key].astype(np.int64)
+                counts = self.cell_starts[key + 1] - starts
+                total = int(counts.sum())
+                if not total:
+                    continue
+                # Expand each cell's CSR range into one (point, piece) row per piece
+                offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+                point_parts.append(np.repeat(inside, counts))
+                piece_parts.append(self.cell_pieces[np.repeat(starts, counts) + offsets])
+        if not point_parts:
+            return empty
+        point = np.concatenate(point_parts)
+        piece = np.concatenate(piece_parts)
+
+        a, b = self.a[piece], self.b[piece]
+        ab = b - a
+        ap_x, ap_y = xs[point] - a[:, 0], ys[point] - a[:, 1]
+        denom = ab[:, 0] * ab[:, 0] + ab[:, 1] * ab[:, 1]
+        t = np.clip((ap_x * ab[:, 0] + ap_y * ab[:, 1]) / np.maximum(denom, 1e-12), 0.0, 1.0)
+        distance = np.hypot(ap_x - ab[:, 0] * t, ap_y - ab[:, 1] * t)
+        near = distance <= radius
+        point, piece, t, distance = point[near], piece[near], t[near], distance[near]
+        edge = self.piece_edge[piece]
+
+        # Closest piece per (point, edge), then the k closest edges per point
+        order = np.lexsort((distance, edge, point))
+        point, edge, piece, t, distance = point[order], edge[order], piece[order], t[order], distance[order]
+        first = np.ones(len(point), dtype=bool)
+        first[1:] = (point[1:] != point[:-1]) | (edge[1:] != edge[:-1])
+        point, edge, piece, t, distance = point[first], edge[first], piece[first], t[first], distance[first]
+        order = np.lexsort((distance, point))
+        point, edge, piece, t, distance = point[order], edge[order], piece[order], t[order], distance[order]
+        group_start = np.searchsorted(point, point, side='left')
+        keep = np.arange(len(point)) - group_start < k
+        point, edge, piece, t, distance = point[keep], edge[keep], piece[keep], t[keep], distance[keep]
+
+        along = self.piece_offset[piece] + t * self.piece_length[piece]
+        length = self.edge_length[edge]
+        position = np.where(length > 0, along / np.where(length > 0, length, 1), 0.0)
+        return point, edge, distance, position
+
 # ----------------------- TransportNetwork -----------------------
 import xml.etree.ElementTree as ET
+
+@dataclass
+class PreparedTraffic:
+    """Routing graphs with a traffic update applied, built off to the side of the live ones."""
+    base_version: int  # Traffic version the copies were made from
+    graph: nx.DiGraph
+    full_graph: nx.DiGraph
+    changed: frozenset  # Routing-graph edges the update touched
+
+    @property
+    def version(self) -> int:
+        return self.base_version + 1
+
 class TransportNetwork:
     def __init__(self):
         self.graph = nx.DiGraph()
         self.street_to_nodes = defaultdict(list)
         self.node_to_street = {}
         self.bottleneck_nodes = set()
+        self.traffic_version = 0  # Bumped on every traffic update so caches can detect staleness
+        self.geometry: Optional[EdgeGeometry] = None
+        self._spatial_index: Optional[EdgeSpatialIndex] = None  # Built lazily, never pickled
+        # Routing runs on `graph`, where degree-2 street chains are single edges;
+        # full_graph keeps every original edge and chain_of maps them to their chain edge
+        self.full_graph = self.graph
+        self.chain_of: Dict[Tuple[str, str], Tuple[str, str]] = {}
+        # (traffic_version, routing edges it changed) for the most recent updates, so
+        # derived structures can repair themselves instead of rescanning every edge
+        self.traffic_log = deque(maxlen=64)
+        # Serialises publishing a traffic version against readers taking a snapshot()
+        self._publish_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_spatial_index'] = None
+        state.pop('_publish_lock', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault('traffic_version', 0)
+        self.__dict__.setdefault('geometry', None)
+        self.__dict__.setdefault('_spatial_index', None)
+        self.__dict__.setdefault('full_graph', self.graph)
+        self.__dict__.setdefault('chain_of', {})
+        self.__dict__.setdefault('traffic_log', deque(maxlen=64))
+        self._publish_lock = threading.Lock()
+        if 'chain_of' not in state:
+            print("Network was pickled before chain contraction and routes on the full graph; "
+                  "run `python app.py rebuild_network <net.xml>` to contract it", file=sys.stderr)
 
     def load_network(self, osm_file: str) -> None:
         try:
@@ -169,6 +1167,13 @@ class TransportNetwork:
         except FileNotFoundError:
             raise FileNotFoundError(f"OSM file not found: {osm_file}")
 
+        # Junction positions are the fallback geometry for edges without a shape
+        self._junction_xy = {}
+        for junction in root.findall('.//junction'):
+            if junction.get('x') is not None and junction.get('y') is not None:
+                self._junction_xy[junction.get('id')] = (float(junction.get('x')), float(junction.get('y')))
+        self._edge_shapes = {}
+
         for edge in root.findall('.//edge'):
             self._process_edge(edge)
 
@@ -179,6 +1184,15 @@ class TransportNetwork:
         largest_cc = max(nx.weakly_connected_components(self.graph), key=len)
         self.graph = self.graph.subgraph(largest_cc).copy()
 
+        # Pack the shapes of the remaining edges into float32 arrays
+        edges = [edge for edge in self.graph.edges() if edge in self._edge_shapes]
+        self.geometry = EdgeGeometry(NetLocation.from_element(root.find('location')),
+                                     edges, [self._edge_shapes[edge] for edge in edges])
+        self._spatial_index = None
+        del self._junction_xy, self._edge_shapes
+
+        self.contract_chains()
+
         # Preprocess network for RL
         self.preprocess_network_for_rl()
 
@@ -200,6 +1214,14 @@ class TransportNetwork:
             speed = float(lanes[0].get('speed', speed))
             length = float(lanes[0].get('length', length))
 
+        # Shape: first lane, then the edge itself, then the straight line between junctions
+        shape = (lanes[0].get('shape') if lanes else None) or edge.get('shape')
+        if shape:
+            self._edge_shapes[(from_node, to_node)] = [tuple(map(float, point.split(',')[:2]))
+                                                       for point in shape.split()]
+        elif from_node in self._junction_xy and to_node in self._junction_xy:
+            self._edge_shapes[(from_node, to_node)] = [self._junction_xy[from_node], self._junction_xy[to_node]]
+
         self.graph.add_edge(
             from_node,
             to_node,
@@ -214,10 +1236,205 @@ class TransportNetwork:
         self.node_to_street[from_node] = name
         self.node_to_street[to_node] = name
 
+    def _is_chain_node(self, node: str) -> bool:
+        """True if node only continues one street: one edge in and one out, or both ways to two neighbours."""
+        graph = self.full_graph
+        successors, predecessors = graph.succ[node], graph.pred[node]
+        if len(successors) == 1 and len(predecessors) == 1:
+            if set(successors) == set(predecessors):
+                return False  # Dead end of a two-way street
+        elif not (len(successors) == 2 and set(successors) == set(predecessors)):
+            return False
+        streets = {data['street_name'] for data in successors.values()}
+        streets.update(data['street_name'] for data in predecessors.values())
+        return len(streets) == 1
+
+    def _chains(self, interior: Set[str]) -> Optional[Dict[Tuple[str, str], List[str]]]:
+        """Walk from every kept node through interior nodes to the next kept node.
+
+        Returns {(start, end): interior nodes}. If two chains would share an edge, or an
+        interior cycle is unreachable, one node is moved out of `interior` and None is returned.
+        """
+        graph = self.full_graph
+        chains = {}
+        covered = set()
+        for start in graph:
+            if start in interior:
+                continue
+            for first in graph.succ[start]:
+                via = []
+                previous, current = start, first
+                while current in interior:
+                    via.append(current)
+                    previous, current = current, next(n for n in graph.succ[current] if n != previous)
+                key = (start, current)
+                if key in chains or (current == start and via):
+                    # Parallel chains or a loop: keep a node of the longer one as a junction
+                    longer = via if len(via) >= len(chains.get(key, [])) else chains[key]
+                    interior.discard(longer[len(longer) // 2])
+                    return None
+                chains[key] = via
+                covered.update(via)
+        orphans = interior - covered
+        if orphans:
+            interior.discard(next(iter(orphans)))  # A ring street with no junction keeps one node
+            return None
+        return chains
+
+    def _refresh_chain_edge(self, start: str, end: str, graph: Optional[nx.DiGraph] = None,
+                            full_graph: Optional[nx.DiGraph] = None) -> None:
+        """Recompute a chain edge's traffic from its parts (in `graph`/`full_graph`, default the live ones).
+
+        It takes the worst traffic state of its parts. Its speed_limit is an effective
+        speed chosen so the usual length / speed_limit * (1 + state * 0.25) formula
+        gives the exact sum of the part travel times.
+        """
+        graph = self.graph if graph is None else graph
+        full_graph = self.full_graph if full_graph is None else full_graph
+        data = graph[start][end]
+        nodes = (start,) + data['via'] + (end,)
+        parts = [full_graph[u][v] for u, v in zip(nodes, nodes[1:])]
+        state = max(part['traffic_state'] for part in parts)
+        travel_time = sum(edge_travel_time(part) for part in parts)
+        data['traffic_state'] = state
+        data['speed_limit'] = data['length'] * (1 + state.value * 0.25) / travel_time
+
+    def contract_chains(self) -> None:
+        """Contract degree-2 chains on the same street into single edges with stored unpacking.
+
+        Each chain edge carries its interior nodes in 'via' and the summed length.
+        full_graph keeps the original edges, which _create_route_result uses to expand
+        routes back to every node and segment.
+        """
+        full = self.full_graph = self.graph
+        interior = {node for node in full if self._is_chain_node(node)}
+        chains = None
+        while chains is None:
+            chains = self._chains(interior)
+
+        contracted = nx.DiGraph()
+        contracted.add_nodes_from((node, data) for node, data in full.nodes(data=True) if node not in interior)
+        self.chain_of = {}
+        for (start, end), via in chains.items():
+            if not via:
+                contracted.add_edge(start, end, **full[start][end])
+                continue
+            nodes = [start] + via + [end]
+            data = dict(full[start][via[0]])
+            data['length'] = sum(full[u][v]['length'] for u, v in zip(nodes, nodes[1:]))
+            data['via'] = tuple(via)
+            contracted.add_edge(start, end, **data)
+            for u, v in zip(nodes, nodes[1:]):
+                self.chain_of[(u, v)] = (start, end)
+        self.graph = contracted
+        for start, end in set(self.chain_of.values()):
+            self._refresh_chain_edge(start, end)
+
+        # Streets are addressed through the contracted edges from now on
+        self.street_to_nodes = defaultdict(list)
+        for start, end, data in contracted.edges(data=True):
+            self.street_to_nodes[data['street_name']].append((start, end))
+        print(f"Contracted {len(interior)} chain nodes: {full.number_of_nodes()} -> "
+              f"{contracted.number_of_nodes()} nodes, {full.number_of_edges()} -> {contracted.number_of_edges()} edges")
+
+    def adopt_traffic(self, previous: 'TransportNetwork') -> int:
+        """Carry traffic over from an older load of the same network (e.g. when rebuilding a pickle).
+
+        Copies the traffic state of every original edge both networks share, refreshes
+        the chain edges they belong to and moves traffic_version past the old one, so
+        caches keyed on the old versions miss. Returns the number of edges copied.
+        """
+        copied = 0
+        touched_chains = set()
+        for u, v, data in self.full_graph.edges(data=True):
+            if previous.full_graph.has_edge(u, v):
+                data['traffic_state'] = previous.full_graph[u][v]['traffic_state']
+                if (u, v) in self.chain_of:
+                    touched_chains.add(self.chain_of[(u, v)])
+                elif self.graph is not self.full_graph and self.graph.has_edge(u, v):
+                    self.graph[u][v]['traffic_state'] = data['traffic_state']
+                copied += 1
+        for start, end in touched_chains:
+            self._refresh_chain_edge(start, end)
+        self.traffic_version = previous.traffic_version + 1
+        self.traffic_log.clear()
+        return copied
+
+    @property
+    def spatial_index(self) -> EdgeSpatialIndex:
+        if self.geometry is None:
+            raise ValueError("Network has no edge geometry (pickled before it was kept); "
+                             "run `python app.py rebuild_network <net.xml>` to add it")
+        if not len(self.geometry):
+            raise ValueError("Network has no edge geometry: its net file has no lane shapes "
+                             "or junction positions")
+        if self._spatial_index is None:
+            self._spatial_index = EdgeSpatialIndex(self.geometry)
+        return self._spatial_index
+
+    def snap_xy(self, x: float, y: float, max_distance: Optional[float] = None) -> Optional[EdgeSnap]:
+        """Closest edge to a point in network coordinates, or None if none lies within max_distance."""
+        hit = self.spatial_index.nearest(x, y, max_distance)
+        if hit is None:
+            return None
+        edge, distance, position, px, py = hit
+        from_node, to_node = self.geometry.edges[edge]
+        return EdgeSnap(from_node, to_node, self.full_graph[from_node][to_node]['street_name'],
+                        distance, position, px, py)
+
+    def snap(self, latitude: float, longitude: float, max_distance: Optional[float] = None) -> Optional[EdgeSnap]:
+        """Closest edge to a WGS84 position (e.g. a TrackerData Location)."""
+        x, y = self.geometry.location.to_net(latitude, longitude)
+        return self.snap_xy(float(x), float(y), max_distance)
+
     def update_traffic(self, traffic_data: pd.DataFrame) -> None:
+        """Apply traffic rows as a new traffic version, without touching the live graphs.
+
+        Prepares copies and publishes them, preparing again if another update was
+        published in between, so queries routing on a snapshot never see a half-applied update.
+        """
+        while not self.publish_traffic(self.prepare_traffic(traffic_data)):
+            pass
+
+    def snapshot(self) -> Tuple[int, nx.DiGraph, nx.DiGraph]:
+        """(traffic_version, graph, full_graph) of one published traffic version."""
+        with self._publish_lock:
+            return self.traffic_version, self.graph, self.full_graph
+
+    def prepare_traffic(self, traffic_data: pd.DataFrame) -> 'PreparedTraffic':
+        """Build copies of the routing graphs with the traffic applied, without publishing them.
+
+        Queries keep routing on the live graphs while this runs; publish_traffic
+        then swaps the copies in as the next traffic version.
+        """
+        version, graph, full_graph = self.snapshot()
+        new_full_graph = full_graph.copy()
+        # Without contraction both names refer to one graph, and so must the copies
+        new_graph = new_full_graph if graph is full_graph else graph.copy()
+        changed = self._apply_traffic(new_full_graph, new_graph, traffic_data)
+        return PreparedTraffic(version, new_graph, new_full_graph, frozenset(changed))
+
+    def publish_traffic(self, prepared: 'PreparedTraffic') -> bool:
+        """Make prepared graphs the live ones and bump the traffic version, atomically.
+
+        Returns False (and publishes nothing) if another update was published after
+        `prepared` was built from it; the caller should prepare again.
+        """
+        with self._publish_lock:
+            if self.traffic_version != prepared.base_version:
+                return False
+            self.graph = prepared.graph
+            self.full_graph = prepared.full_graph
+            self.traffic_version = prepared.version
+            self.traffic_log.append((prepared.version, prepared.changed))
+        return True
+
+    def _apply_traffic(self, full_graph: nx.DiGraph, graph: nx.DiGraph,
+                       traffic_data: pd.DataFrame) -> Set[Tuple[str, str]]:
+        """Write traffic rows into the given graphs; returns the routing-graph edges touched."""
         # Create a mapping of edge_ids to their corresponding graph edges for faster lookup
         edge_id_map = {}
-        for u, v, d in self.graph.edges(data=True):
+        for u, v, d in full_graph.edges(data=True):
             edge_id = d.get('edge_id')
             if edge_id:
                 if edge_id not in edge_id_map:
@@ -225,6 +1442,8 @@ class TransportNetwork:
                 edge_id_map[edge_id].append((u, v))
 
         # Update traffic states for all rows in one pass
+        touched_chains = set()
+        touched_edges = set()
         for _, row in traffic_data.iterrows():
             edge_id = row['edge_id']
             if edge_id in edge_id_map:
@@ -236,7 +1455,31 @@ class TransportNetwork:
 
                 # Update all edges with this edge_id
                 for u, v in edge_id_map[edge_id]:
-                    self.graph[u][v]['traffic_state'] = traffic_state
+                    full_graph[u][v]['traffic_state'] = traffic_state
+                    if (u, v) in self.chain_of:
+                        touched_chains.add(self.chain_of[(u, v)])
+                    elif graph.has_edge(u, v):
+                        graph[u][v]['traffic_state'] = traffic_state
+                        touched_edges.add((u, v))
+
+        for start, end in touched_chains:
+            self._refresh_chain_edge(start, end, graph, full_graph)
+        return touched_edges | touched_chains
+
+    def traffic_changes_since(self, traffic_version: int) -> Optional[Set[Tuple[str, str]]]:
+        """Routing-graph edges whose traffic may have changed after `traffic_version`.
+
+        None when the log no longer reaches back that far and callers must rescan.
+        """
+        if traffic_version == self.traffic_version:
+            return set()
+        if not self.traffic_log or self.traffic_log[0][0] > traffic_version + 1:
+            return None
+        changed = set()
+        for version, edges in self.traffic_log:
+            if version > traffic_version:
+                changed.update(edges)
+        return changed
 
     def _calculate_traffic_state(self, speed: Optional[float],
                                occupancy: Optional[float],
@@ -281,6 +1524,668 @@ class TransportNetwork:
         print(f"Network has {len(self.street_to_nodes)} unique streets")
 
 # ----------------------- RoutePlanner -----------------------
+def edge_travel_time(data: dict) -> float:
+    """Travel time in seconds of one edge under its current traffic state."""
+    return data['length'] / data['speed_limit'] * (1 + data['traffic_state'].value * 0.25)
+
+
+def travel_time_search(graph: nx.DiGraph, sources, reverse: bool = False,
+                       cutoff: Optional[float] = None, targets=None, cost=edge_travel_time):
+    """Multi-source Dijkstra over travel times (or any other `cost` of the edge data).
+
+    `sources` is an iterable of nodes or a dict of node -> (start_cost, label).
+    With reverse=True edges are followed backwards, giving times *to* the sources.
+    Returns (times, predecessors, labels): the best time per reached node, the
+    previous node on its tree path (None at sources) and the label of the source
+    it was reached from (the source node itself when no label is given).
+    Nodes beyond `cutoff` (seconds, or `cost` units) are not settled, and the search stops early
+    once any node in `targets` is settled.
+    """
+    if not isinstance(sources, dict):
+        sources = {node: (0.0, node) for node in sources}
+    adjacency = graph.pred if reverse else graph.succ
+    times = {}
+    predecessors = {}
+    labels = {}
+    heap = []
+    counter = 0
+    for node, (start_cost, label) in sources.items():
+        if node in graph:
+            heap.append((start_cost, counter, node, None, label))
+            counter += 1
+    heapq.heapify(heap)
+    while heap:
+        total, _, node, pred, label = heapq.heappop(heap)
+        if node in times:
+            continue
+        if cutoff is not None and total > cutoff:
+            break
+        times[node] = total
+        predecessors[node] = pred
+        labels[node] = label
+        if targets is not None and node in targets:
+            break
+        for neighbor, data in adjacency[node].items():
+            if neighbor not in times:
+                heapq.heappush(heap, (total + cost(data), counter, neighbor, node, label))
+                counter += 1
+    return times, predecessors, labels
+
+
+def k_nearest_labels(graph: nx.DiGraph, sources: List[Tuple[str, Hashable]], k: int,
+                     cutoff: Optional[float] = None) -> Dict[str, Dict[Hashable, float]]:
+    """Travel time from the k nearest distinct labels to every node, in one search.
+
+    `sources` is a list of (seed node, label) pairs; a label may cover several
+    nodes (all nodes of one street) and a node may carry several labels. Each node is settled at most once per label and at most
+    k times in total, so the search costs about k times a plain Dijkstra.
+    Returns node -> {label: time} with up to k entries.
+    """
+    nearest: Dict[str, Dict[Hashable, float]] = defaultdict(dict)
+    heap = []
+    counter = 0
+    for node, label in sources:
+        if node in graph:
+            heap.append((0.0, counter, node, label))
+            counter += 1
+    heapq.heapify(heap)
+    while heap:
+        cost, _, node, label = heapq.heappop(heap)
+        settled = nearest[node]
+        if label in settled or len(settled) >= k:
+            continue
+        if cutoff is not None and cost > cutoff:
+            break
+        settled[label] = cost
+        for neighbor, data in graph.succ[node].items():
+            reached = nearest.get(neighbor)
+            if reached is None or (label not in reached and len(reached) < k):
+                heapq.heappush(heap, (cost + edge_travel_time(data), counter, neighbor, label))
+                counter += 1
+    return nearest
+
+
+def tree_path(predecessors: dict, node) -> List:
+    """Walk a predecessor map back to its source; returns the path ending at `node`."""
+    path = []
+    while node is not None:
+        path.append(node)
+        node = predecessors[node]
+    path.reverse()
+    return path
+
+
+class StateEncoder:
+    """Packs a node and the traffic on its outgoing edges into a single integer.
+
+    The node index occupies the high bits and each outgoing edge contributes its
+    2-bit TrafficState to the low TRAFFIC_BITS bits (in neighbour-index order,
+    XOR-folded for nodes with more than 12 successors). Connectivity and the
+    bottleneck flag are fixed per node, so the node index already implies them.
+    """
+    TRAFFIC_BITS = 24
+
+    def __init__(self):
+        self.node_ids: Dict[str, int] = {}
+        self.nodes: List[str] = []
+        # Dense ids for the columnar route representation (RouteSegments)
+        self.edge_ids: Dict[Tuple[int, int], int] = {}
+        self.street_ids: Dict[str, int] = {}
+        self.streets: List[str] = []
+        self._lock = threading.Lock()  # Guards id assignment; lookups of known ids take no lock
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault('edge_ids', {})
+        self.__dict__.setdefault('street_ids', {})
+        self.__dict__.setdefault('streets', [])
+        self._lock = threading.Lock()
+
+    def node_id(self, node: str) -> int:
+        """Return the dense integer id for a node, assigning one on first use."""
+        idx = self.node_ids.get(node)
+        if idx is None:
+            with self._lock:
+                idx = self.node_ids.get(node)
+                if idx is None:
+                    idx = len(self.nodes)
+                    self.nodes.append(node)
+                    self.node_ids[node] = idx
+        return idx
+
+    def intern(self, nodes, streets=()) -> None:
+        """Assign ids to all given nodes and streets now instead of on first use."""
+        with self._lock:
+            for node in nodes:
+                if node not in self.node_ids:
+                    self.node_ids[node] = len(self.nodes)
+                    self.nodes.append(node)
+            for street in streets:
+                if street not in self.street_ids:
+                    self.street_ids[street] = len(self.streets)
+                    self.streets.append(street)
+
+    def edge_id(self, from_id: int, to_id: int) -> int:
+        idx = self.edge_ids.get((from_id, to_id))
+        if idx is None:
+            with self._lock:
+                idx = self.edge_ids.get((from_id, to_id))
+                if idx is None:
+                    idx = len(self.edge_ids)
+                    self.edge_ids[(from_id, to_id)] = idx
+        return idx
+
+    def street_id(self, street: str) -> int:
+        idx = self.street_ids.get(street)
+        if idx is None:
+            with self._lock:
+                idx = self.street_ids.get(street)
+                if idx is None:
+                    idx = len(self.streets)
+                    self.streets.append(street)
+                    self.street_ids[street] = idx
+        return idx
+
+    def encode(self, graph: nx.DiGraph, node: str) -> int:
+        return self._pack(node, [(dest, int(data['traffic_state']))
+                                 for _, dest, data in graph.edges(node, data=True)])
+
+    def encode_legacy(self, graph: nx.DiGraph, key: str) -> Optional[int]:
+        """Pack a string state of the pre-integer Q-table, or None if it no longer fits the graph.
+
+        Legacy keys read 'node|c<connectivity>|t<avg traffic>|b<bottleneck>|dest:state_dest:state'
+        with the outgoing edges sorted by name.
+        """
+        parts = key.rsplit('|', 4)
+        if len(parts) != 5 or parts[0] not in graph:
+            return None
+        node = parts[0]
+        traffic = [(dest, int(value)) for dest, value in re.findall(r'(.+?):(\d+)(?:_|$)', parts[4])]
+        if any(not graph.has_edge(node, dest) for dest, _ in traffic):
+            return None
+        return self._pack(node, traffic)
+
+    def _pack(self, node: str, traffic: List[Tuple[str, int]]) -> int:
+        traffic = sorted((self.node_id(dest), value) for dest, value in traffic)
+        code = 0
+        for i, (_, value) in enumerate(traffic):
+            code ^= value << ((2 * i) % self.TRAFFIC_BITS)
+        return (self.node_id(node) << self.TRAFFIC_BITS) | code
+
+
+@dataclass
+class PolicyEntry:
+    """Training outcome for one destination node under one traffic version."""
+    traffic_version: int
+    converged: bool
+    episodes: int
+    success_rate: float
+    best_paths: Dict[str, List[str]]  # start node -> best path found
+    q_slice: Tuple[np.ndarray, np.ndarray, np.ndarray]  # see CompactQTable.export_rows
+
+    @property
+    def nbytes(self) -> int:
+        path_bytes = sum(64 * len(path) for path in self.best_paths.values())
+        return path_bytes + sum(array.nbytes for array in self.q_slice)
+
+
+class PolicyCache:
+    """Destination-keyed cache of trained policies with LRU eviction by memory size."""
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[tuple, PolicyEntry]" = OrderedDict()
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def lookup(self, key: tuple, traffic_version: int) -> Optional[PolicyEntry]:
+        """Return the entry for key if it was trained under the current traffic."""
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.traffic_version != traffic_version:
+                # Only a newer lookup retires the entry; a query on older traffic just misses
+                if entry.traffic_version < traffic_version:
+                    self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def store(self, key: tuple, entry: PolicyEntry) -> None:
+        with self._lock:
+            previous = self.entries.get(key)
+            if previous is not None and previous.traffic_version > entry.traffic_version:
+                return  # Trained on traffic that has since been replaced
+            if previous is not None and previous.traffic_version == entry.traffic_version:
+                # Keep best paths found for other start nodes towards the same destination
+                entry.best_paths = {**previous.best_paths, **entry.best_paths}
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = entry
+            self.total_bytes += entry.nbytes
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key: tuple) -> None:
+        self.total_bytes -= self.entries.pop(key).nbytes
+
+
+class CachedRoute:
+    """Stored form of a successful RouteResult: its node ids, segment columns and summary values.
+
+    The columns are kept as computed rather than re-walked from the node path,
+    because a joined multi-stop route can have gaps between its legs.
+    """
+    __slots__ = ('node_ids', 'street_path', 'total_distance', 'total_time', 'traffic_distribution', 'segments')
+
+    def __init__(self, node_ids: np.ndarray, street_path: Tuple[str, ...],
+                 total_distance: float, total_time: float, traffic_distribution: dict,
+                 segments: Union[RouteSegments, list]):
+        self.node_ids = node_ids
+        self.street_path = street_path
+        self.total_distance = total_distance
+        self.total_time = total_time
+        self.traffic_distribution = traffic_distribution
+        self.segments = segments
+
+
+class RouteResultCache:
+    """Bounded LRU cache of successful RouteResults.
+
+    Keys are (start_street, end_street, mode, traffic_version, penalty_key).
+    Because a traffic update changes every key, the whole cache is dropped as
+    soon as a lookup sees a newer traffic version instead of keeping dead entries.
+    Queries still finishing on an older version miss and do not store.
+    """
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[tuple, CachedRoute]" = OrderedDict()
+        self.traffic_version = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        # Entries pickled before segments were stored cannot be rebuilt exactly
+        for key in [key for key, entry in self.entries.items() if not hasattr(entry, 'segments')]:
+            del self.entries[key]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _check_version(self, traffic_version: int) -> bool:
+        """Move the cache to a newer traffic version; False if traffic_version is older."""
+        if self.traffic_version is not None and traffic_version < self.traffic_version:
+            return False
+        if traffic_version != self.traffic_version:
+            if self.entries:
+                print(f"Traffic version changed ({self.traffic_version} -> {traffic_version}), "
+                      f"dropping {len(self.entries)} cached routes")
+            self.entries.clear()
+            self.traffic_version = traffic_version
+        return True
+
+    def get(self, key: tuple, traffic_version: int) -> Optional[CachedRoute]:
+        with self._lock:
+            entry = self.entries.get(key) if self._check_version(traffic_version) else None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: tuple, traffic_version: int, entry: CachedRoute) -> None:
+        with self._lock:
+            if not self._check_version(traffic_version):
+                return
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.entries.clear()
+
+
+class DistanceRow:
+    """Hop distances to one end node, stored as a float32 array indexed by StateEncoder node id.
+
+    Nodes beyond the search cutoff (or added to the graph later) read as missing,
+    and the mapping-style accessors let training code treat it like the old dict.
+    """
+    __slots__ = ('distances', 'node_ids', 'cutoff')
+
+    def __init__(self, distances: np.ndarray, node_ids: Dict[str, int], cutoff: Optional[float]):
+        self.distances = distances
+        self.node_ids = node_ids
+        self.cutoff = cutoff
+
+    def _lookup(self, node: str) -> float:
+        idx = self.node_ids.get(node)
+        if idx is None or idx >= len(self.distances):
+            return np.inf
+        return float(self.distances[idx])
+
+    def __contains__(self, node: str) -> bool:
+        return self._lookup(node) != np.inf
+
+    def __getitem__(self, node: str) -> float:
+        value = self._lookup(node)
+        if value == np.inf:
+            raise KeyError(node)
+        return value
+
+    def get(self, node: str, default=None):
+        value = self._lookup(node)
+        return default if value == np.inf else value
+
+    def covers(self, cutoff: Optional[float]) -> bool:
+        """Whether this row was searched at least as far as `cutoff` requires."""
+        return self.cutoff is None or (cutoff is not None and cutoff <= self.cutoff)
+
+
+class DistanceCache:
+    """Memory-budgeted LRU of DistanceRows, keyed by end node.
+
+    Rows come from a cutoff-bounded Dijkstra on the reversed graph, so they hold
+    true distances *to* the end node and only cover the query's neighbourhood.
+    The cache is not pickled: rows are cheap to rebuild and would bloat the
+    saved planner.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.rows: "OrderedDict[str, DistanceRow]" = OrderedDict()
+        self.total_bytes = 0
+        self._lock = threading.Lock()  # Held for bookkeeping only, not while searching
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getstate__(self):
+        return {'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_bytes'])
+
+    def get(self, graph: nx.DiGraph, encoder: 'StateEncoder', end_node: str,
+            cutoff: Optional[float] = None) -> DistanceRow:
+        with self._lock:
+            row = self.rows.get(end_node)
+            if row is not None and row.covers(cutoff):
+                self.rows.move_to_end(end_node)
+                print("Using cached distance data")
+                return row
+
+        print("Building distance cache...")
+        lengths = nx.single_source_dijkstra_path_length(graph.reverse(copy=False), end_node, cutoff=cutoff)
+        node_id = encoder.node_id
+        ids = np.fromiter((node_id(node) for node in lengths), dtype=np.int64, count=len(lengths))
+        distances = np.full(len(encoder.nodes), np.inf, dtype=np.float32)
+        distances[ids] = np.fromiter(lengths.values(), dtype=np.float32, count=len(lengths))
+        row = DistanceRow(distances, encoder.node_ids, cutoff)
+
+        with self._lock:
+            if end_node in self.rows:
+                self.total_bytes -= self.rows.pop(end_node).distances.nbytes
+            self.rows[end_node] = row
+            self.total_bytes += distances.nbytes
+            while self.total_bytes > self.max_bytes and len(self.rows) > 1:
+                _, evicted = self.rows.popitem(last=False)
+                self.total_bytes -= evicted.distances.nbytes
+        return row
+
+
+class StreetOverlay:
+    """Street-adjacency graph: streets are nodes, connections weighted by the best transfer times.
+
+    Each street gets a center node and the travel time along the street from that
+    center to each of its junctions (direction ignored). Moving from street r to
+    street q at a shared junction x costs leg_r(x) + leg_q(x), center to center; the
+    connection weight is the best such transfer. A street-to-street estimate starts
+    at the transfer junction of the first street and ends at the junction where
+    the last street is reached, so streets that touch are 0 apart.
+    Distance rows are cached per source street, so repeated estimates for ordering
+    and allocation take microseconds. The rows also select a corridor of streets
+    for node-level searches.
+    """
+
+    def __init__(self, graph: nx.DiGraph, street_to_nodes: Dict[str, List[Tuple[str, str]]],
+                 key: Hashable = None, max_rows: int = 4096):
+        self.key = key  # (traffic_version, penalty_key) the weights were built for
+        self.streets = list(street_to_nodes)
+        self.index = {street: i for i, street in enumerate(self.streets)}
+        self.max_rows = max_rows
+        self._rows = OrderedDict()  # street id -> center-to-center distances, LRU
+        self._lock = threading.Lock()  # Guards the row LRU between concurrent queries
+
+        streets_at = defaultdict(set)
+        along = [defaultdict(dict) for _ in self.streets]  # Undirected along-street edge times
+        for u, v, data in graph.edges(data=True):
+            sid = self.index.get(data['street_name'])
+            if sid is None:
+                continue
+            streets_at[u].add(sid)
+            streets_at[v].add(sid)
+            cost = edge_travel_time(data)
+            if cost < along[sid][u].get(v, float('inf')):
+                along[sid][u][v] = along[sid][v][u] = cost
+
+        # half[r][q]: time from the center of r to its nearest junction with q
+        self.half: List[Dict[int, float]] = [{} for _ in self.streets]
+        # transfer[r][q]: best center-to-center time through a junction of r and q
+        self.transfer: List[Dict[int, float]] = [{} for _ in self.streets]
+        legs = [self._legs(adjacency) for adjacency in along]
+        for node, sids in streets_at.items():
+            if len(sids) < 2:
+                continue
+            for r in sids:
+                leg_r = legs[r].get(node, float('inf'))
+                for q in sids:
+                    if q == r:
+                        continue
+                    if leg_r < self.half[r].get(q, float('inf')):
+                        self.half[r][q] = leg_r
+                    cost = leg_r + legs[q].get(node, float('inf'))
+                    if cost < self.transfer[r].get(q, float('inf')):
+                        self.transfer[r][q] = cost
+
+    @staticmethod
+    def _legs(adjacency: Dict[str, Dict[str, float]]) -> Dict[str, float]:
+        """Along-street times from the street's center, the node with the smallest eccentricity
+        between the two ends of its longest stretch."""
+        if not adjacency:
+            return {}
+
+        def search(source):
+            times = {source: 0.0}
+            heap = [(0.0, source)]
+            while heap:
+                cost, node = heapq.heappop(heap)
+                if cost > times[node]:
+                    continue
+                for neighbor, weight in adjacency[node].items():
+                    if cost + weight < times.get(neighbor, float('inf')):
+                        times[neighbor] = cost + weight
+                        heapq.heappush(heap, (cost + weight, neighbor))
+            return times
+
+        from_any = search(next(iter(adjacency)))
+        end_a = max(from_any, key=from_any.get)
+        from_a = search(end_a)
+        end_b = max(from_a, key=from_a.get)
+        from_b = search(end_b)
+        center = min(from_a, key=lambda node: max(from_a[node], from_b.get(node, float('inf'))))
+        return search(center)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _row(self, sid: int) -> np.ndarray:
+        """Center-to-center times from street sid, starting on sid's junctions at no cost."""
+        with self._lock:
+            row = self._rows.get(sid)
+            if row is not None:
+                self._rows.move_to_end(sid)
+                return row
+        row = np.full(len(self.streets), np.inf)
+        heap = []
+        for q in self.half[sid]:
+            # Leave sid right at the junction: only q's half of the transfer counts
+            row[q] = self.half[q][sid]
+            heap.append((row[q], q))
+        heapq.heapify(heap)
+        row[sid] = 0.0
+        while heap:
+            cost, street = heapq.heappop(heap)
+            if cost > row[street]:
+                continue
+            for neighbor, weight in self.transfer[street].items():
+                total = cost + weight
+                if total < row[neighbor]:
+                    row[neighbor] = total
+                    heapq.heappush(heap, (total, neighbor))
+        with self._lock:
+            self._rows[sid] = row
+            if len(self._rows) > self.max_rows:
+                self._rows.popitem(last=False)
+        return row
+
+    def _estimate(self, row: np.ndarray, sid: int, tid: int) -> float:
+        if sid == tid or tid in self.half[sid]:
+            return 0.0  # Same street, or the streets meet
+        # Arrive at t's junction with a street r: r's half of the transfer into t
+        return min((row[r] + cost for r, cost in ((r, self.half[r][tid]) for r in self.half[tid])),
+                   default=float('inf'))
+
+    def estimate(self, source: str, destination: str) -> float:
+        """Coarse travel time (s) from one street to another; inf if unreachable."""
+        sid, tid = self.index[source], self.index[destination]
+        return float(self._estimate(self._row(sid), sid, tid))
+
+    def center_distance(self, source: str, destination: str) -> float:
+        """Center-to-center overlay time; breaks ties between streets that meet (estimate 0)."""
+        return float(self._row(self.index[source])[self.index[destination]])
+
+    def estimate_matrix(self, sources: List[str], destinations: List[str]) -> np.ndarray:
+        matrix = np.empty((len(sources), len(destinations)))
+        for i, source in enumerate(sources):
+            sid = self.index[source]
+            row = self._row(sid)
+            for j, destination in enumerate(destinations):
+                matrix[i, j] = self._estimate(row, sid, self.index[destination])
+        return matrix
+
+    def corridor(self, source: str, destination: str, slack: float = 0.25,
+                 margin: float = 20.0) -> Optional[Set[str]]:
+        """Streets whose center lies on an overlay route within (1 + slack) * best + margin
+        seconds, or None if the destination is unreachable."""
+        sid, tid = self.index[source], self.index[destination]
+        forward, backward = self._row(sid), self._row(tid)  # Transfers are symmetric
+        best = self._estimate(forward, sid, tid)
+        if not np.isfinite(best):
+            return None
+        through = forward + backward
+        streets = {self.streets[i] for i in np.flatnonzero(through <= best * (1 + slack) + margin).tolist()}
+        streets.update((source, destination))
+        return streets
+
+
+class QueryContext:
+    """Per-request state of one routing query on a shared ImprovedRoutePlanner.
+
+    Holds what a query used to write onto the planner, its agent or its network: the
+    graph being routed on (None for the network graph, or a penalty overlay of it),
+    the starting exploration rate (None for the training defaults), the street
+    corridor find_route restricts episodes to, and the agent whose Q-table training
+    reads and writes. Contexts made by ImprovedRoutePlanner.query_context give the
+    agent a ScratchQTable, so the shared model is only read, and pin the traffic
+    version (with its graphs) published when the context was entered, so a query
+    finishes on one version even if a refresh publishes the next meanwhile. The
+    implicit context of a thread that never entered one trains the shared agent in
+    place and is pinned only while a find_route-style query runs, to the version
+    published when that query started.
+    """
+
+    def __init__(self, agent: ImprovedRLAgent, epsilon: Optional[float] = None,
+                 scratch: Optional[ScratchQTable] = None):
+        self.agent = agent
+        self.epsilon = epsilon
+        self.scratch = scratch
+        self.graph: Optional[nx.DiGraph] = None
+        self.corridor: Optional[Set[str]] = None
+        self.traffic_version: Optional[int] = None  # Pinned version, None to follow the network
+        self.full_graph: Optional[nx.DiGraph] = None
+
+
+# Planner and coordination primitives of the attempt pool a forked worker belongs to.
+# Only ever filled in inside the worker, from the pool's initargs (inherited without pickling).
+_ATTEMPT_CONTEXT = {}
+
+def _init_route_attempt_worker(planner: 'ImprovedRoutePlanner', context: QueryContext, cancel_event,
+                               best_bound, deadline: Optional[float]) -> None:
+    _ATTEMPT_CONTEXT.update(planner=planner, context=context, cancel_event=cancel_event,
+                            best_bound=best_bound, deadline=deadline)
+
+def _run_route_attempt(start_node: str, end_node: str, min_episodes: int,
+                       max_episodes: int, success_threshold: float):
+    """Worker entry point: train one node pair and hand back the route and learned policy."""
+    planner = _ATTEMPT_CONTEXT['planner']
+    # Train under the forking query's context (graph overlay, corridor, scratch Q-values)
+    planner._local.context = _ATTEMPT_CONTEXT['context']
+    route = planner._improved_train_route(
+        start_node, end_node, min_episodes, max_episodes, success_threshold,
+        cancel_event=_ATTEMPT_CONTEXT['cancel_event'],
+        best_bound=_ATTEMPT_CONTEXT['best_bound'],
+        deadline=_ATTEMPT_CONTEXT['deadline']
+    )
+    policy = planner.policy_cache.entries.get((end_node, planner._penalty_key()))
+    return route, policy
+
+
+def _pins_traffic(method):
+    """Run a planner query on one traffic snapshot (see ImprovedRoutePlanner._pinned_traffic)."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._pinned_traffic():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class ImprovedRoutePlanner:
     def __init__(self, network: TransportNetwork, agent: ImprovedRLAgent):
         self.network = network
@@ -288,7 +2193,434 @@ class ImprovedRoutePlanner:
         self.shortest_path_cache = {}  # Cache for shortest paths
         self.state_cache = {}  # Cache for states
         self.connectivity_cache = {}  # Cache for connectivity checks
-        self.distance_cache = {}  # Cache for distance calculations
+        self.distance_cache = DistanceCache()  # Bounded distance-to-end rows for reward shaping
+        self.state_encoder = StateEncoder()  # Packed integer states for the Q-table
+        self.policy_cache = PolicyCache()  # Converged policies per destination node
+        self.route_cache = RouteResultCache()  # Final routes per street pair and traffic version
+        # Worker processes for node-pair attempts (used only while the process is single-threaded)
+        self.parallel_attempts = min(4, os.cpu_count() or 1)
+        self.street_overlay_enabled = True  # Prune find_route to a street corridor
+        # (traffic_version, penalty_key) -> StreetOverlay for the versions queries are on, most recent last
+        self._street_overlays: "OrderedDict[tuple, StreetOverlay]" = OrderedDict()
+        # Shared Q-table access from query contexts; per-thread QueryContexts (never pickled)
+        self.model_lock = threading.RLock()
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['model_lock'], state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.model_lock = threading.RLock()
+        self._local = threading.local()
+        # The corridor now lives on the query context
+        self.__dict__.pop('_active_corridor', None)
+        # Fill in attributes added after older planners were pickled
+        self.__dict__.setdefault('state_encoder', StateEncoder())
+        self.__dict__.setdefault('policy_cache', PolicyCache())
+        self.__dict__.setdefault('route_cache', RouteResultCache())
+        self.__dict__.setdefault('parallel_attempts', min(4, os.cpu_count() or 1))
+        self.__dict__.setdefault('street_overlay_enabled', True)
+        self.__dict__.pop('_street_overlay', None)
+        self.__dict__.setdefault('_street_overlays', OrderedDict())
+        if not isinstance(self.distance_cache, DistanceCache):
+            # Older planners pickled an unbounded dict of full Dijkstra results
+            self.distance_cache = DistanceCache()
+        if getattr(self.agent, 'legacy_q_table', None) is not None:
+            self._migrate_legacy_q_table()
+
+    def _migrate_legacy_q_table(self) -> None:
+        """Re-key a string-keyed Q-table loaded from an older pickle onto packed integer states."""
+        legacy = self.agent.legacy_q_table
+        kept = 0
+        for key, row in legacy.items():
+            state = self.state_encoder.encode_legacy(self.network.graph, key)
+            if state is None:
+                continue
+            node = self.state_encoder.nodes[state >> StateEncoder.TRAFFIC_BITS]
+            for action, value in row.items():
+                if self.network.graph.has_edge(node, action):
+                    self.agent.q_table.set(state, self.state_encoder.node_id(action), float(value))
+            kept += 1
+        del self.agent.legacy_q_table
+        if kept < len(legacy):
+            print(f"Migrated {kept} of {len(legacy)} legacy Q-table states; "
+                  f"{len(legacy) - kept} no longer match the network", file=sys.stderr)
+
+    def use_network(self, network: TransportNetwork) -> None:
+        """Route on a rebuilt network from now on.
+
+        Nodes keep their names, so the state encoder and Q-table stay valid; every
+        cache derived from the old graph is dropped.
+        """
+        with self.model_lock:
+            self.network = network
+            self.shortest_path_cache = {}
+            self.state_cache = {}
+            self.connectivity_cache = {}
+            self.distance_cache = DistanceCache(self.distance_cache.max_bytes)
+            self.policy_cache = PolicyCache(self.policy_cache.max_bytes)
+            self.route_cache = RouteResultCache(self.route_cache.max_entries)
+            self._street_overlays = OrderedDict()
+
+    @property
+    def context(self) -> QueryContext:
+        """The calling thread's query context (an implicit one on the shared agent if none was entered)."""
+        context = getattr(self._local, 'context', None)
+        if context is None:
+            context = QueryContext(self.agent)
+            self._local.context = context
+        return context
+
+    @property
+    def graph(self) -> nx.DiGraph:
+        """Graph the current query routes on: the network graph or the query's penalty overlay."""
+        graph = self.context.graph
+        return self.network.graph if graph is None else graph
+
+    @property
+    def full_graph(self) -> nx.DiGraph:
+        """Uncontracted graph of the traffic version the current query routes on."""
+        full_graph = self.context.full_graph
+        return self.network.full_graph if full_graph is None else full_graph
+
+    @property
+    def traffic_version(self) -> int:
+        """Traffic version the current query routes on (keys the version-scoped caches)."""
+        version = self.context.traffic_version
+        return self.network.traffic_version if version is None else version
+
+    @contextlib.contextmanager
+    def query_context(self, epsilon: Optional[float] = None, learn: bool = False):
+        """Run the queries of this block read-only against the shared model.
+
+        Exploration rate, penalty overlays, the street corridor and all Q-value
+        updates stay on a fresh QueryContext for the calling thread, so several
+        threads can route on one loaded planner at once. The block routes on the
+        traffic version published when it was entered. Shared caches lock
+        themselves and still fill up, so later queries reuse this one's routes and
+        policies. With learn=True the query's Q-values are written into the shared
+        table when the block exits. Node-pair attempts inside the block run
+        sequentially rather than in forked workers.
+        """
+        previous = getattr(self._local, 'context', None)
+        scratch = ScratchQTable(self.agent.q_table, self.model_lock)
+        agent = copy.copy(self.agent)
+        agent.q_table = scratch
+        context = QueryContext(agent, epsilon=epsilon, scratch=scratch)
+        context.traffic_version, context.graph, context.full_graph = self.network.snapshot()
+        self._local.context = context
+        try:
+            yield context
+        finally:
+            self._local.context = previous
+            if learn:
+                scratch.commit()
+
+    @contextlib.contextmanager
+    def _pinned_traffic(self):
+        """Pin the calling thread's context to the current traffic snapshot for the block.
+
+        A no-op when the context is already pinned (by query_context or an outer
+        query); otherwise the implicit context is pinned until the block exits, so a
+        version published meanwhile never mixes into the query.
+        """
+        context = self.context
+        if context.traffic_version is not None:
+            yield context
+            return
+        context.traffic_version, context.graph, context.full_graph = self.network.snapshot()
+        try:
+            yield context
+        finally:
+            context.traffic_version = context.graph = context.full_graph = None
+
+    def _penalty_key(self):
+        """Identifies the penalty overlay currently applied to the graph (None for the base graph)."""
+        return self.graph.graph.get('penalty_key')
+
+    def _route_cache_key(self, start_street: str, end_street, mode: str) -> tuple:
+        return (start_street, end_street, mode, self.traffic_version, self._penalty_key())
+
+    def _get_cached_route(self, key: tuple) -> Optional[RouteResult]:
+        """Rebuild a fresh RouteResult from the route cache, or None on a miss."""
+        entry = self.route_cache.get(key, self.traffic_version)
+        if entry is None:
+            return None
+        nodes = self.state_encoder.nodes
+        return RouteResult(
+            path=[nodes[i] for i in entry.node_ids.tolist()],
+            street_path=list(entry.street_path),
+            total_distance=entry.total_distance,
+            total_time=entry.total_time,
+            success=True,
+            traffic_distribution=dict(entry.traffic_distribution),
+            segments=entry.segments
+        )
+
+    def _cache_route(self, key: tuple, route: RouteResult) -> None:
+        if not route.converged:
+            return  # A deadline-limited answer should not outlive its request
+        node_id = self.state_encoder.node_id
+        self.route_cache.put(key, self.traffic_version, CachedRoute(
+            node_ids=np.array([node_id(node) for node in route.path], dtype=np.int32),
+            street_path=tuple(route.street_path),
+            total_distance=route.total_distance,
+            total_time=route.total_time,
+            traffic_distribution=dict(route.traffic_distribution),
+            segments=route.segments
+        ))
+
+    def _path_time(self, path: List[str]) -> float:
+        """Travel time of a node path under current traffic."""
+        graph = self.graph
+        return sum(edge_travel_time(graph[u][v]) for u, v in zip(path, path[1:]))
+
+    def reachable_streets(self, source_street: str, time_limit: float,
+                          target_streets: Optional[List[str]] = None) -> Dict[str, float]:
+        """Earliest arrival time (seconds) at every street reachable within time_limit.
+
+        A single travel-time search from all nodes of source_street, bounded by
+        time_limit, replaces one find_route per candidate street. A street counts as
+        reached at the earliest time any of its nodes is settled. If target_streets
+        is given only those streets are reported.
+        """
+        if source_street not in self.network.street_to_nodes:
+            raise ValueError(f"Street '{source_street}' not found in network")
+
+        graph = self.graph
+        times, _, _ = travel_time_search(graph, self._get_street_nodes(source_street), cutoff=time_limit)
+
+        arrivals = {}
+        node_to_street = self.network.node_to_street
+        for node, arrival in times.items():
+            streets = [node_to_street.get(node)]
+            # A node can sit on several streets; its outgoing edges name them all
+            streets.extend(data['street_name'] for data in graph.succ[node].values())
+            for street in streets:
+                if street is not None and arrival < arrivals.get(street, float('inf')):
+                    arrivals[street] = arrival
+
+        if target_streets is not None:
+            arrivals = {street: arrivals[street] for street in target_streets if street in arrivals}
+        return arrivals
+
+    @_pins_traffic
+    def find_alternative_routes(self, start_street: str, end_street: str, k: int = 3,
+                                max_overlap: float = 0.6, max_stretch: float = 1.4,
+                                time_budget: float = 5.0) -> List[RouteResult]:
+        """Find up to k distinct routes between two streets with the via-node method.
+
+        One forward travel-time tree from all start-street nodes and one backward tree
+        from all end-street nodes are built once. Every node reached by both is a via
+        candidate whose route is forward path + backward path. Candidates are taken
+        cheapest first and accepted when their time is within max_stretch of the
+        fastest route and at most max_overlap of their length is shared with any
+        route already accepted. The fastest route is always returned first.
+        """
+        start_time = time.time()
+        if start_street not in self.network.street_to_nodes:
+            raise ValueError(f"Start street '{start_street}' not found in network")
+        if end_street not in self.network.street_to_nodes:
+            raise ValueError(f"End street '{end_street}' not found in network")
+
+        graph = self.graph
+        start_nodes = self._get_street_nodes(start_street)
+        end_nodes = self._get_street_nodes(end_street)
+        # Where the streets touch, a shared node is already "on" the end street; like
+        # find_route, routes leave from the other start-street nodes instead
+        if start_nodes - end_nodes:
+            start_nodes = start_nodes - end_nodes
+        else:
+            end_nodes = end_nodes - start_nodes
+        forward_times, forward_pred, _ = travel_time_search(graph, start_nodes)
+        backward_times, backward_pred, _ = travel_time_search(graph, end_nodes, reverse=True)
+
+        # Total time through each node reached by both trees
+        via_costs = [(forward_times[node] + backward_times[node], node)
+                     for node in forward_times if node in backward_times]
+        if not via_costs:
+            raise ValueError(f"No valid path exists between {start_street} and {end_street}")
+        via_costs.sort()
+        # Stretch is measured against at least one edge, so a near-zero fastest route
+        # does not rule out every alternative
+        min_edge_time = min((edge_travel_time(data) for _, _, data in graph.edges(data=True)), default=0.0)
+        stretch_base = max(via_costs[0][0], min_edge_time, 1e-9)
+
+        accepted = []  # (path, edge set, length)
+        for cost, via in via_costs:
+            if len(accepted) >= k or cost > max_stretch * stretch_base:
+                break
+            if time.time() - start_time > time_budget:
+                print("Alternative route search time budget exhausted")
+                break
+            forward = tree_path(forward_pred, via)
+            backward = tree_path(backward_pred, via)[::-1]  # via -> end street
+            if not set(forward).isdisjoint(backward[1:]):
+                continue  # Not a simple path
+            path = forward + backward[1:]
+            if len(path) < 2:
+                continue
+            edges = set(zip(path, path[1:]))
+            length = sum(graph[u][v]['length'] for u, v in edges)
+            too_similar = False
+            for _, other_edges, _ in accepted:
+                shared = sum(graph[u][v]['length'] for u, v in edges & other_edges)
+                if length <= 0 or shared / length > max_overlap:
+                    too_similar = True
+                    break
+            if not too_similar:
+                accepted.append((path, edges, length))
+
+        routes = []
+        for path, _, _ in accepted:
+            route = self._create_route_result(path)
+            if route.street_path and route.street_path[-1] != end_street:
+                route.street_path.append(end_street)
+            routes.append(route)
+
+        print(f"Found {len(routes)} alternative routes in {time.time() - start_time:.2f} seconds")
+        return routes
+
+    def _parallel_attempts(self, top_pairs, min_episodes: int, max_episodes: int,
+                           success_threshold: float, workers: int, deadline: Optional[float] = None):
+        """Train the candidate node pairs concurrently in forked worker processes.
+
+        Workers share a best-so-far travel time and a cancellation event. Once the
+        sequential stop criterion is met (a route within 1.3x of the shortest length,
+        or two successes after three finished attempts) pending attempts are
+        cancelled and running ones return what they have. Learned Q-values come back
+        with each worker's policy entry and are merged into this planner.
+        Returns (best_route, successful_attempts).
+        """
+        # Each worker would hand out ids to the nodes it meets in its own order, so the
+        # Q-rows it sends back would name different nodes here; intern them all first
+        self.state_encoder.intern(self.full_graph.nodes, self.network.street_to_nodes)
+        ctx = multiprocessing.get_context('fork')
+        cancel_event = ctx.Event()
+        best_bound = ctx.Value('d', float('inf'))
+        penalty_key = self._penalty_key()
+        best_route = None
+        successful_attempts = 0
+        finished = 0
+        print(f"Running {len(top_pairs)} attempts on {workers} worker processes")
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, mp_context=ctx, initializer=_init_route_attempt_worker,
+                initargs=(self, self.context, cancel_event, best_bound, deadline)) as pool:
+            futures = {}
+            for i, (start_node, end_node, priority) in enumerate(top_pairs):
+                # Lower-priority pairs get half the budget, as in the sequential loop
+                scale = 2 if i >= 2 else 1
+                future = pool.submit(_run_route_attempt, start_node, end_node,
+                                     min_episodes // scale, max_episodes // scale,
+                                     success_threshold)
+                futures[future] = (start_node, end_node)
+
+            for future in concurrent.futures.as_completed(futures):
+                start_node, end_node = futures[future]
+                if future.cancelled():
+                    continue
+                finished += 1
+                try:
+                    route, policy = future.result()
+                except Exception as e:
+                    print(f"Attempt {start_node} -> {end_node} failed: {str(e)}")
+                    continue
+
+                if policy is not None:
+                    self.policy_cache.store((end_node, penalty_key), policy)
+                    self.context.agent.q_table.import_rows(*policy.q_slice)
+
+                if not (route and route.success):
+                    continue
+                # Re-intern the worker's route into this planner's id tables
+                converged = route.converged
+                route = self._create_route_result(route.path)
+                route.converged = converged
+                successful_attempts += 1
+                print(f"Found route with time {route.total_time:.1f}s, distance {route.total_distance:.0f}m")
+
+                stop = successful_attempts >= 2 and finished >= 3
+                if best_route is None or route.total_time < best_route.total_time:
+                    best_route = route
+                    with best_bound.get_lock():
+                        best_bound.value = min(best_bound.value, route.total_time)
+                    if route.total_distance < 1.3 * nx.shortest_path_length(
+                            self.graph, start_node, end_node, weight='length'):
+                        print("Found route very close to shortest path, cancelling remaining attempts")
+                        stop = True
+                if stop and not cancel_event.is_set():
+                    cancel_event.set()
+                    for pending in futures:
+                        pending.cancel()
+
+        return best_route, successful_attempts
+
+    def _greedy_rollout(self, start_node: str, end_node: str, max_steps: int) -> Optional[List[str]]:
+        """Follow the highest Q-value action from start_node; return the path if it reaches end_node."""
+        graph = self.graph
+        node_id = self.state_encoder.node_id
+        current = start_node
+        path = [current]
+        visited = {current}
+        for _ in range(max_steps):
+            if current == end_node:
+                return path
+            candidates = [n for n in graph.successors(current) if n not in visited]
+            if not candidates:
+                return None
+            q_values = self.context.agent.q_table.get_many(self._get_state(current),
+                                                   [node_id(n) for n in candidates])
+            current = candidates[int(np.argmax(q_values))]
+            path.append(current)
+            visited.add(current)
+        return path if current == end_node else None
+
+    @property
+    def street_overlay(self) -> StreetOverlay:
+        """Street-level overlay for the current traffic and penalty overlay, built on demand."""
+        key = (self.traffic_version, self._penalty_key())
+        overlay = self._street_overlays.get(key)
+        if overlay is None:
+            overlay = StreetOverlay(self.graph, self.network.street_to_nodes, key)
+            self._store_overlay(overlay)
+        return overlay
+
+    def _store_overlay(self, overlay: StreetOverlay) -> None:
+        # A few versions are kept so queries pinned to the previous traffic don't rebuild it
+        with self.model_lock:
+            self._street_overlays[overlay.key] = overlay
+            self._street_overlays.move_to_end(overlay.key)
+            while len(self._street_overlays) > 4:
+                self._street_overlays.popitem(last=False)
+
+    def warm_traffic(self, prepared: PreparedTraffic) -> None:
+        """Build the structures derived from prepared traffic before it is published."""
+        self._store_overlay(StreetOverlay(prepared.graph, self.network.street_to_nodes, (prepared.version, None)))
+
+    def estimate_travel_time(self, source_street: str, destination_street: str) -> float:
+        """Coarse street-to-street travel time (s) from the overlay, without a node search."""
+        for street in (source_street, destination_street):
+            if street not in self.network.street_to_nodes:
+                raise ValueError(f"Street '{street}' not found in network")
+        return self.street_overlay.estimate(source_street, destination_street)
+
+    def _corridor_nodes(self, start_street: str, end_street: str) -> Optional[Set[str]]:
+        """Nodes of the streets in the overlay corridor, or None when pruning would not help."""
+        if not self.street_overlay_enabled:
+            return None
+        streets = self.street_overlay.corridor(start_street, end_street)
+        if streets is None:
+            return None
+        nodes = set()
+        for street in streets:
+            nodes.update(self._get_street_nodes(street))
+        if len(nodes) > 0.8 * len(self.graph):
+            return None
+        print(f"Street corridor: {len(streets)} streets, {len(nodes)} of {len(self.graph)} nodes")
+        return nodes
 
     def _get_street_nodes(self, street: str) -> Set[str]:
         """Get all nodes associated with a street."""
@@ -298,30 +2630,13 @@ class ImprovedRoutePlanner:
             nodes.add(to_node)
         return nodes
 
-    def _get_state(self, node: str) -> str:
-        # Replace string concatenation with more efficient representation
-        edges = list(self.network.graph.edges(node, data=True))
-        connectivity = self.network.graph.nodes[node].get('connectivity', 0)
-
-        if not edges:
-            return f"{node}|c{connectivity}|t0.0|b{1 if node in self.network.bottleneck_nodes else 0}|"
-
-        # Use array operations instead of list comprehensions
-        traffic_sum = 0
-        traffic_conditions = []
-        for _, dest, data in edges:
-            traffic_sum += data['traffic_state'].value
-            traffic_conditions.append(f"{dest}:{data['traffic_state'].value}")
-
-        avg_traffic = traffic_sum / len(edges)
-        is_bottleneck = 1 if node in self.network.bottleneck_nodes else 0
-
-        # Join once at the end
-        return f"{node}|c{connectivity}|t{avg_traffic:.1f}|b{is_bottleneck}|{'_'.join(sorted(traffic_conditions))}"
+    def _get_state(self, node: str) -> int:
+        """Packed integer state for a node (see StateEncoder)."""
+        return self.state_encoder.encode(self.graph, node)
 
     def _calculate_reward(self, current: str, next_node: str) -> float:
         """Calculate reward for moving from current to next_node."""
-        edge = self.network.graph[current][next_node]
+        edge = self.graph[current][next_node]
         traffic_multiplier = 1 + (edge['traffic_state'].value * 0.25)
         time_cost = edge['length'] / edge['speed_limit'] * traffic_multiplier
         return -time_cost  # Negative because we want to minimize time
@@ -340,19 +2655,38 @@ class ImprovedRoutePlanner:
                 segments=[]
             )
 
-        segments = []
-        total_distance = 0
-        total_time = 0
-        # Initialize counters for all possible traffic states (assuming TrafficState is an Enum)
-        traffic_counts = {state: 0 for state in TrafficState}
+        graph = self.graph
+        full_graph = self.full_graph
+        encoder = self.state_encoder
+
+        # Unpack chain edges of the contracted graph into their original nodes
+        if full_graph is not graph:
+            expanded = [path[0]]
+            for current, next_node in zip(path, path[1:]):
+                edge = graph.succ[current].get(next_node) if current in graph else None
+                if edge is not None:
+                    expanded.extend(edge.get('via', ()))
+                expanded.append(next_node)
+            path = expanded
+            graph = full_graph
+
+        num_edges = len(path) - 1
+        node_ids = np.empty(num_edges + 1, dtype=np.int32)
+        edge_ids = np.empty(num_edges, dtype=np.int32)
+        street_ids = np.empty(num_edges, dtype=np.int32)
+        lengths = np.empty(num_edges)
+        times = np.empty(num_edges)
+        traffic = np.empty(num_edges, dtype=np.int8)
         street_path = []
 
-        # Validate path connectivity
-        for i in range(len(path) - 1):
+        # Validate path connectivity while filling the edge columns
+        node_ids[0] = encoder.node_id(path[0])
+        for i in range(num_edges):
             current = path[i]
             next_node = path[i + 1]
 
-            if not self.network.graph.has_edge(current, next_node):
+            edge = graph.succ[current].get(next_node) if current in graph else None
+            if edge is None:
                 return RouteResult(
                     path=path,
                     street_path=[],
@@ -363,67 +2697,36 @@ class ImprovedRoutePlanner:
                     segments=[]
                 )
 
-            edge = self.network.graph[current][next_node]
-            time = (edge['length'] / edge['speed_limit'] *
-                  (1 + edge['traffic_state'].value * 0.25))
-
-            segment = RouteSegment(
-                from_node=current,
-                to_node=next_node,
-                street_name=edge['street_name'],
-                length=edge['length'],
-                traffic_state=edge['traffic_state'],
-                estimated_time=time
-            )
-
-            segments.append(segment)
-            total_distance += edge['length']
-            total_time += time
-            # Count by segment length instead of just incrementing
-            traffic_counts[edge['traffic_state']] += edge['length']
+            node_ids[i + 1] = encoder.node_id(next_node)
+            edge_ids[i] = encoder.edge_id(node_ids[i], node_ids[i + 1])
+            street_ids[i] = encoder.street_id(edge['street_name'])
+            lengths[i] = edge['length']
+            traffic[i] = edge['traffic_state'].value
+            times[i] = edge['length'] / edge['speed_limit'] * (1 + edge['traffic_state'].value * 0.25)
 
             if not street_path or street_path[-1] != edge['street_name']:
                 street_path.append(edge['street_name'])
-        
-        # Find and add the end destination street name
-        end_node = path[-1]
-        
-        # Improved method to find the end street
-        # First check if we already have a segment with the end node as destination
-        if segments and segments[-1].to_node == end_node:
-            end_street = segments[-1].street_name
-        else:
-            # Fallback method: search for the street by end node
-            end_street = None
-            
-            # Find streets containing the end node
-            for street, nodes in self.network.street_to_nodes.items():
-                for node_info in nodes:
-                    # Check if this is the correct format for node_info
-                    if isinstance(node_info, tuple) and node_info[0] == end_node:
-                        end_street = street
-                        break
-                    elif node_info == end_node:  # Alternative format check
-                        end_street = street
-                        break
-                if end_street:
-                    break
-        
-        # Explicitly add the end street to the path if it's not already there
-        if end_street and (not street_path or street_path[-1] != end_street):
-            street_path.append(end_street)
+
+        # The last edge ends at the destination node, so its street is already
+        # the final entry of street_path
+
+        segments = RouteSegments(encoder.nodes, encoder.streets, node_ids, edge_ids,
+                                 street_ids, lengths, times, traffic)
+        total_distance = float(lengths.sum())
+        total_time = float(times.sum())
 
         if total_distance > 0:
             # Calculate distribution based on distance, not segment count
+            traffic_counts = np.bincount(traffic, weights=lengths, minlength=len(TrafficState))
             traffic_distribution = {
-                state: (distance / total_distance * 100)
-                for state, distance in traffic_counts.items()
+                state: float(traffic_counts[state.value] / total_distance * 100)
+                for state in TrafficState
             }
         else:
             traffic_distribution = {state: 0 for state in TrafficState}
 
         return RouteResult(
-            path=path,
+            path=None,  # Decoded from segments.node_ids on demand
             street_path=street_path,
             total_distance=total_distance,
             total_time=total_time,
@@ -431,11 +2734,45 @@ class ImprovedRoutePlanner:
             traffic_distribution=traffic_distribution,
             segments=segments
         )
+    def route_from_coordinates(self, start: Tuple[float, float], destinations: List[Tuple[float, float]],
+                               net_coordinates: bool = False, max_snap_distance: Optional[float] = 200.0,
+                               deadline: Optional[float] = None) -> Tuple[RouteResult, List[EdgeSnap]]:
+        """Route between positions instead of street names.
+
+        Points are (latitude, longitude), or network (x, y) when net_coordinates is set.
+        Each point is snapped to its nearest edge and routed by that edge's street.
+        Returns the route and the snaps (start first, then destinations in input order).
+        """
+        snaps = []
+        for point in [start] + list(destinations):
+            if net_coordinates:
+                snap = self.network.snap_xy(point[0], point[1], max_snap_distance)
+            else:
+                snap = self.network.snap(point[0], point[1], max_snap_distance)
+            if snap is None:
+                raise ValueError(f"No street within {max_snap_distance}m of {point}")
+            snaps.append(snap)
+
+        start_street = snaps[0].street_name
+        destination_streets = [snap.street_name for snap in snaps[1:]]
+        if len(destination_streets) == 1:
+            route = self.find_route(start_street, destination_streets[0], deadline=deadline)
+        else:
+            route = self.find_multi_stop_route(start_street, destination_streets, deadline=deadline)
+        return route, snaps
+
+    @_pins_traffic
     def find_route(self, start_street: str, end_street: str,
            min_episodes: int = 1000,
            max_episodes: int = 3000,
-           success_threshold: float = 0.7) -> RouteResult:
-        """Find optimal route between two streets using enhanced RL approach with performance optimizations."""
+           success_threshold: float = 0.7,
+           deadline: Optional[float] = None) -> RouteResult:
+        """Find optimal route between two streets using enhanced RL approach with performance optimizations.
+
+        deadline is an absolute time.time() value: once it passes, the best route found
+        so far is returned with converged=False (a travel-time shortest path if
+        training had not produced one yet).
+        """
         start_time = time.time()
         print(f"Finding route from {start_street} to {end_street}")
 
@@ -451,9 +2788,18 @@ class ImprovedRoutePlanner:
             start_node, end_node = self.network.street_to_nodes[start_street][0]
             return self._create_route_result([start_node, end_node])
 
+        # Identical street pairs under the same traffic and penalty overlay reuse the last result
+        cache_key = self._route_cache_key(start_street, end_street, 'route')
+        cached_route = self._get_cached_route(cache_key)
+        if cached_route is not None:
+            print(f"Using cached route: {cached_route.total_distance:.0f}m, {cached_route.total_time:.1f}s")
+            return cached_route
+
         # Get all nodes for each street
         start_nodes = self._get_street_nodes(start_street)
         end_nodes = self._get_street_nodes(end_street)
+        all_start_nodes, all_end_nodes = start_nodes, end_nodes
+        timed_out = False
 
         print(f"Finding route from {start_street} ({len(start_nodes)} nodes) to {end_street} ({len(end_nodes)} nodes)")
 
@@ -474,7 +2820,7 @@ class ImprovedRoutePlanner:
             print(f"Selected {len(start_nodes)} start nodes and {len(end_nodes)} end nodes for exploration")
 
         # Dynamically adjust episode counts based on network complexity
-        network_size_factor = min(1.0, 50000 / len(self.network.graph))  # Scale down for larger networks
+        network_size_factor = min(1.0, 50000 / len(self.graph))  # Scale down for larger networks
         distance_factor = 1.0  # Will be updated if we can estimate distance
 
         # Try to estimate distance between streets to adjust episode count
@@ -483,7 +2829,7 @@ class ImprovedRoutePlanner:
                 # Find a sample path to gauge distance
                 sample_start = next(iter(start_nodes))
                 sample_end = next(iter(end_nodes))
-                sample_path = nx.shortest_path(self.network.graph, sample_start, sample_end)
+                sample_path = nx.shortest_path(self.graph, sample_start, sample_end)
                 path_length = len(sample_path)
 
                 # Adjust factors based on path complexity
@@ -502,6 +2848,11 @@ class ImprovedRoutePlanner:
 
         print(f"Adjusted episode range: {adjusted_min_episodes} to {adjusted_max_episodes}")
 
+        # Episodes only explore the streets the overlay puts between the two streets
+        # (forked attempt workers inherit the corridor with the query context)
+        context = self.context
+        context.corridor = self._corridor_nodes(start_street, end_street)
+
         # Try multiple node pairs with intelligent selection
         best_route = None
         best_reward = float('-inf')
@@ -517,12 +2868,12 @@ class ImprovedRoutePlanner:
                     continue
 
                 # Calculate priority based on connectivity and distance (if available)
-                start_connectivity = self.network.graph.nodes[start_node].get('connectivity', 0)
-                end_connectivity = self.network.graph.nodes[end_node].get('connectivity', 0)
+                start_connectivity = self.graph.nodes[start_node].get('connectivity', 0)
+                end_connectivity = self.graph.nodes[end_node].get('connectivity', 0)
 
                 # Try to get distance between nodes
                 try:
-                    distance = nx.shortest_path_length(self.network.graph, start_node, end_node)
+                    distance = nx.shortest_path_length(self.graph, start_node, end_node)
                     # Prioritize shorter distances and higher connectivity
                     priority = (start_connectivity + end_connectivity) / (distance + 1)
                 except:
@@ -531,8 +2882,14 @@ class ImprovedRoutePlanner:
 
                 node_pairs.append((start_node, end_node, priority))
 
-        # Sort by priority (highest first)
-        node_pairs.sort(key=lambda x: x[2], reverse=True)
+        # Sort by priority (highest first), trying destinations with a converged policy first
+        penalty_key = self._penalty_key()
+        converged_ends = set()
+        for end_node in end_nodes:
+            policy = self.policy_cache.lookup((end_node, penalty_key), self.traffic_version)
+            if policy is not None and policy.converged:
+                converged_ends.add(end_node)
+        node_pairs.sort(key=lambda x: (x[1] in converged_ends, x[2]), reverse=True)
 
         # Take top N pairs
         top_pairs = node_pairs[:max_attempts]
@@ -542,8 +2899,27 @@ class ImprovedRoutePlanner:
         successful_attempts = 0
         total_episodes = 0
 
+        # Run attempts concurrently when we can fork workers; a converged cached
+        # policy answers the first attempt immediately, so stay sequential then.
+        # A fork copies locks other threads hold (model, encoder, publish) into the
+        # workers, so only fork from a single-threaded process outside query contexts
+        workers = min(self.parallel_attempts, len(top_pairs))
+        use_parallel = (workers > 1 and not converged_ends and self.context.scratch is None and
+                        threading.active_count() == 1 and
+                        'fork' in multiprocessing.get_all_start_methods())
+        if use_parallel:
+            best_route, successful_attempts = self._parallel_attempts(
+                top_pairs, adjusted_min_episodes, adjusted_max_episodes, success_threshold, workers,
+                deadline=deadline)
+            timed_out = deadline is not None and time.time() >= deadline
+            top_pairs = []
+
         # Try each pair
         for start_node, end_node, priority in top_pairs:
+            if deadline is not None and time.time() >= deadline:
+                print("Deadline reached, stopping further attempts")
+                timed_out = True
+                break
             attempts += 1
             print(f"\nAttempt {attempts}/{len(top_pairs)}: Route from node {start_node} to {end_node} (priority: {priority:.2f})")
 
@@ -571,8 +2947,11 @@ class ImprovedRoutePlanner:
                 start_node, end_node,
                 current_min_episodes,
                 current_max_episodes,
-                success_threshold
+                success_threshold,
+                deadline=deadline
             )
+            if route and not route.converged:
+                timed_out = True
 
             if route and route.success:
                 successful_attempts += 1
@@ -586,9 +2965,24 @@ class ImprovedRoutePlanner:
 
                     # If this route is particularly good, consider stopping early
                     if route.total_distance < 1.3 * nx.shortest_path_length(
-                        self.network.graph, start_node, end_node, weight='length'):
+                        self.graph, start_node, end_node, weight='length'):
                         print("Found route very close to shortest path, stopping")
                         break
+        context.corridor = None
+
+        if not best_route and timed_out:
+            # Out of time before training reached the destination: answer with the
+            # travel-time shortest path rather than nothing
+            # Nodes shared by both streets would give a one-node path, as in the pair loop
+            targets = set(all_end_nodes) - set(all_start_nodes)
+            times, predecessors, _ = travel_time_search(self.graph, all_start_nodes,
+                                                        targets=targets)
+            reached = [node for node in targets if node in times]
+            if reached:
+                print("Deadline reached without a trained route, using travel-time shortest path")
+                best_route = self._create_route_result(tree_path(predecessors, min(reached, key=times.get)))
+        if best_route and timed_out:
+            best_route.converged = False
 
         # Check if we found a valid route
         if not best_route:
@@ -606,10 +3000,14 @@ class ImprovedRoutePlanner:
         print(f"Route finding completed in {elapsed:.2f} seconds")
         print(f"Final route: {len(best_route.path)} nodes, {best_route.total_distance:.0f}m, {best_route.total_time:.1f}s")
 
+        self._cache_route(cache_key, best_route)
         return best_route
+
+    @_pins_traffic
     def find_multi_stop_route(self, start_street: str, destination_streets: List[str],
                   min_episodes: int = 1000, max_episodes: int = 3000,
-                      success_threshold: float = 0.7) -> RouteResult:
+                      success_threshold: float = 0.7,
+                      deadline: Optional[float] = None) -> RouteResult:
         """
         Find a route from start_street through all destination_streets in the optimal order,
         with improved logic to avoid revisiting streets when possible.
@@ -620,9 +3018,11 @@ class ImprovedRoutePlanner:
             min_episodes: Minimum number of training episodes per segment
             max_episodes: Maximum number of training episodes per segment
             success_threshold: Success rate threshold for early stopping
+            deadline: Absolute time.time() after which segments return their best route so far
 
         Returns:
-            RouteResult object representing the complete route
+            RouteResult object representing the complete route (converged=False if any
+            segment was cut short by the deadline)
         """
         if not destination_streets:
             raise ValueError("At least one destination street must be provided")
@@ -635,58 +3035,19 @@ class ImprovedRoutePlanner:
             if street not in self.network.street_to_nodes:
                 raise ValueError(f"Street '{street}' not found in network")
 
-        # Compute distances between all pairs of streets (including start)
-        all_streets = [start_street] + destination_streets
-        distance_matrix = {}
-
-        print("Computing distances between all street pairs...")
-        for i, street1 in enumerate(all_streets):
-            distance_matrix[street1] = {}
-            for j, street2 in enumerate(all_streets):
-                if i == j:
-                    distance_matrix[street1][street2] = 0
-                    continue
-
-                # Skip redundant calculations
-                if street2 in distance_matrix and street1 in distance_matrix[street2]:
-                    distance_matrix[street1][street2] = distance_matrix[street2][street1]
-                    continue
+        cache_key = self._route_cache_key(start_street, tuple(destination_streets), 'multi_stop')
+        cached_route = self._get_cached_route(cache_key)
+        if cached_route is not None:
+            print(f"Using cached multi-stop route: {cached_route.total_distance:.0f}m, {cached_route.total_time:.1f}s")
+            return cached_route
 
-                # Estimate distance between streets
-                try:
-                    # Use the first node of each street for estimation
-                    start_nodes = self._get_street_nodes(street1)
-                    end_nodes = self._get_street_nodes(street2)
-
-                    # Find the shortest path between any pair of nodes
-                    min_distance = float('inf')
-                    for start_node in list(start_nodes)[:3]:  # Limit to 3 nodes for efficiency
-                        for end_node in list(end_nodes)[:3]:
-                            try:
-                                path_length = nx.shortest_path_length(
-                                    self.network.graph, start_node, end_node, weight='length')
-                                min_distance = min(min_distance, path_length)
-                            except:
-                                continue
-
-                    if min_distance == float('inf'):
-                        # Fallback to topological distance if length-based fails
-                        for start_node in list(start_nodes)[:3]:
-                            for end_node in list(end_nodes)[:3]:
-                                try:
-                                    path_length = len(nx.shortest_path(self.network.graph, start_node, end_node))
-                                    min_distance = min(min_distance, path_length * 100)  # Rough estimate
-                                except:
-                                    continue
-
-                    if min_distance == float('inf'):
-                        print(f"Warning: Could not find distance between {street1} and {street2}")
-                        min_distance = 10000  # Some large default value
-
-                    distance_matrix[street1][street2] = min_distance
-                except Exception as e:
-                    print(f"Error estimating distance between {street1} and {street2}: {str(e)}")
-                    distance_matrix[street1][street2] = 10000  # Default large value
+        # Coarse street-to-street travel times from the street overlay order the stops;
+        # one cached overlay row per street replaces a node search per pair
+        all_streets = [start_street] + destination_streets
+        overlay = self.street_overlay
+        estimates = overlay.estimate_matrix(all_streets, all_streets)
+        distance_matrix = {street1: {street2: float(estimates[i, j]) for j, street2 in enumerate(all_streets)}
+                           for i, street1 in enumerate(all_streets)}
 
         # Find optimal order using nearest neighbor heuristic
         current_street = start_street
@@ -694,9 +3055,10 @@ class ImprovedRoutePlanner:
         optimal_order = [current_street]
 
         while unvisited:
-            # Find nearest unvisited street
+            # Find nearest unvisited street (streets that meet tie at 0: nearest center first)
             next_street = min(unvisited,
-                              key=lambda s: distance_matrix[current_street][s])
+                              key=lambda s: (distance_matrix[current_street][s],
+                                             overlay.center_distance(current_street, s), s))
             optimal_order.append(next_street)
             unvisited.remove(next_street)
             current_street = next_street
@@ -752,9 +3114,10 @@ class ImprovedRoutePlanner:
                             remaining_destination_streets  # Pass remaining destinations to exempt them
                         )
 
-                        # Temporarily swap the graphs
-                        original_graph = self.network.graph
-                        self.network.graph = modified_graph
+                        # Route this segment on the penalised graph (only this query sees it)
+                        context = self.context
+                        original_graph = context.graph
+                        context.graph = modified_graph
 
                         print(f"Applied penalties to {len(visited_streets)} previously visited streets, exempting {len(remaining_destination_streets)} remaining destinations")
 
@@ -763,18 +3126,20 @@ class ImprovedRoutePlanner:
                                 current_street, next_street,
                                 min_episodes=segment_min_episodes,
                                 max_episodes=segment_max_episodes,
-                                success_threshold=success_threshold
+                                success_threshold=success_threshold,
+                                deadline=deadline
                             )
                         finally:
                             # Restore original graph
-                            self.network.graph = original_graph
+                            context.graph = original_graph
                     else:
                         # First segment, use original graph
                         segment = self.find_route(
                             current_street, next_street,
                             min_episodes=segment_min_episodes,
                             max_episodes=segment_max_episodes,
-                            success_threshold=success_threshold
+                            success_threshold=success_threshold,
+                            deadline=deadline
                         )
 
                     # Update visited streets and edges
@@ -783,8 +3148,7 @@ class ImprovedRoutePlanner:
                         visited_streets.update(segment.street_path)
 
                         # Add all edges in this segment to visited edges
-                        for seg in segment.segments:
-                            visited_edges.add((seg.from_node, seg.to_node))
+                        visited_edges.update(segment.segments.node_pairs())
                         
                         # Mark current destination as visited and remove from remaining
                         visited_destination_streets.add(next_street)
@@ -855,7 +3219,7 @@ class ImprovedRoutePlanner:
                         combined_street_path.append(street)
 
             # Add all segments
-            combined_segments.extend(segment.segments)
+            combined_segments.append(segment.segments)
 
             # Accumulate statistics
             total_distance += segment.total_distance
@@ -924,7 +3288,8 @@ class ImprovedRoutePlanner:
             total_time=total_time,
             success=True,
             traffic_distribution=traffic_distribution,
-            segments=combined_segments
+            segments=RouteSegments.concat(combined_segments),
+            converged=all(segment.converged for segment in segment_routes)
         )
 
         # Report total time and statistics
@@ -950,6 +3315,7 @@ class ImprovedRoutePlanner:
         print(f"All destinations included: {'Yes' if all_destinations_included else 'No'}")
         print(f"Optimal order preserved: {'Yes' if optimal_order_preserved else 'No'}")
 
+        self._cache_route(cache_key, combined_route)
         return combined_route
 
     def _create_modified_graph_with_penalties(self, visited_streets, visited_edges, exempt_streets=None):
@@ -967,7 +3333,7 @@ class ImprovedRoutePlanner:
         """
         # Create a deep copy of the graph
         import copy
-        modified_graph = copy.deepcopy(self.network.graph)
+        modified_graph = copy.deepcopy(self.graph)
         
         # Initialize exempt_streets if not provided
         if exempt_streets is None:
@@ -984,7 +3350,9 @@ class ImprovedRoutePlanner:
             if street_name in exempt_streets:
                 continue
                     
-            # Higher penalty for edges we've directly traversed
+            # Higher penalty for edges we've directly traversed (chain edges by their first part)
+            if data.get('via'):
+                v = data['via'][0]
             if (u, v) in visited_edges or (v, u) in visited_edges:
                 # Apply a significant penalty to directly traversed edges
                 data['length'] = data['length'] * 5.0
@@ -995,53 +3363,11 @@ class ImprovedRoutePlanner:
                 data['length'] = data['length'] * 2.0
                 penalized_edges += 1
         
-        print(f"Applied penalties to {penalized_edges} edges")
-        
-        return modified_graph
+        # Tag the overlay so caches keyed on the graph can tell it apart from the base graph
+        # (a digest, not hash(): string hashes are salted per process and these keys are pickled)
+        modified_graph.graph['penalty_key'] = hashlib.blake2b(repr((
+            sorted(visited_streets), sorted(visited_edges), sorted(exempt_streets))).encode()).hexdigest()
 
-    def _create_modified_graph_with_penalties(self, visited_streets, visited_edges, exempt_streets=None):
-        """
-        Create a modified copy of the network graph with penalties for already visited streets,
-        but exempting streets that are still in our destination list.
-        
-        Args:
-            visited_streets: Set of street names that have already been visited
-            visited_edges: Set of (from_node, to_node) tuples that have already been traversed
-            exempt_streets: Set of street names that should be exempt from penalties (remaining destinations)
-        
-        Returns:
-            A modified copy of the network graph
-        """
-        # Create a deep copy of the graph
-        import copy
-        modified_graph = copy.deepcopy(self.network.graph)
-        
-        # Initialize exempt_streets if not provided
-        if exempt_streets is None:
-            exempt_streets = set()
-        
-        # Count penalized edges for reporting
-        penalized_edges = 0
-        
-        # Apply penalties to edges on visited streets
-        for u, v, data in modified_graph.edges(data=True):
-            street_name = data.get('street_name')
-            
-            # Skip penalty if this street is a remaining destination
-            if street_name in exempt_streets:
-                continue
-                    
-            # Higher penalty for edges we've directly traversed
-            if (u, v) in visited_edges or (v, u) in visited_edges:
-                # Apply a significant penalty to directly traversed edges
-                data['length'] = data['length'] * 5.0
-                penalized_edges += 1
-            # Smaller penalty for any edge on a street we've visited
-            elif street_name in visited_streets:
-                # Apply a moderate penalty to edges on visited streets
-                data['length'] = data['length'] * 2.0
-                penalized_edges += 1
-        
         print(f"Applied penalties to {penalized_edges} edges")
         
         return modified_graph
@@ -1062,7 +3388,7 @@ class ImprovedRoutePlanner:
         for start_node in start_sample:
             for end_node in end_sample:
                 try:
-                    if nx.has_path(self.network.graph, start_node, end_node):
+                    if nx.has_path(self.graph, start_node, end_node):
                         return True
                 except Exception as e:
                     continue
@@ -1081,7 +3407,7 @@ class ImprovedRoutePlanner:
                 # Expand forward
                 new_forward = set()
                 for node in forward_frontier:
-                    neighbors = set(self.network.graph.neighbors(node))
+                    neighbors = set(self.graph.neighbors(node))
                     new_forward.update(neighbors - visited_forward)
 
                 visited_forward.update(new_forward)
@@ -1094,9 +3420,9 @@ class ImprovedRoutePlanner:
                 # Expand backward
                 new_backward = set()
                 for node in backward_frontier:
-                    neighbors = set(self.network.graph.predecessors(node)
-                                if self.network.graph.is_directed()
-                                else self.network.graph.neighbors(node))
+                    neighbors = set(self.graph.predecessors(node)
+                                if self.graph.is_directed()
+                                else self.graph.neighbors(node))
                     new_backward.update(neighbors - visited_backward)
 
                 visited_backward.update(new_backward)
@@ -1117,7 +3443,7 @@ class ImprovedRoutePlanner:
         # Calculate node scores based on connectivity and other properties
         start_scores = []
         for node in start_nodes:
-            connectivity = self.network.graph.nodes[node].get('connectivity', 0)
+            connectivity = self.graph.nodes[node].get('connectivity', 0)
             # Higher score for non-bottleneck nodes with good connectivity
             is_bottleneck = 1 if node in self.network.bottleneck_nodes else 0
             score = connectivity * (2 - is_bottleneck)
@@ -1125,7 +3451,7 @@ class ImprovedRoutePlanner:
 
         end_scores = []
         for node in end_nodes:
-            connectivity = self.network.graph.nodes[node].get('connectivity', 0)
+            connectivity = self.graph.nodes[node].get('connectivity', 0)
             is_bottleneck = 1 if node in self.network.bottleneck_nodes else 0
             score = connectivity * (2 - is_bottleneck)
             end_scores.append((node, score))
@@ -1158,12 +3484,23 @@ class ImprovedRoutePlanner:
     def _improved_train_route(self, start_node: str, end_node: str,
                      min_episodes: int,
                      max_episodes: int,
-                     success_threshold: float) -> Optional[RouteResult]:
-        """Enhanced RL training for very long routes with performance optimizations."""
+                     success_threshold: float,
+                     cancel_event=None,
+                     best_bound=None,
+                     deadline: Optional[float] = None) -> Optional[RouteResult]:
+        """Enhanced RL training for very long routes with performance optimizations.
+
+        cancel_event and best_bound are set by parallel find_route attempts: training
+        stops when the event is set, or after min_episodes once another attempt has
+        published a faster route time than this one's best. Training also stops at
+        the deadline (absolute time.time()), returning the best path so far with
+        converged=False unless the stop criteria were already met.
+        """
 
-        # Save and reset agent's exploration parameters
-        original_epsilon = self.agent.epsilon
-        self.agent.epsilon = 0.9  # High exploration rate
+        # Exploration rate for this query only; the shared agent's epsilon is never written
+        context = self.context
+        agent = context.agent
+        epsilon = 0.9 if context.epsilon is None else context.epsilon  # High exploration rate
 
         # Use cached shortest path if available
         path_key = f"{start_node}_{end_node}"
@@ -1174,7 +3511,7 @@ class ImprovedRoutePlanner:
         else:
             # Get shortest path info for guidance
             try:
-                shortest_path = nx.shortest_path(self.network.graph, start_node, end_node)
+                shortest_path = nx.shortest_path(self.graph, start_node, end_node)
                 shortest_length = len(shortest_path)
                 # Cache the result
                 self.shortest_path_cache[path_key] = shortest_path
@@ -1184,6 +3521,26 @@ class ImprovedRoutePlanner:
                 shortest_path = None
                 shortest_length = 1000  # Default if no path found
 
+        # Warm start from the policy trained for this destination if traffic is unchanged
+        policy_key = (end_node, self._penalty_key())
+        policy = self.policy_cache.lookup(policy_key, self.traffic_version)
+        if policy is not None:
+            # Re-seed Q-values the shared table may have evicted since training
+            agent.q_table.import_rows(*policy.q_slice)
+            if policy.converged:
+                cached_path = policy.best_paths.get(start_node)
+                if cached_path is None:
+                    cached_path = self._greedy_rollout(start_node, end_node, max(100, shortest_length * 3))
+                if cached_path:
+                    print(f"Reusing converged policy for {end_node} ({policy.episodes} episodes, "
+                          f"{policy.success_rate * 100:.0f}% success), skipping training")
+                    return self._create_route_result(cached_path)
+            # Known destination: explore less and train for a fraction of the budget
+            min_episodes = max(1, min_episodes // 4)
+            max_episodes = max(min_episodes, max_episodes // 4)
+            epsilon = 0.3 if context.epsilon is None else context.epsilon
+            print(f"Warm-starting from cached policy for {end_node}: up to {max_episodes} episodes")
+
         # Create waypoints for long paths to improve exploration
         if shortest_path and shortest_length > 50:
             print(f"Path is very long. Creating waypoints...")
@@ -1196,42 +3553,39 @@ class ImprovedRoutePlanner:
             waypoints = [end_node]
 
         # Calculate distance matrix for reward shaping (with caching)
-        distance_to_end = {}
         # Define the bounded subgraph to work with
         bounded_nodes = set()
 
-        if end_node in self.distance_cache:
-            print("Using cached distance data")
-            distance_to_end = self.distance_cache[end_node]
-        else:
-            print("Building distance cache...")
-            # Use Dijkstra's algorithm once instead of multiple shortest_path_length calls
-            lengths = nx.single_source_dijkstra_path_length(self.network.graph, end_node)
-            distance_to_end = lengths
-
-            # Cache for future use
-            self.distance_cache[end_node] = distance_to_end
+        # Only nodes within the search bound matter, so stop the Dijkstra there
+        search_distance = min(shortest_length * 2, 500) if shortest_path else None  # Reasonable upper bound
+        distance_to_end = self.distance_cache.get(
+            self.graph, self.state_encoder, end_node, cutoff=search_distance)
 
         # Create bounded search space for efficiency
         if shortest_path:
-            search_distance = min(shortest_length * 2, 500)  # Reasonable upper bound
-            for node in self.network.graph.nodes():
-                if node in distance_to_end and distance_to_end[node] <= search_distance:
-                    bounded_nodes.add(node)
+            nodes = self.state_encoder.nodes
+            within = np.flatnonzero(distance_to_end.distances <= search_distance)
+            bounded_nodes.update(nodes[i] for i in within.tolist())
+
+            # Stay inside the street corridor, if find_route chose one
+            corridor = context.corridor
+            if corridor is not None:
+                bounded_nodes &= corridor
+                bounded_nodes.update((start_node, end_node))
 
             # Always include shortest path nodes
             bounded_nodes.update(shortest_path)
             print(f"Bounded search space: {len(bounded_nodes)} nodes")
         else:
             # If no shortest path, use a larger bounded area
-            bounded_nodes = set(self.network.graph.nodes())
+            bounded_nodes = set(self.graph.nodes())
 
         # Create subgraph for faster operations
-        if len(bounded_nodes) < len(self.network.graph.nodes()):
-            subgraph = self.network.graph.subgraph(bounded_nodes)
+        if len(bounded_nodes) < len(self.graph.nodes()):
+            subgraph = self.graph.subgraph(bounded_nodes)
             print(f"Using subgraph with {len(subgraph)} nodes and {subgraph.number_of_edges()} edges")
         else:
-            subgraph = self.network.graph
+            subgraph = self.graph
 
         successful_paths = []
         best_reward = float('-inf')
@@ -1251,6 +3605,8 @@ class ImprovedRoutePlanner:
 
         # Precompute states for frequently visited nodes
         state_cache = {}
+        encoder = self.state_encoder
+        node_id = encoder.node_id
 
         # Track time for monitoring
         import time
@@ -1258,6 +3614,9 @@ class ImprovedRoutePlanner:
         last_report_time = start_time
 
         # Training loop
+        stop_reason = None
+        episode = -1
+        best_time = float('inf')
         for episode in range(adjusted_max_episodes):
             current = start_node
             path = [current]
@@ -1288,7 +3647,7 @@ class ImprovedRoutePlanner:
                         break
 
                     # Exploration-exploitation balance with dynamic adjustment
-                    explore_rate = self.agent.epsilon * (1 - (steps_to_target / max_steps_to_target * 0.5))
+                    explore_rate = epsilon * (1 - (steps_to_target / max_steps_to_target * 0.5))
 
                     # Choose action with targeted exploration
                     if random.random() < explore_rate:
@@ -1304,7 +3663,9 @@ class ImprovedRoutePlanner:
                         else:
                             next_node = random.choice(valid_actions)
                     else:
-                        next_node = self.agent.choose_action(state, valid_actions, is_training=True)
+                        action_ids = [node_id(n) for n in valid_actions]
+                        next_node = encoder.nodes[agent.choose_action(state, action_ids, is_training=True,
+                                                                      epsilon=epsilon)]
 
                     # Fast reward calculation
                     edge = subgraph[current][next_node]
@@ -1327,9 +3688,9 @@ class ImprovedRoutePlanner:
 
                     # Update Q-values
                     next_state = self._get_state(next_node)
-                    next_valid_actions = [n for n in neighbor_cache.get(next_node, [])
-                                        if n not in visited or steps_to_target > 50]
-                    self.agent.update(state, next_node, reward, next_state, next_valid_actions)
+                    next_valid_actions = [node_id(n) for n in neighbor_cache.get(next_node, [])
+                                          if n not in visited or steps_to_target > 50]
+                    agent.update(state, node_id(next_node), reward, next_state, next_valid_actions)
 
                     # Move to next state
                     current = next_node
@@ -1385,32 +3746,81 @@ class ImprovedRoutePlanner:
                 # Stop if we have a good success rate and a reasonable number of samples
                 if (len(successful_paths) / (episode + 1)) >= success_threshold and len(successful_paths) >= 10:
                     print(f"Early stopping at episode {episode+1}: Success threshold reached")
+                    stop_reason = 'threshold'
                     break
 
                 # Stop if we're not making progress after enough episodes
                 if stagnation_count > min(1000, adjusted_max_episodes // 5) and len(successful_paths) > 0:
                     print(f"Early stopping at episode {episode+1}: Stagnation detected")
+                    stop_reason = 'stagnation'
                     break
 
                 # Stop if we've had a consistent streak of successes
                 if success_streak >= 20:
                     print(f"Early stopping at episode {episode+1}: Consistent success streak")
+                    stop_reason = 'streak'
+                    break
+
+            if deadline is not None and time.time() >= deadline:
+                print(f"Deadline reached at episode {episode+1}")
+                stop_reason = 'deadline'
+                break
+
+            # Coordination with concurrent attempts of the same query
+            if cancel_event is not None and cancel_event.is_set():
+                print(f"Attempt cancelled at episode {episode+1}")
+                stop_reason = 'cancelled'
+                break
+            if best_bound is not None and best_path is not None:
+                if stagnation_count == 0:
+                    # New best path this episode: publish its travel time
+                    best_time = self._path_time(best_path)
+                    with best_bound.get_lock():
+                        best_bound.value = min(best_bound.value, best_time)
+                if episode >= min_episodes and best_bound.value < best_time:
+                    print(f"Stopping at episode {episode+1}: another attempt already has a faster route")
+                    stop_reason = 'outbound'
                     break
 
             # Gradually reduce exploration as training progresses
             if episode % 100 == 0 and episode > 0:
-                self.agent.epsilon = max(0.1, self.agent.epsilon * 0.95)
+                epsilon = max(0.1, epsilon * 0.95)
 
-        # Restore original exploration rate
-        self.agent.epsilon = original_epsilon
+        if best_path is None and successful_paths:
+            # Fallback to best successful path if best_path wasn't set
+            best_path, _ = max(successful_paths, key=lambda x: x[1])
+
+        # Record convergence stats and the trained Q-slice for this destination
+        episodes_run = episode + 1
+        converged = episodes_run > 0 and (stop_reason in ('threshold', 'streak') or
+                                          len(successful_paths) / episodes_run >= success_threshold)
+        if episodes_run > 0:
+            self.policy_cache.store(policy_key, PolicyEntry(
+                traffic_version=self.traffic_version,
+                converged=converged,
+                episodes=episodes_run,
+                success_rate=len(successful_paths) / episodes_run,
+                best_paths={start_node: best_path} if best_path else {},
+                q_slice=agent.q_table.export_rows(set(state_cache.values()))
+            ))
+
+        if best_path is None and context.corridor is not None and stop_reason not in ('deadline', 'cancelled'):
+            # Corridor pruning failed: train again on the full graph
+            print("No route inside the street corridor, retrying on the full graph")
+            corridor, context.corridor = context.corridor, None
+            try:
+                return self._improved_train_route(start_node, end_node, min_episodes, max_episodes,
+                                                  success_threshold, cancel_event, best_bound, deadline)
+            finally:
+                context.corridor = corridor
 
         # Return best route or None if no successful path was found
         if best_path:
-            return self._create_route_result(best_path)
-        elif successful_paths:
-            # Fallback to best successful path if best_path wasn't set
-            best_path, _ = max(successful_paths, key=lambda x: x[1])
-            return self._create_route_result(best_path)
+            route = self._create_route_result(best_path)
+            # Only a deadline stop leaves the answer provisional; other early stops are the
+            # normal search budget running out
+            route.converged = stop_reason != 'deadline' or converged
+            return route
         else:
             print("No successful path found")
             return None
@@ -1432,6 +3842,525 @@ class TransportAllocation:
     dest_street: str
     quantity: float
 
+@dataclass
+class AllocationJob:
+    """Transportation-problem solution kept between re-optimizations of one job.
+
+    The problem is padded with a dummy source (unmet demand, charged a penalty)
+    and a dummy destination (unused supply, free) so it stays balanced whatever
+    deltas are applied. Flows live on the cells of a spanning tree (`basis`,
+    m+n-1 cells of the padded table) and `u`/`v` are its dual potentials, so a
+    demand or capacity change only needs the tree flows recomputed and a few
+    dual simplex pivots instead of a full solve.
+    """
+    job_id: str
+    source_streets: List[str]
+    dest_streets: List[str]
+    supply: np.ndarray  # Padded: last entry is the dummy source
+    demand: np.ndarray  # Padded: last entry is the dummy destination
+    costs: np.ndarray
+    penalty: float  # Cost per unit of unmet demand
+    flows: Optional[np.ndarray] = None
+    basis: Optional[np.ndarray] = None
+    u: Optional[np.ndarray] = None
+    v: Optional[np.ndarray] = None
+    traffic_version: Optional[int] = None
+    pivots: int = 0  # Simplex pivots used by the last solve or repair
+
+    @classmethod
+    def create(cls, job_id: str, sources: List['LogisticsRequest'],
+               destinations: List['LogisticsDestination'], costs: np.ndarray,
+               traffic_version: Optional[int] = None) -> 'AllocationJob':
+        finite = costs[np.isfinite(costs)]
+        penalty = float(finite.max()) * 10 + 1000 if finite.size else 1000.0
+        m, n = costs.shape
+        padded = np.zeros((m + 1, n + 1))
+        # Unreachable pairs cost more than leaving the demand unmet
+        padded[:m, :n] = np.where(np.isfinite(costs), costs, 2 * penalty)
+        padded[m, :n] = penalty
+        job = cls(job_id, [s.source_street for s in sources], [d.dest_street for d in destinations],
+                  np.zeros(m + 1), np.zeros(n + 1), padded, penalty, traffic_version=traffic_version)
+        job.supply[:m] = [s.capacity for s in sources]
+        job.demand[:n] = [d.demand for d in destinations]
+        job._balance()
+
+        # Starting basis: every source ships to the dummy destination and every
+        # destination is served by the dummy source (a feasible spanning star)
+        job.basis = np.zeros((m + 1, n + 1), dtype=bool)
+        job.basis[:, n] = True
+        job.basis[m, :] = True
+        job._compute_potentials()
+        job.flows = job._compute_flows()
+        job.pivots = job._primal_pivots()
+        return job
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return len(self.source_streets), len(self.dest_streets)
+
+    def _balance(self) -> None:
+        """Size the dummy source/destination so total supply equals total demand."""
+        m, n = self.shape
+        self.supply[m] = self.demand[:n].sum()
+        self.demand[n] = self.supply[:m].sum()
+
+    def _tree_adjacency(self) -> List[List[Tuple[int, Tuple[int, int]]]]:
+        """Neighbours of each tree node: rows are 0..m, columns m+1..m+n+1."""
+        rows = self.costs.shape[0]
+        adjacency = [[] for _ in range(rows + self.costs.shape[1])]
+        for i, j in zip(*np.nonzero(self.basis)):
+            adjacency[i].append((rows + j, (i, j)))
+            adjacency[rows + j].append((i, (i, j)))
+        return adjacency
+
+    def _compute_potentials(self) -> None:
+        """Solve u_i + v_j = c_ij over the basis tree, anchored at u_0 = 0."""
+        rows, cols = self.costs.shape
+        potentials = np.full(rows + cols, np.nan)
+        potentials[0] = 0.0
+        adjacency = self._tree_adjacency()
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            for neighbour, (i, j) in adjacency[node]:
+                if np.isnan(potentials[neighbour]):
+                    potentials[neighbour] = self.costs[i, j] - potentials[node]
+                    stack.append(neighbour)
+        self.u = potentials[:rows]
+        self.v = potentials[rows:]
+
+    def _compute_flows(self) -> np.ndarray:
+        """Flows on the basis cells implied by supply/demand (leaf peeling; may go negative)."""
+        residual = np.concatenate([self.supply, self.demand]).astype(float)
+        adjacency = self._tree_adjacency()
+        degree = [len(neighbours) for neighbours in adjacency]
+        done = set()
+        flows = np.zeros(self.costs.shape)
+        leaves = [node for node, d in enumerate(degree) if d == 1]
+        while leaves:
+            node = leaves.pop()
+            if degree[node] != 1:
+                continue
+            for neighbour, cell in adjacency[node]:
+                if cell in done:
+                    continue
+                # A leaf's whole remaining supply/demand must cross its only edge
+                flows[cell] = residual[node]
+                residual[neighbour] -= residual[node]
+                residual[node] = 0.0
+                done.add(cell)
+                degree[node] -= 1
+                degree[neighbour] -= 1
+                if degree[neighbour] == 1:
+                    leaves.append(neighbour)
+                break
+        return flows
+
+    def _reduced_costs(self) -> np.ndarray:
+        reduced = self.costs - self.u[:, None] - self.v[None, :]
+        reduced[self.basis] = 0.0
+        return reduced
+
+    def _tree_path(self, start: int, end: int) -> List[Tuple[int, int]]:
+        """Cells on the unique tree path between two nodes."""
+        adjacency = self._tree_adjacency()
+        parent = {start: None}
+        stack = [start]
+        while stack and end not in parent:
+            node = stack.pop()
+            for neighbour, cell in adjacency[node]:
+                if neighbour not in parent:
+                    parent[neighbour] = (node, cell)
+                    stack.append(neighbour)
+        path = []
+        node = end
+        while parent[node] is not None:
+            node, cell = parent[node]
+            path.append(cell)
+        path.reverse()
+        return path
+
+    def _primal_pivots(self, max_pivots: Optional[int] = None, tolerance: float = 1e-9) -> int:
+        """Transportation simplex (MODI) pivots from a feasible basis until optimal."""
+        rows = self.costs.shape[0]
+        if max_pivots is None:
+            max_pivots = 20 * sum(self.costs.shape)
+        pivots = 0
+        while pivots < max_pivots:
+            reduced = self._reduced_costs()
+            p, q = np.unravel_index(np.argmin(reduced), reduced.shape)
+            if reduced[p, q] >= -tolerance:
+                break
+            # The cycle closed by the entering cell alternates -/+ along the tree
+            # path from row p to column q; the first cell on the path is a minus
+            path = self._tree_path(p, rows + q)
+            minus = path[0::2]
+            plus = path[1::2]
+            leaving = min(minus, key=lambda cell: self.flows[cell])
+            theta = self.flows[leaving]
+            for cell in minus:
+                self.flows[cell] -= theta
+            for cell in plus:
+                self.flows[cell] += theta
+            self.flows[p, q] += theta
+            self.flows[leaving] = 0.0
+            self.basis[p, q] = True
+            self.basis[leaving] = False
+            self._compute_potentials()
+            pivots += 1
+        return pivots
+
+    def _dual_pivots(self, max_pivots: Optional[int] = None, tolerance: float = 1e-9) -> int:
+        """Dual simplex pivots restoring non-negative flows while keeping the potentials optimal."""
+        rows = self.costs.shape[0]
+        if max_pivots is None:
+            max_pivots = 20 * sum(self.costs.shape)
+        pivots = 0
+        while pivots < max_pivots:
+            flows = np.where(self.basis, self.flows, np.inf)
+            r, s = np.unravel_index(np.argmin(flows), flows.shape)
+            if flows[r, s] >= -tolerance:
+                break
+            # Removing the negative cell splits the tree; the side holding row r
+            # is short of supply, so the entering cell must ship into it
+            self.basis[r, s] = False
+            adjacency = self._tree_adjacency()
+            side = {r}
+            stack = [r]
+            while stack:
+                for neighbour, _ in adjacency[stack.pop()]:
+                    if neighbour not in side:
+                        side.add(neighbour)
+                        stack.append(neighbour)
+            in_side = np.zeros(rows + self.costs.shape[1], dtype=bool)
+            in_side[list(side)] = True
+            candidate_rows = np.nonzero(~in_side[:rows])[0]
+            candidate_cols = np.nonzero(in_side[rows:])[0]
+            reduced = self.costs - self.u[:, None] - self.v[None, :]
+            block = reduced[np.ix_(candidate_rows, candidate_cols)]
+            k, l = np.unravel_index(np.argmin(block), block.shape)
+            self.basis[candidate_rows[k], candidate_cols[l]] = True
+            self._compute_potentials()
+            self.flows = self._compute_flows()
+            pivots += 1
+        return pivots
+
+    def add_source(self, source: 'LogisticsRequest', costs: np.ndarray) -> None:
+        """Add a source row attached to the tree through its dummy-destination cell."""
+        m, n = self.shape
+        self.source_streets.append(source.source_street)
+        row = np.append(np.where(np.isfinite(costs), costs, 2 * self.penalty), 0.0)
+        self.costs = np.insert(self.costs, m, row, axis=0)
+        self.supply = np.insert(self.supply, m, 0.0)
+        self.flows = np.insert(self.flows, m, 0.0, axis=0)
+        basis_row = np.zeros(n + 1, dtype=bool)
+        basis_row[n] = True
+        self.basis = np.insert(self.basis, m, basis_row, axis=0)
+        self.u = np.insert(self.u, m, 0.0 - self.v[n])
+
+    def add_destination(self, destination: 'LogisticsDestination', costs: np.ndarray) -> None:
+        """Add a destination column attached to the tree through its dummy-source cell."""
+        m, n = self.shape
+        self.dest_streets.append(destination.dest_street)
+        column = np.append(np.where(np.isfinite(costs), costs, 2 * self.penalty), self.penalty)
+        self.costs = np.insert(self.costs, n, column, axis=1)
+        self.demand = np.insert(self.demand, n, 0.0)
+        self.flows = np.insert(self.flows, n, 0.0, axis=1)
+        basis_column = np.zeros(m + 1, dtype=bool)
+        basis_column[m] = True
+        self.basis = np.insert(self.basis, n, basis_column, axis=1)
+        self.v = np.insert(self.v, n, self.penalty - self.u[m])
+
+    def apply_deltas(self, capacity_deltas: Optional[Dict[str, float]] = None,
+                     demand_deltas: Optional[Dict[str, float]] = None) -> int:
+        """Apply capacity/demand changes for known streets and repair the solution."""
+        for street, delta in (capacity_deltas or {}).items():
+            i = self.source_streets.index(street)
+            self.supply[i] = max(self.supply[i] + delta, 0.0)
+        for street, delta in (demand_deltas or {}).items():
+            j = self.dest_streets.index(street)
+            self.demand[j] = max(self.demand[j] + delta, 0.0)
+        self._balance()
+        # Costs are unchanged, so the potentials stay dual feasible: only the
+        # flows move, and dual pivots fix any that went negative
+        self.flows = self._compute_flows()
+        self.pivots = self._dual_pivots()
+        self.pivots += self._primal_pivots()
+        return self.pivots
+
+    def update_costs(self, costs: np.ndarray) -> int:
+        """Swap in new travel costs (e.g. after a traffic update) and re-optimize from the current basis."""
+        m, n = self.shape
+        self.costs[:m, :n] = np.where(np.isfinite(costs), costs, 2 * self.penalty)
+        # The flows are still feasible; only the potentials need recomputing
+        self._compute_potentials()
+        self.pivots = self._primal_pivots()
+        return self.pivots
+
+    def total_cost(self) -> float:
+        m, n = self.shape
+        return float((self.flows[:m, :n] * self.costs[:m, :n]).sum())
+
+    def unmet_demand(self) -> Dict[str, float]:
+        m, n = self.shape
+        return {street: float(self.flows[m, j]) for j, street in enumerate(self.dest_streets)
+                if self.flows[m, j] > 1e-6}
+
+    def allocations(self) -> List['TransportAllocation']:
+        m, n = self.shape
+        allocations = []
+        for i in range(m):
+            for j in range(n):
+                quantity = self.flows[i, j]
+                if quantity > 1e-6:  # Small threshold to handle floating point errors
+                    allocations.append(TransportAllocation(
+                        source_street=self.source_streets[i],
+                        dest_street=self.dest_streets[j],
+                        quantity=int(round(quantity)) if abs(quantity - round(quantity)) < 1e-9 else float(quantity)
+                    ))
+        return allocations
+
+class DepotPartition:
+    """Nearest-depot (travel-time Voronoi) partition of the routing graph.
+
+    One forward travel-time search seeded from every node of every depot street
+    labels each node with the depot it is reached from first and the arrival time,
+    replacing a find_route per (depot, customer) pair. A street belongs to the depot
+    of its earliest-reached node, as in reachable_streets. The search tree and the
+    edge times it was built with are kept so a traffic update only re-settles the
+    nodes whose tree path got slower and the nodes a faster edge now improves.
+    """
+
+    def __init__(self, network: 'TransportNetwork', depot_streets: List[str]):
+        for street in depot_streets:
+            if street not in network.street_to_nodes:
+                raise ValueError(f"Street '{street}' not found in network")
+        self.network = network
+        self.depot_streets = list(dict.fromkeys(depot_streets))
+        self.build()
+
+    def _seeds(self) -> Dict[str, Tuple[float, str]]:
+        seeds = {}
+        for depot in self.depot_streets:
+            for from_node, to_node in self.network.street_to_nodes[depot]:
+                # A node shared by two depots goes to the one listed first
+                seeds.setdefault(from_node, (0.0, depot))
+                seeds.setdefault(to_node, (0.0, depot))
+        return seeds
+
+    def build(self) -> None:
+        """Full multi-source search under the current traffic."""
+        graph = self.network.graph
+        self.times, self.predecessors, self.node_depot = travel_time_search(graph, self._seeds())
+        self.edge_times = {(u, v): edge_travel_time(data) for u, v, data in graph.edges(data=True)}
+        self.traffic_version = self.network.traffic_version
+        self._label_streets()
+
+    def _label_streets(self, streets=None) -> None:
+        """(Re)label all streets, or only `streets`, from the node labels."""
+        if streets is None:
+            self.street_depot: Dict[str, str] = {}
+            self.street_time: Dict[str, float] = {}
+            streets = self.network.street_to_nodes
+        for street in streets:
+            edges = self.network.street_to_nodes[street]
+            self.street_depot.pop(street, None)
+            self.street_time.pop(street, None)
+            best = None
+            for edge in edges:
+                for node in edge:
+                    arrival = self.times.get(node)
+                    if arrival is not None and (best is None or arrival < best):
+                        best = arrival
+                        self.street_depot[street] = self.node_depot[node]
+            if best is not None:
+                self.street_time[street] = best
+
+    def refresh(self) -> int:
+        """Bring the partition up to the network's traffic version; returns nodes re-settled.
+
+        Only the edges the network logged as updated are re-timed. Nodes below an
+        edge of the search tree that got slower lose their labels and are re-seeded
+        from their labelled in-neighbours; edges that got faster seed their heads.
+        A Dijkstra over those seeds only accepts improvements, so nodes and streets
+        whose arrival is unaffected are never touched.
+        """
+        if self.traffic_version == self.network.traffic_version:
+            return 0
+        graph = self.network.graph
+        candidates = self.network.traffic_changes_since(self.traffic_version)
+        if candidates is None:
+            candidates = list(graph.edges())
+        if any(edge not in self.edge_times or not graph.has_edge(*edge) for edge in candidates) or \
+                graph.number_of_edges() != len(self.edge_times):
+            # The graph itself changed (reloaded or re-contracted): start over
+            self.build()
+            return len(self.times)
+
+        current = self.edge_times
+        slower = []
+        faster = []
+        for u, v in candidates:
+            cost = edge_travel_time(graph[u][v])
+            if cost > current[(u, v)]:
+                slower.append((u, v))
+            elif cost < current[(u, v)]:
+                faster.append((u, v))
+            current[(u, v)] = cost
+        self.traffic_version = self.network.traffic_version
+        if not slower and not faster:
+            return 0
+
+        children = defaultdict(list)
+        if slower:
+            for node, pred in self.predecessors.items():
+                if pred is not None:
+                    children[pred].append(node)
+        invalid = set()
+        for u, v in slower:
+            if self.predecessors.get(v) == u and v not in invalid:
+                stack = [v]
+                while stack:
+                    node = stack.pop()
+                    invalid.add(node)
+                    stack.extend(child for child in children[node] if child not in invalid)
+        for node in invalid:
+            del self.times[node], self.predecessors[node], self.node_depot[node]
+
+        heap = []
+        counter = 0
+        for node in invalid:
+            for pred in graph.pred[node]:
+                if pred in self.times:
+                    heap.append((self.times[pred] + current[(pred, node)], counter, node, pred))
+                    counter += 1
+        for u, v in faster:
+            if u in self.times:
+                heap.append((self.times[u] + current[(u, v)], counter, v, u))
+                counter += 1
+        heapq.heapify(heap)
+
+        settled = set()
+        while heap:
+            total, _, node, pred = heapq.heappop(heap)
+            if node in settled or self.times.get(node, float('inf')) <= total:
+                continue
+            settled.add(node)
+            self.times[node] = total
+            self.predecessors[node] = pred
+            self.node_depot[node] = self.node_depot[pred]
+            for neighbor in graph.succ[node]:
+                arrival = total + current[(node, neighbor)]
+                if arrival < self.times.get(neighbor, float('inf')):
+                    heapq.heappush(heap, (arrival, counter, neighbor, node))
+                    counter += 1
+
+        streets = set()
+        for node in invalid | settled:
+            for adjacency in (graph.succ[node], graph.pred[node]):
+                streets.update(data['street_name'] for data in adjacency.values())
+        self._label_streets(streets)
+        print(f"Depot partition refreshed: {len(slower)} slower / {len(faster)} faster edges, "
+              f"{len(settled)} nodes re-settled")
+        return len(settled)
+
+    def depot_of(self, street: str) -> Tuple[Optional[str], float]:
+        """(nearest depot, arrival time) of a street; (None, inf) if no depot reaches it."""
+        if street not in self.network.street_to_nodes:
+            raise ValueError(f"Street '{street}' not found in network")
+        return self.street_depot.get(street), self.street_time.get(street, float('inf'))
+
+    def members(self, streets: Optional[List[str]] = None) -> Dict[str, List[str]]:
+        """Streets (all, or only `streets`) grouped by nearest depot, each sorted by arrival."""
+        if streets is None:
+            streets = list(self.street_depot)
+        groups = {depot: [] for depot in self.depot_streets}
+        for street in streets:
+            depot = self.street_depot.get(street)
+            if depot is not None:
+                groups[depot].append(street)
+        for group in groups.values():
+            group.sort(key=lambda street: self.street_time[street])
+        return groups
+
+    def _depot_times(self, streets: List[str]) -> Dict[str, Dict[str, float]]:
+        """Travel time from every depot to each street (one k-label search, k = depots)."""
+        seeds = [(node, depot) for node, (_, depot) in self._seeds().items()]
+        nearest = k_nearest_labels(self.network.graph, seeds, len(self.depot_streets))
+        result = {}
+        for street in streets:
+            best: Dict[str, float] = {}
+            for edge in self.network.street_to_nodes[street]:
+                for node in edge:
+                    for depot, cost in nearest.get(node, {}).items():
+                        if cost < best.get(depot, float('inf')):
+                            best[depot] = cost
+            result[street] = best
+        return result
+
+    def assign(self, demands: Dict[str, float],
+               capacities: Optional[Dict[str, float]] = None) -> Tuple[Dict[str, str], List[str]]:
+        """Serve each customer street whole from one depot, respecting depot capacities.
+
+        Customers start at their nearest depot. While a depot is over capacity the
+        customer whose move to a depot with room costs the least extra travel time
+        is moved there. Returns (street -> depot, unassigned streets); a customer no
+        depot reaches, or that fits nowhere, stays unassigned.
+        """
+        assignment = {}
+        unassigned = []
+        for street in demands:
+            depot, _ = self.depot_of(street)
+            if depot is None:
+                unassigned.append(street)
+            else:
+                assignment[street] = depot
+        if not capacities:
+            return assignment, unassigned
+
+        loads = {depot: 0.0 for depot in self.depot_streets}
+        for street, depot in assignment.items():
+            loads[depot] += demands[street]
+        room = {depot: capacities.get(depot, float('inf')) - loads[depot] for depot in self.depot_streets}
+        if all(spare >= -1e-9 for spare in room.values()):
+            return assignment, unassigned
+
+        times = self._depot_times(list(assignment))
+        moves = 0
+        while True:
+            best = None
+            for street, depot in assignment.items():
+                if room[depot] >= -1e-9:
+                    continue
+                own = times[street].get(depot, self.street_time[street])
+                for other, cost in times[street].items():
+                    if other != depot and room[other] + 1e-9 >= demands[street]:
+                        regret = cost - own
+                        if best is None or regret < best[0]:
+                            best = (regret, street, other)
+            if best is None:
+                break
+            _, street, other = best
+            room[assignment[street]] += demands[street]
+            room[other] -= demands[street]
+            assignment[street] = other
+            moves += 1
+
+        overloaded = [depot for depot, spare in room.items() if spare < -1e-9]
+        if overloaded:
+            # Drop the latest-arriving customers of depots nothing else can relieve
+            for depot in overloaded:
+                for street in sorted((s for s, d in assignment.items() if d == depot),
+                                     key=lambda s: times[s].get(depot, float('inf')), reverse=True):
+                    if room[depot] >= -1e-9:
+                        break
+                    room[depot] += demands[street]
+                    del assignment[street]
+                    unassigned.append(street)
+            print(f"Warning: depots {overloaded} over capacity, {len(unassigned)} customers left unassigned")
+        print(f"Capacity rebalancing moved {moves} customers off their nearest depot")
+        return assignment, unassigned
+
 class LogisticsOptimizer:
     """Optimizes transport quantities from sources to destinations using reinforcement learning,
     based on the cost (travel time) associated with moving from one street to another."""
@@ -1440,20 +4369,51 @@ class LogisticsOptimizer:
         self.network = network
         self.route_planner = route_planner
         self.costs_cache = {}  # Cache for route costs to avoid recomputation
-
-    def _estimate_transport_cost(self, source: str, destination: str) -> float:
+        self.costs_cache_version = route_planner.network.traffic_version  # Traffic the costs were computed under
+        self.bitmask_states = True  # Train on packed int states and an array Q-table
+        self.last_allocation_converged = True  # False if the last allocation hit its deadline
+        self.depot_partitions = OrderedDict()  # Depot street tuple -> DepotPartition, most recent last
+        self.max_depot_partitions = 8
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault('costs_cache_version', None)
+        self.__dict__.setdefault('bitmask_states', True)
+        self.__dict__.setdefault('last_allocation_converged', True)
+        self.__dict__.setdefault('depot_partitions', OrderedDict())
+        self.__dict__.setdefault('max_depot_partitions', 8)
+
+    def _check_costs_cache(self) -> None:
+        """Drop cached costs computed under an older traffic version."""
+        traffic_version = self.route_planner.traffic_version
+        if self.costs_cache_version != traffic_version:
+            self.costs_cache.clear()
+            self.costs_cache_version = traffic_version
+
+    def _estimate_transport_cost(self, source: str, destination: str,
+                                 deadline: Optional[float] = None) -> float:
         """
         Estimate transport cost between source and destination by using the route planner
         to find the best route from the source street to the destination street.
-        The total travel time of the route is used as the cost.
+        The total travel time of the route is used as the cost. Once the deadline has
+        passed the street overlay's coarse estimate is used instead and not cached.
         """
+        self._check_costs_cache()
         cache_key = f"{source}_{destination}"
         if cache_key in self.costs_cache:
             return self.costs_cache[cache_key]
 
+        if deadline is not None and time.time() >= deadline:
+            try:
+                return self.route_planner.estimate_travel_time(source, destination)
+            except Exception:
+                return float('inf')
+
+        converged = True
         try:
             # Use the route planner to get a route result for the two streets
-            route_result = self.route_planner.find_route(source, destination)
+            route_result = self.route_planner.find_route(source, destination, deadline=deadline)
+            converged = route_result.converged
             if route_result.success:
                 cost = route_result.total_time  # Use travel time as the cost
             else:
@@ -1461,7 +4421,8 @@ class LogisticsOptimizer:
         except Exception:
             cost = float('inf')
 
-        self.costs_cache[cache_key] = cost
+        if converged:
+            self.costs_cache[cache_key] = cost
         return cost
 
     def _get_state_representation(self, current_supply: List[float], current_demand: List[float]) -> Tuple:
@@ -1479,21 +4440,37 @@ class LogisticsOptimizer:
 
     def optimize_transport_allocation(self,
                                       sources: List['LogisticsRequest'],
-                                      destinations: List['LogisticsDestination']) -> List['TransportAllocation']:
+                                      destinations: List['LogisticsDestination'],
+                                      costs: Optional[np.ndarray] = None,
+                                      deadline: Optional[float] = None,
+                                      coarse_costs: bool = False) -> List['TransportAllocation']:
         """
         Optimize transport allocation from sources to destinations using Q-learning RL and route cost
-        estimation based on street-to-street travel times.
+        estimation based on street-to-street travel times. A precomputed cost matrix
+        (sources x destinations) can be passed to skip the estimation; with coarse_costs
+        the street overlay's estimates are used instead of a route per pair.
+
+        The deadline (absolute time.time()) bounds the whole call: route searches for the
+        cost matrix are cut off at it and the remaining pairs use overlay estimates, and
+        training stops at it with the greedy allocation of the Q-values learned so far.
+        last_allocation_converged records whether every cost was routed and all episodes ran.
         """
         print(f"Optimizing transport allocation from {len(sources)} sources to {len(destinations)} destinations")
 
         num_sources = len(sources)
         num_dests = len(destinations)
 
-        # Build the cost matrix using the updated cost estimation function
-        costs = np.zeros((num_sources, num_dests))
-        for i, source in enumerate(sources):
-            for j, dest in enumerate(destinations):
-                costs[i, j] = self._estimate_transport_cost(source.source_street, dest.dest_street)
+        # Build the cost matrix using the updated cost estimation function, all pairs
+        # on the traffic version published when the allocation started
+        with self.route_planner._pinned_traffic():
+            if costs is None and coarse_costs:
+                costs = self._estimated_cost_rows([s.source_street for s in sources],
+                                                  [d.dest_street for d in destinations])
+            elif costs is None:
+                costs = self._cost_rows([s.source_street for s in sources], [d.dest_street for d in destinations],
+                                        deadline=deadline)
+        # Pairs costed at or after the deadline fell back to coarse estimates
+        costs_converged = deadline is None or time.time() < deadline
 
         # Compute total supply and demand
         total_supply = sum(source.capacity for source in sources)
@@ -1510,6 +4487,12 @@ class LogisticsOptimizer:
             ]
             total_demand = total_supply
 
+        if self.bitmask_states:
+            optimal_allocation_matrix, converged = self._train_bitmask_allocation(
+                sources, destinations, costs, deadline=deadline)
+            self.last_allocation_converged = converged and costs_converged
+            return self._matrix_to_allocations(sources, destinations, optimal_allocation_matrix)
+
         # Q-learning parameters
         num_episodes = 5000
         learning_rate = 0.1
@@ -1527,6 +4510,7 @@ class LogisticsOptimizer:
         q_values: Dict[int, np.ndarray] = {}
 
         # Training loop: iterate over many episodes to update Q-values
+        self.last_allocation_converged = costs_converged
         for episode in range(num_episodes):
             # Initialize state: available supply and demand for this episode
             current_supply = [source.capacity for source in sources]
@@ -1612,6 +4596,11 @@ class LogisticsOptimizer:
             # Decay epsilon after each episode
             epsilon = max(min_epsilon, epsilon * epsilon_decay)
 
+            if deadline is not None and time.time() >= deadline:
+                print(f"Deadline reached after {episode + 1} of {num_episodes} episodes")
+                self.last_allocation_converged = False
+                break
+
         # Print the final Q-values for the initial state
         initial_state = self._get_state_representation(
             [source.capacity for source in sources],
@@ -1647,6 +4636,11 @@ class LogisticsOptimizer:
             current_supply[supplier] -= units_to_transport
             current_demand[destination] -= units_to_transport
 
+        return self._matrix_to_allocations(sources, destinations, optimal_allocation_matrix)
+
+    def _matrix_to_allocations(self, sources: List['LogisticsRequest'], destinations: List['LogisticsDestination'],
+                               optimal_allocation_matrix: np.ndarray) -> List['TransportAllocation']:
+        num_sources, num_dests = optimal_allocation_matrix.shape
         # Convert the allocation matrix into a list of TransportAllocation objects
         allocations = []
         for i in range(num_sources):
@@ -1663,4 +4657,1033 @@ class LogisticsOptimizer:
         for alloc in allocations:
             print(f"{alloc.source_street} -> {alloc.dest_street}: {alloc.quantity} units")
 
-        return allocations
\ No newline at end of file
+        return allocations
+
+    def _train_bitmask_allocation(self, sources: List['LogisticsRequest'], destinations: List['LogisticsDestination'],
+                                  costs: np.ndarray, deadline: Optional[float] = None) -> Tuple[np.ndarray, bool]:
+        """
+        Same Q-learning as optimize_transport_allocation, on a faster representation.
+        A state is one int: bit i set while source i has supply, bit num_sources + j
+        while destination j has demand. Q-values live in one preallocated
+        (states x actions) array with actions flattened to i * num_dests + j. When a
+        state is first seen, the outer product of its supply and demand masks sets its
+        invalid actions to -inf, so argmax/max over a row only ever sees valid actions.
+        Returns the greedy allocation matrix and whether training ran to completion
+        (False when stopped at the deadline).
+        """
+        num_sources, num_dests = costs.shape
+        num_actions = num_sources * num_dests
+        num_episodes = 5000
+        learning_rate = 0.1
+        discount_factor = 0.9
+        epsilon = 1.0
+        epsilon_decay = 0.995
+        min_epsilon = 0.01
+
+        flat_costs = costs.ravel().tolist()
+        initial_supply = [float(source.capacity) for source in sources]
+        initial_demand = [float(dest.demand) for dest in destinations]
+        initial_bits = 0
+        for i, amount in enumerate(initial_supply):
+            if amount > 0.1:
+                initial_bits |= 1 << i
+        for j, amount in enumerate(initial_demand):
+            if amount > 0.1:
+                initial_bits |= 1 << (num_sources + j)
+
+        state_rows: Dict[int, int] = {}
+        # Rows are filled with the same small random initial values as the tuple-state table
+        q_table = np.random.uniform(-0.01, 0.01, (256, num_actions))
+        # Cached max Q-value and its action per row, refreshed only when an update
+        # lowers the current best, so most steps skip the row scan
+        best_values: List[float] = []
+        best_actions: List[int] = []
+        # Flattened outer product of the supply and demand masks as an additive
+        # 0 / -inf penalty; exhausting a source or destination strikes out its row
+        # or column of the product in place
+        has_supply = np.array([amount > 0.1 for amount in initial_supply])
+        has_demand = np.array([amount > 0.1 for amount in initial_demand])
+        initial_penalty = np.where(np.outer(has_supply, has_demand).ravel(), 0.0, -np.inf)
+
+        def state_row(bits: int, penalty: np.ndarray) -> int:
+            nonlocal q_table
+            row = state_rows.get(bits)
+            if row is None:
+                row = len(state_rows)
+                state_rows[bits] = row
+                if row == len(q_table):
+                    q_table = np.concatenate([q_table, np.random.uniform(-0.01, 0.01, q_table.shape)])
+                q_values = q_table[row]
+                q_values += penalty
+                action = int(q_values.argmax())
+                best_actions.append(action)
+                best_values.append(float(q_values[action]))
+            return row
+
+        converged = True
+        for episode in range(num_episodes):
+            current_supply = list(initial_supply)
+            current_demand = list(initial_demand)
+            penalty = initial_penalty.copy()
+            # Valid actions are the product of these lists, so a uniform random valid
+            # action is a uniform source paired with a uniform destination
+            open_sources = [i for i in range(num_sources) if current_supply[i] > 0.1]
+            open_dests = [j for j in range(num_dests) if current_demand[j] > 0.1]
+            bits = initial_bits
+            current_row = state_row(bits, penalty)
+
+            while open_sources and open_dests:
+                # Epsilon-greedy action selection
+                if random.uniform(0, 1) < epsilon:
+                    supplier = random.choice(open_sources)
+                    destination = random.choice(open_dests)
+                    action = supplier * num_dests + destination
+                else:
+                    action = best_actions[current_row]
+                    supplier, destination = divmod(action, num_dests)
+
+                units_to_transport = min(current_supply[supplier], current_demand[destination])
+                cost = flat_costs[action]
+                if cost == float('inf'):
+                    reward_value = -1000  # Large negative reward for infinite cost routes
+                else:
+                    reward_value = -cost * units_to_transport / 100.0
+                reward_value = max(min(reward_value, 1000), -1000)
+
+                current_supply[supplier] -= units_to_transport
+                current_demand[destination] -= units_to_transport
+                if current_supply[supplier] <= 0.1:
+                    bits &= ~(1 << supplier)
+                    penalty[supplier * num_dests:(supplier + 1) * num_dests] = -np.inf
+                    open_sources.remove(supplier)
+                if current_demand[destination] <= 0.1:
+                    bits &= ~(1 << (num_sources + destination))
+                    penalty[destination::num_dests] = -np.inf
+                    open_dests.remove(destination)
+                next_row = state_row(bits, penalty)
+
+                max_future_q = best_values[next_row] if open_sources and open_dests else 0
+                old_q = float(q_table[current_row, action])
+                td_error = reward_value + discount_factor * max_future_q - old_q
+                td_error = max(min(td_error, 100), -100)  # Clip TD error to reasonable bounds
+                new_q = old_q + learning_rate * td_error
+                q_table[current_row, action] = new_q
+                if new_q > best_values[current_row]:
+                    best_values[current_row] = new_q
+                    best_actions[current_row] = action
+                elif action == best_actions[current_row]:
+                    best_action = int(q_table[current_row].argmax())
+                    best_actions[current_row] = best_action
+                    best_values[current_row] = float(q_table[current_row, best_action])
+
+                current_row = next_row
+
+            epsilon = max(min_epsilon, epsilon * epsilon_decay)
+
+            if deadline is not None and time.time() >= deadline:
+                print(f"Deadline reached after {episode + 1} of {num_episodes} episodes")
+                converged = False
+                break
+
+        print(f"Trained {len(state_rows)} bitmask states")
+
+        # Greedy allocation with the learned Q-table
+        optimal_allocation_matrix = np.zeros((num_sources, num_dests))
+        current_supply = list(initial_supply)
+        current_demand = list(initial_demand)
+        bits = initial_bits
+        while True:
+            if bits in state_rows:
+                q_row = q_table[state_rows[bits]]
+            else:
+                # A state training never reached (e.g. stopped at the deadline):
+                # fall back to the cheapest valid pair
+                valid = np.array([current_supply[i] > 0.1 for i in range(num_sources)])[:, None] & \
+                        np.array([current_demand[j] > 0.1 for j in range(num_dests)])[None, :]
+                q_row = np.where(valid.ravel(), -costs.ravel(), -np.inf)
+            action = int(q_row.argmax())
+            if q_row[action] == -np.inf:
+                break  # No valid actions left
+            supplier, destination = divmod(action, num_dests)
+            units_to_transport = min(current_supply[supplier], current_demand[destination])
+            optimal_allocation_matrix[supplier, destination] += units_to_transport
+            current_supply[supplier] -= units_to_transport
+            current_demand[destination] -= units_to_transport
+            if current_supply[supplier] <= 0.1:
+                bits &= ~(1 << supplier)
+            if current_demand[destination] <= 0.1:
+                bits &= ~(1 << (num_sources + destination))
+        return optimal_allocation_matrix, converged
+
+    def optimize_batch(self, problems: List[Tuple[List['LogisticsRequest'], List['LogisticsDestination']]],
+                       workers: Optional[int] = None) -> List[Union[List['TransportAllocation'], Exception]]:
+        """
+        Optimize several allocation problems at once. The union of their street pairs
+        is costed exactly once into a shared travel-time table, then the problems are
+        solved in forked worker processes (sequentially where fork is unavailable).
+        Returns one allocation list per problem, or the exception that problem raised.
+        """
+        source_streets = sorted({s.source_street for sources, _ in problems for s in sources})
+        dest_streets = sorted({d.dest_street for _, destinations in problems for d in destinations})
+        needed = {(s.source_street, d.dest_street)
+                  for sources, destinations in problems for s in sources for d in destinations}
+        print(f"Batch of {len(problems)} problems needs {len(needed)} distinct street pairs")
+
+        # One shared table: rows/columns are the union of streets, only needed pairs are costed
+        source_index = {street: i for i, street in enumerate(source_streets)}
+        dest_index = {street: j for j, street in enumerate(dest_streets)}
+        shared_costs = np.full((len(source_streets), len(dest_streets)), np.nan)
+        for source, dest in sorted(needed):
+            shared_costs[source_index[source], dest_index[dest]] = self._estimate_transport_cost(source, dest)
+
+        problem_costs = []
+        for sources, destinations in problems:
+            rows = [source_index[s.source_street] for s in sources]
+            cols = [dest_index[d.dest_street] for d in destinations]
+            problem_costs.append(shared_costs[np.ix_(rows, cols)])
+
+        if workers is None:
+            workers = min(len(problems), os.cpu_count() or 1)
+        results: List[Union[List['TransportAllocation'], Exception]] = [None] * len(problems)
+        # Workers pin traffic through the publish lock; a fork while another thread (e.g. a
+        # TrafficRefresher) holds it would deadlock the children, so only fork single-threaded
+        if (workers > 1 and len(problems) > 1 and threading.active_count() == 1 and
+                'fork' in multiprocessing.get_all_start_methods()):
+            ctx = multiprocessing.get_context('fork')
+            _BATCH_CONTEXT.update(optimizer=self, problems=problems, costs=problem_costs)
+            print(f"Solving {len(problems)} problems on {workers} worker processes")
+            try:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+                    futures = {pool.submit(_run_allocation_problem, index): index
+                               for index in range(len(problems))}
+                    for future in concurrent.futures.as_completed(futures):
+                        try:
+                            results[futures[future]] = future.result()
+                        except Exception as e:
+                            results[futures[future]] = e
+            finally:
+                _BATCH_CONTEXT.clear()
+        else:
+            for index, (sources, destinations) in enumerate(problems):
+                try:
+                    results[index] = self.optimize_transport_allocation(sources, destinations,
+                                                                        costs=problem_costs[index])
+                except Exception as e:
+                    results[index] = e
+        return results
+
+    def _nearest_source_arcs(self, sources: List['LogisticsRequest'], destinations: List['LogisticsDestination'],
+                             k: int) -> Dict[Tuple[int, int], float]:
+        """Travel time from each destination's k nearest sources (one k-label search)."""
+        seeds = [(node, i) for i, source in enumerate(sources)
+                 for node in self.route_planner._get_street_nodes(source.source_street)]
+        nearest = k_nearest_labels(self.network.graph, seeds, k)
+
+        arcs = {}
+        for j, dest in enumerate(destinations):
+            best: Dict[int, float] = {}
+            # A destination street is reached when any of its nodes is
+            for node in self.route_planner._get_street_nodes(dest.dest_street):
+                for i, cost in nearest.get(node, {}).items():
+                    if cost < best.get(i, float('inf')):
+                        best[i] = cost
+            for i, cost in sorted(best.items(), key=lambda item: item[1])[:k]:
+                arcs[(i, j)] = cost
+        return arcs
+
+    def optimize_sparse_allocation(self,
+                                   sources: List['LogisticsRequest'],
+                                   destinations: List['LogisticsDestination'],
+                                   k: int = 5,
+                                   deadline: Optional[float] = None) -> List['TransportAllocation']:
+        """
+        Allocation for large problems: each destination may only be served by its k
+        nearest sources, found with one multi-source travel-time search instead of a
+        route search per cell, and the resulting sparse min-cost flow is solved exactly.
+        If some demand cannot be met on the sparse arcs, k is doubled for the
+        destinations left short until they are served or every source is a candidate;
+        once the deadline (absolute time.time()) passes no further widening is tried and
+        last_allocation_converged is False.
+        Demand is scaled down proportionally when supply is short, as in
+        optimize_transport_allocation.
+        """
+        print(f"Sparse allocation from {len(sources)} sources to {len(destinations)} destinations (k={k})")
+        total_supply = sum(source.capacity for source in sources)
+        total_demand = sum(dest.demand for dest in destinations)
+        if total_supply < total_demand:
+            print("Warning: Supply is less than demand - scaling down demands proportionally")
+            scale_factor = total_supply / total_demand if total_demand else 0.0
+            destinations = [LogisticsDestination(dest.dest_street, dest.demand * scale_factor)
+                            for dest in destinations]
+
+        # network_simplex needs integral data: quantities in thousandths, times in centiseconds
+        supply = [int(round(source.capacity * 1000)) for source in sources]
+        # Share out demand units by largest remainder so rounding never pushes the total
+        # past supply (which would read as a shortfall and widen k for nothing)
+        scaled = [dest.demand * 1000 for dest in destinations]
+        demand = [int(np.floor(amount)) for amount in scaled]
+        target = min(int(round(sum(scaled))), sum(supply))
+        by_remainder = sorted(range(len(scaled)), key=lambda j: scaled[j] - demand[j], reverse=True)
+        for j in by_remainder[:max(target - sum(demand), 0)]:
+            demand[j] += 1
+        arcs = self._nearest_source_arcs(sources, destinations, min(k, len(sources)))
+        finite = [cost for cost in arcs.values() if np.isfinite(cost)]
+        penalty = int(round((max(finite) if finite else 1.0) * 100)) * 10 + 100000
+
+        short = list(range(len(destinations)))
+        converged = True
+        while True:
+            flow_graph = nx.DiGraph()
+            for i, amount in enumerate(supply):
+                flow_graph.add_node(('s', i), demand=-amount)
+                flow_graph.add_edge(('s', i), 'unused', weight=0)
+            for j, amount in enumerate(demand):
+                flow_graph.add_node(('d', j), demand=amount)
+                # Penalised arc from a virtual source keeps the flow feasible and flags shortfalls
+                flow_graph.add_edge('unmet', ('d', j), weight=penalty)
+            flow_graph.add_node('unmet', demand=-sum(demand))
+            flow_graph.add_node('unused', demand=sum(supply))
+            flow_graph.add_edge('unmet', 'unused', weight=0)
+            for (i, j), cost in arcs.items():
+                flow_graph.add_edge(('s', i), ('d', j), weight=int(round(cost * 100)))
+
+            _, flow = nx.network_simplex(flow_graph)
+            short = [j for j in range(len(destinations)) if flow['unmet'][('d', j)] > 0]
+            if not short or k >= len(sources):
+                break
+            if deadline is not None and time.time() >= deadline:
+                print(f"Deadline reached with {len(short)} destinations short at k={k}")
+                converged = False
+                break
+            k = min(2 * k, len(sources))
+            print(f"{len(short)} destinations short on the sparse arcs, widening to k={k}")
+            widened = self._nearest_source_arcs(sources, [destinations[j] for j in short], k)
+            for (i, jj), cost in widened.items():
+                arcs[(i, short[jj])] = cost
+
+        if short:
+            print(f"Warning: {len(short)} destinations cannot be fully served from any reachable source")
+
+        allocations = []
+        for (i, j) in arcs:
+            quantity = flow[('s', i)].get(('d', j), 0) / 1000
+            if quantity > 1e-6:
+                allocations.append(TransportAllocation(
+                    source_street=sources[i].source_street,
+                    dest_street=destinations[j].dest_street,
+                    quantity=int(quantity) if int(quantity) == quantity else quantity
+                ))
+        print(f"Sparse allocation used {len(arcs)} arcs, produced {len(allocations)} allocations")
+        self.last_allocation_converged = converged
+        return allocations
+
+    def _cost_rows(self, source_streets: List[str], dest_streets: List[str],
+                   deadline: Optional[float] = None) -> np.ndarray:
+        costs = np.zeros((len(source_streets), len(dest_streets)))
+        for i, source in enumerate(source_streets):
+            for j, dest in enumerate(dest_streets):
+                costs[i, j] = self._estimate_transport_cost(source, dest, deadline=deadline)
+        return costs
+
+    def _estimated_cost_rows(self, source_streets: List[str], dest_streets: List[str]) -> np.ndarray:
+        """Coarse travel-time matrix from the planner's street overlay (no route searches)."""
+        for street in source_streets + dest_streets:
+            if street not in self.network.street_to_nodes:
+                raise ValueError(f"Street '{street}' not found in network")
+        return self.route_planner.street_overlay.estimate_matrix(source_streets, dest_streets)
+
+    def depot_partition(self, depot_streets: List[str]) -> DepotPartition:
+        """Nearest-depot partition for these depots, refreshed incrementally after traffic updates."""
+        key = tuple(sorted(set(depot_streets)))
+        partition = self.depot_partitions.get(key)
+        if partition is None or partition.network is not self.network:
+            print(f"Building depot partition for {len(key)} depots")
+            partition = DepotPartition(self.network, list(key))
+            self.depot_partitions[key] = partition
+            while len(self.depot_partitions) > self.max_depot_partitions:
+                self.depot_partitions.popitem(last=False)
+        else:
+            partition.refresh()
+        self.depot_partitions.move_to_end(key)
+        return partition
+
+    def assign_to_depots(self, sources: List['LogisticsRequest'], destinations: List['LogisticsDestination'],
+                         capacity_aware: bool = True) -> Tuple[List['TransportAllocation'], List[str]]:
+        """
+        Dispatch each destination whole to one source depot: its nearest by travel time,
+        moved to the next cheapest depot with room while its own is over capacity.
+        Returns the allocations and the destination streets left unassigned. Unlike
+        optimize_transport_allocation a destination's demand is never split.
+        """
+        partition = self.depot_partition([source.source_street for source in sources])
+        demands: Dict[str, float] = {}
+        for dest in destinations:
+            demands[dest.dest_street] = demands.get(dest.dest_street, 0) + dest.demand
+        capacities: Dict[str, float] = {}
+        for source in sources:
+            capacities[source.source_street] = capacities.get(source.source_street, 0) + source.capacity
+        assignment, unassigned = partition.assign(demands, capacities if capacity_aware else None)
+        allocations = [TransportAllocation(source_street=depot, dest_street=street, quantity=demands[street])
+                       for street, depot in assignment.items() if demands[street] > 0]
+        return allocations, unassigned
+
+    def start_allocation_job(self, job_id: str, sources: List['LogisticsRequest'],
+                             destinations: List['LogisticsDestination']) -> AllocationJob:
+        """
+        Solve an allocation exactly (transportation simplex) and keep the solution,
+        cost matrix and dual potentials so later deltas can be repaired incrementally.
+        Unlike optimize_transport_allocation, a supply shortfall is left as unmet
+        demand on the most expensive destinations rather than scaled across all.
+        """
+        print(f"Starting allocation job {job_id}: {len(sources)} sources, {len(destinations)} destinations")
+        costs = self._cost_rows([s.source_street for s in sources], [d.dest_street for d in destinations])
+        job = AllocationJob.create(job_id, sources, destinations, costs,
+                                   traffic_version=self.route_planner.network.traffic_version)
+        print(f"Allocation job {job_id} solved in {job.pivots} pivots, cost {job.total_cost():.2f}")
+        return job
+
+    def update_allocation_job(self, job: AllocationJob,
+                              capacity_deltas: Optional[Dict[str, float]] = None,
+                              demand_deltas: Optional[Dict[str, float]] = None) -> AllocationJob:
+        """
+        Apply capacity/demand deltas to a stored job and repair its solution from the
+        previous basis. Streets not yet in the job are added with the delta as their
+        capacity/demand; costs are refreshed first if traffic changed since the last solve.
+        """
+        traffic_version = self.route_planner.network.traffic_version
+        if job.traffic_version != traffic_version:
+            print(f"Traffic changed since job {job.job_id} was solved, refreshing costs")
+            job.update_costs(self._cost_rows(job.source_streets, job.dest_streets))
+            job.traffic_version = traffic_version
+
+        capacity_deltas = dict(capacity_deltas or {})
+        demand_deltas = dict(demand_deltas or {})
+        for street in [s for s in capacity_deltas if s not in job.source_streets]:
+            job.add_source(LogisticsRequest(street, 0.0), self._cost_rows([street], job.dest_streets)[0])
+        for street in [d for d in demand_deltas if d not in job.dest_streets]:
+            job.add_destination(LogisticsDestination(street, 0.0), self._cost_rows(job.source_streets, [street])[:, 0])
+
+        pivots = job.apply_deltas(capacity_deltas, demand_deltas)
+        print(f"Allocation job {job.job_id} repaired in {pivots} pivots, cost {job.total_cost():.2f}")
+        return job
+
+# Set in the parent right before forking batch workers (see optimize_batch)
+_BATCH_CONTEXT = {}
+
+def _run_allocation_problem(index: int) -> List[TransportAllocation]:
+    """Worker entry point: solve one problem of a batch against the shared costs."""
+    optimizer = _BATCH_CONTEXT['optimizer']
+    sources, destinations = _BATCH_CONTEXT['problems'][index]
+    return optimizer.optimize_transport_allocation(sources, destinations,
+                                                   costs=_BATCH_CONTEXT['costs'][index])
+
+# ----------------------- FleetRouting -----------------------
+@dataclass
+class Vehicle:
+    vehicle_id: str
+    capacity: float
+
+@dataclass
+class VehicleTour:
+    vehicle_id: str
+    trip: int  # 1 for a vehicle's first tour, 2 for its second, ...
+    source_street: str
+    stops: List[str]
+    quantities: List[float]
+    load: float
+    travel_time: float  # Estimated from the travel-time matrix
+    route: Optional[RouteResult] = None
+
+class FleetTourBuilder:
+    """Builds capacitated per-vehicle tours from allocations (a CVRP per source depot).
+
+    Tours are constructed with Clarke-Wright savings on the street travel-time
+    matrix, then improved by relocate moves between tours and 2-opt within tours
+    until the time budget runs out. Each finished tour can be materialized as a
+    RouteResult by chaining travel-time shortest paths between its stops.
+    """
+
+    def __init__(self, network: TransportNetwork, route_planner: ImprovedRoutePlanner):
+        self.network = network
+        self.route_planner = route_planner
+
+    def build_travel_time_matrix(self, streets: List[str]) -> np.ndarray:
+        """Street-to-street travel times: one search per street, min over destination nodes."""
+        graph = self.network.graph
+        street_nodes = [self.route_planner._get_street_nodes(street) for street in streets]
+        matrix = np.full((len(streets), len(streets)), np.inf)
+        for i, nodes in enumerate(street_nodes):
+            times, _, _ = travel_time_search(graph, nodes)
+            for j, other_nodes in enumerate(street_nodes):
+                matrix[i, j] = 0.0 if i == j else min((times[n] for n in other_nodes if n in times),
+                                                      default=np.inf)
+        return matrix
+
+    def build_tours(self, allocations: List[TransportAllocation],
+                    fleets: Dict[str, List[Vehicle]],
+                    streets: Optional[List[str]] = None,
+                    travel_times: Optional[np.ndarray] = None,
+                    time_budget: float = 5.0,
+                    return_to_depot: bool = True,
+                    materialize: bool = True) -> List[VehicleTour]:
+        """Turn allocations into vehicle tours.
+
+        Args:
+            allocations: Source -> destination quantities from the optimizer
+            fleets: Vehicles available at each source street
+            streets, travel_times: Optional precomputed matrix and its street order;
+                built from the network when omitted
+            time_budget: Seconds for construction plus local search across all depots
+            return_to_depot: Whether tours (and their RouteResults) end back at the depot
+            materialize: Whether to attach a RouteResult to every tour
+        """
+        start_time = time.time()
+        deadline = start_time + time_budget
+
+        if (streets is None) != (travel_times is None):
+            raise ValueError("streets and travel_times must be given together")
+        if travel_times is None:
+            streets = sorted({a.source_street for a in allocations} | {a.dest_street for a in allocations})
+            travel_times = self.build_travel_time_matrix(streets)
+        index = {street: i for i, street in enumerate(streets)}
+
+        by_source = {}
+        for alloc in allocations:
+            if alloc.quantity > 0:
+                by_source.setdefault(alloc.source_street, []).append(alloc)
+
+        for source, vehicles in fleets.items():
+            for vehicle in vehicles:
+                # Splitting loads by a non-positive capacity would never finish
+                if not isinstance(vehicle.capacity, (int, float, np.number)) or not vehicle.capacity > 0:
+                    raise ValueError(f"Vehicle '{vehicle.vehicle_id}' at '{source}' needs a positive "
+                                     f"capacity, got {vehicle.capacity!r}")
+
+        tours = []
+        for source, depot_allocations in by_source.items():
+            vehicles = fleets.get(source)
+            if not vehicles:
+                raise ValueError(f"No vehicles configured for source '{source}'")
+            max_capacity = max(v.capacity for v in vehicles)
+
+            # Split allocations larger than the biggest vehicle into full loads
+            stops = []
+            for alloc in depot_allocations:
+                remaining = float(alloc.quantity)
+                while remaining > 1e-9:
+                    load = min(remaining, max_capacity)
+                    stops.append((alloc.dest_street, load))
+                    remaining -= load
+
+            # Local matrix: index 0 is the depot, 1..n the stops
+            ids = [index[source]] + [index[street] for street, _ in stops]
+            dist = travel_times[np.ix_(ids, ids)]
+            dist = np.where(np.isfinite(dist), dist, 1e9)
+            if not return_to_depot:
+                dist[:, 0] = 0.0
+            demands = np.array([0.0] + [load for _, load in stops])
+
+            routes = self._savings(dist, demands, max_capacity)
+            routes = self._improve(routes, dist, demands, max_capacity, deadline)
+            print(f"Depot {source}: {len(stops)} stops in {len(routes)} tours")
+
+            for vehicle, trip, route in self._assign_vehicles(routes, demands, vehicles):
+                tours.append(VehicleTour(
+                    vehicle_id=vehicle.vehicle_id,
+                    trip=trip,
+                    source_street=source,
+                    stops=[stops[i - 1][0] for i in route],
+                    quantities=[stops[i - 1][1] for i in route],
+                    load=float(demands[route].sum()),
+                    travel_time=float(self._route_cost(route, dist))
+                ))
+
+        if materialize:
+            for tour in tours:
+                tour.route = self.materialize(tour, return_to_depot)
+
+        print(f"Built {len(tours)} tours in {time.time() - start_time:.2f} seconds")
+        return tours
+
+    @staticmethod
+    def _route_cost(route: List[int], dist: np.ndarray) -> float:
+        stops = np.array([0] + route + [0])
+        return float(dist[stops[:-1], stops[1:]].sum())
+
+    def _savings(self, dist: np.ndarray, demands: np.ndarray, capacity: float) -> List[List[int]]:
+        """Clarke-Wright savings construction (orientation-preserving, for asymmetric times)."""
+        n = len(demands) - 1
+        if n == 0:
+            return []
+        # Saving of serving j right after i instead of returning to the depot in between
+        savings = dist[1:, [0]] + dist[[0], 1:] - dist[1:, 1:]
+        np.fill_diagonal(savings, -np.inf)
+        order = np.argsort(savings, axis=None)[::-1]
+
+        route_of = {i: [i] for i in range(1, n + 1)}
+        loads = {i: demands[i] for i in range(1, n + 1)}  # keyed by the route's first stop
+        for flat in order.tolist():
+            i, j = divmod(flat, n)
+            i, j = i + 1, j + 1
+            if savings[i - 1, j - 1] < 0:
+                break
+            route_i, route_j = route_of[i], route_of[j]
+            # i must end its route and j must start another one
+            if route_i is route_j or route_i[-1] != i or route_j[0] != j:
+                continue
+            load = loads[route_i[0]] + loads[route_j[0]]
+            if load > capacity + 1e-9:
+                continue
+            del loads[route_j[0]]
+            route_i.extend(route_j)
+            loads[route_i[0]] = load
+            for stop in route_j:
+                route_of[stop] = route_i
+
+        unique = {id(route): route for route in route_of.values()}
+        return list(unique.values())
+
+    def _improve(self, routes: List[List[int]], dist: np.ndarray, demands: np.ndarray,
+                 capacity: float, deadline: float) -> List[List[int]]:
+        """Relocate and 2-opt local search until no move improves or the deadline passes."""
+        improved = True
+        while improved and time.time() < deadline:
+            improved = False
+
+            # Relocate: move one stop to its cheapest feasible position in any tour
+            loads = [float(demands[route].sum()) for route in routes]
+            for a, route_a in enumerate(routes):
+                position = 0
+                while position < len(route_a):
+                    if time.time() >= deadline:
+                        break
+                    stop = route_a[position]
+                    prev_stop = route_a[position - 1] if position > 0 else 0
+                    next_stop = route_a[position + 1] if position + 1 < len(route_a) else 0
+                    removal_gain = (dist[prev_stop, stop] + dist[stop, next_stop] -
+                                    dist[prev_stop, next_stop])
+                    best = (1e-6, None, None)
+                    for b, route_b in enumerate(routes):
+                        if b != a and loads[b] + demands[stop] > capacity + 1e-9:
+                            continue
+                        candidate = route_b if b != a else route_a[:position] + route_a[position + 1:]
+                        tour = np.array([0] + candidate + [0])
+                        insert_cost = (dist[tour[:-1], stop] + dist[stop, tour[1:]] -
+                                       dist[tour[:-1], tour[1:]])
+                        k = int(np.argmin(insert_cost))
+                        gain = removal_gain - insert_cost[k]
+                        if gain > best[0]:
+                            best = (gain, b, k)
+                    if best[1] is None:
+                        position += 1
+                        continue
+                    _, b, k = best
+                    del route_a[position]
+                    routes[b].insert(k, stop)
+                    loads[a] -= demands[stop]
+                    loads[b] += demands[stop]
+                    improved = True
+            routes = [route for route in routes if route]
+
+            # 2-opt within each tour (segment reversal, re-costed for asymmetric times)
+            for route in routes:
+                if time.time() >= deadline:
+                    break
+                best_cost = self._route_cost(route, dist)
+                for i in range(len(route) - 1):
+                    for j in range(i + 2, len(route) + 1):
+                        candidate = route[:i] + route[i:j][::-1] + route[j:]
+                        cost = self._route_cost(candidate, dist)
+                        if cost < best_cost - 1e-6:
+                            route[:] = candidate
+                            best_cost = cost
+                            improved = True
+        return routes
+
+    @staticmethod
+    def _assign_vehicles(routes: List[List[int]], demands: np.ndarray, vehicles: List[Vehicle]):
+        """Give each tour the least-used vehicle big enough for it (vehicles may do several trips)."""
+        trips = {v.vehicle_id: 0 for v in vehicles}
+        assignments = []
+        for route in sorted(routes, key=lambda r: demands[r].sum(), reverse=True):
+            load = demands[route].sum()
+            fitting = [v for v in vehicles if v.capacity + 1e-9 >= load]
+            vehicle = min(fitting, key=lambda v: (trips[v.vehicle_id], v.capacity))
+            trips[vehicle.vehicle_id] += 1
+            assignments.append((vehicle, trips[vehicle.vehicle_id], route))
+        return assignments
+
+    def materialize(self, tour: VehicleTour, return_to_depot: bool = True) -> RouteResult:
+        """Chain fastest node paths depot -> stops (-> depot) into one RouteResult."""
+        graph = self.network.graph
+        planner = self.route_planner
+        legs = tour.stops + ([tour.source_street] if return_to_depot else [])
+        path = []
+        current_sources = planner._get_street_nodes(tour.source_street)
+        for street in legs:
+            targets = planner._get_street_nodes(street)
+            if path and path[-1] in targets:
+                continue  # Already on this street
+            times, predecessors, _ = travel_time_search(graph, current_sources, targets=targets)
+            reached = [node for node in targets if node in times]
+            if not reached:
+                raise ValueError(f"No path from {tour.source_street} tour to '{street}'")
+            leg = tree_path(predecessors, min(reached, key=times.get))
+            path.extend(leg if not path else leg[1:])
+            current_sources = [path[-1]]
+        if len(path) < 2:
+            # Every stop is on the depot node itself: nothing to drive
+            return RouteResult(path=path, street_path=[tour.source_street], total_distance=0,
+                               total_time=0, success=True,
+                               traffic_distribution={state: 0 for state in TrafficState}, segments=[])
+        return planner._create_route_result(path)
+
+# ----------------------- MapMatching -----------------------
+def edge_length(data: dict) -> float:
+    """Length in metres of one edge, as a travel_time_search cost."""
+    return data['length']
+
+
+class TraceMatcher:
+    """HMM map-matcher for batches of GPS traces (Newson & Krumm, 2009).
+
+    Hidden states are candidate edge positions near each ping. Emissions are
+    Gaussian in the snap distance. Transitions are exponential in the difference
+    between the network distance and the straight-line distance of consecutive
+    pings. Candidate search is vectorized over the whole batch through the edge
+    spatial index. Network distances come from bounded length searches, cached
+    per node and shared by all traces.
+    """
+
+    def __init__(self, network: TransportNetwork, gps_sigma: float = 10.0, beta: float = 25.0,
+                 search_radius: float = 50.0, max_candidates: int = 8,
+                 max_route_distance: float = 2000.0, max_speed: float = 50.0,
+                 max_gap: float = 180.0, cache_nodes: int = 20000):
+        self.network = network
+        self.gps_sigma = gps_sigma  # GPS noise (m)
+        self.beta = beta  # Tolerated route vs. straight-line difference (m)
+        self.search_radius = search_radius
+        self.max_candidates = max_candidates
+        self.max_route_distance = max_route_distance  # Longest network hop between pings (m)
+        self.max_speed = max_speed  # Hops implying a faster speed (m/s) are impossible
+        self.max_gap = max_gap  # Pings further apart (s) start a new trace segment
+        self.cache_nodes = cache_nodes
+        self._searches = OrderedDict()  # node -> (reach, distances, predecessors), LRU
+
+        geometry = network.geometry
+        if geometry is None:
+            raise ValueError("Network has no edge geometry (pickled before it was kept); "
+                             "run `python app.py rebuild_network <net.xml>` to add it")
+        graph = network.full_graph
+        self.edges = geometry.edges
+        self.edge_lengths = [graph[u][v]['length'] for u, v in self.edges]
+
+    def _search(self, node: str, reach: float) -> Tuple[Dict[str, float], Dict[str, Optional[str]]]:
+        """Length search from node covering at least `reach` metres (capped at max_route_distance)."""
+        reach = min(reach, self.max_route_distance)
+        search = self._searches.get(node)
+        if search is not None and search[0] >= reach:
+            self._searches.move_to_end(node)
+            return search[1], search[2]
+        if search is not None:
+            # Grow geometrically so a node reached by ever longer hops is searched only a few times
+            reach = min(max(reach, 2 * search[0]), self.max_route_distance)
+        distances, predecessors, _ = travel_time_search(self.network.full_graph, [node],
+                                                        cutoff=reach, cost=edge_length)
+        self._searches[node] = (reach, distances, predecessors)
+        self._searches.move_to_end(node)
+        if len(self._searches) > self.cache_nodes:
+            self._searches.popitem(last=False)
+        return distances, predecessors
+
+    def _route_distance(self, edge_a: int, position_a: float, edge_b: int, position_b: float,
+                        reach: float) -> float:
+        """Network distance (m) from a position on one edge to a position on another.
+
+        Routes longer than `reach` may come back as inf.
+        """
+        length_a = self.edge_lengths[edge_a]
+        if edge_a == edge_b:
+            ahead = (position_b - position_a) * length_a
+            if ahead >= -self.gps_sigma:
+                return max(ahead, 0.0)  # Small backward jumps are GPS noise
+        distances, _ = self._search(self.edges[edge_a][1], reach)
+        between = distances.get(self.edges[edge_b][0])
+        if between is None:
+            return float('inf')
+        return (1 - position_a) * length_a + between + position_b * self.edge_lengths[edge_b]
+
+    def _traversed(self, edge_a: int, position_a: float, edge_b: int, position_b: float,
+                   reach: float) -> List[Tuple[Tuple[str, str], float]]:
+        """Edges covered between two matched positions, with the metres driven on each."""
+        length_a = self.edge_lengths[edge_a]
+        if edge_a == edge_b and (position_b - position_a) * length_a >= -self.gps_sigma:
+            return [(self.edges[edge_a], max(position_b - position_a, 0.0) * length_a)]
+        _, predecessors = self._search(self.edges[edge_a][1], reach)
+        nodes = tree_path(predecessors, self.edges[edge_b][0])
+        graph = self.network.full_graph
+        covered = [(self.edges[edge_a], (1 - position_a) * length_a)]
+        covered.extend(((u, v), graph[u][v]['length']) for u, v in zip(nodes, nodes[1:]))
+        covered.append((self.edges[edge_b], position_b * self.edge_lengths[edge_b]))
+        return covered
+
+    def _prepare(self, pings: pd.DataFrame) -> pd.DataFrame:
+        """Sorted pings with network x/y and timestamps in seconds."""
+        frame = pings.sort_values(['driver', 'timestamp'], kind='stable').reset_index(drop=True)
+        if 'x' not in frame.columns or 'y' not in frame.columns:
+            x, y = self.network.geometry.location.to_net(frame['latitude'].to_numpy(),
+                                                         frame['longitude'].to_numpy())
+            frame['x'], frame['y'] = x, y
+        timestamps = frame['timestamp']
+        if pd.api.types.is_numeric_dtype(timestamps):
+            frame['seconds'] = timestamps.astype(float)
+        else:
+            frame['seconds'] = (pd.to_datetime(timestamps, utc=True)
+                                - pd.Timestamp(0, tz='UTC')).dt.total_seconds()
+        return frame
+
+    def _match(self, pings: pd.DataFrame) -> Tuple[pd.DataFrame, list]:
+        frame = self._prepare(pings)
+        xs = frame['x'].to_numpy(dtype=np.float64)
+        ys = frame['y'].to_numpy(dtype=np.float64)
+        seconds = frame['seconds'].to_numpy(dtype=np.float64)
+        drivers = frame['driver'].to_numpy()
+
+        # Pings within 2 sigma of the last kept ping carry no new information
+        kept = []
+        last_driver, last_x, last_y = None, 0.0, 0.0
+        min_move2 = (2 * self.gps_sigma) ** 2
+        for i, (driver, x, y) in enumerate(zip(drivers.tolist(), xs.tolist(), ys.tolist())):
+            if driver != last_driver or (x - last_x) ** 2 + (y - last_y) ** 2 >= min_move2:
+                kept.append(i)
+                last_driver, last_x, last_y = driver, x, y
+        kept = np.array(kept, dtype=np.int64)
+
+        point, edge, distance, position = self.network.spatial_index.candidates(
+            xs[kept], ys[kept], self.search_radius, self.max_candidates)
+        cand_start = np.searchsorted(point, np.arange(len(kept) + 1))
+        emission = -0.5 * (distance / self.gps_sigma) ** 2
+        edge_list = edge.tolist()
+        position_list = position.tolist()
+
+        rows = []  # (ping row, candidate index, segment)
+        traversals = []  # (driver, edge, metres, seconds)
+        segment_id = 0
+
+        def close_segment(steps, scores, back):
+            # Backtrack the best candidate chain of one unbroken segment
+            nonlocal segment_id
+            if not steps:
+                return
+            choice = int(np.argmax(scores))
+            chosen = [0] * len(steps)
+            for s in range(len(steps) - 1, -1, -1):
+                chosen[s] = steps[s][1] + choice
+                if back[s] is not None:
+                    choice = int(back[s][choice])
+            for s, (ping, _) in enumerate(steps):
+                rows.append((kept[ping], chosen[s], segment_id))
+            segment_id += 1
+
+        steps, back, scores = [], [], None
+        previous = None
+        for ping in range(len(kept)):
+            lo, hi = int(cand_start[ping]), int(cand_start[ping + 1])
+            if lo == hi:
+                continue  # No street nearby: skip the ping
+            row = kept[ping]
+            new_segment = (previous is None or drivers[row] != drivers[kept[previous]]
+                           or seconds[row] - seconds[kept[previous]] > self.max_gap)
+            if not new_segment:
+                p_lo, p_hi = int(cand_start[previous]), int(cand_start[previous + 1])
+                prev_row = kept[previous]
+                straight = float(np.hypot(xs[row] - xs[prev_row], ys[row] - ys[prev_row]))
+                max_distance = self.max_speed * max(seconds[row] - seconds[prev_row], 1.0)
+                routes = np.array([[self._route_distance(edge_list[i], position_list[i],
+                                                         edge_list[j], position_list[j], max_distance)
+                                    for j in range(lo, hi)] for i in range(p_lo, p_hi)])
+                transition = np.where(routes <= max_distance, -np.abs(routes - straight) / self.beta, -np.inf)
+                total = scores[:, None] + transition
+                best_previous = np.argmax(total, axis=0)
+                step_scores = total[best_previous, np.arange(hi - lo)]
+                if np.isfinite(step_scores).any():
+                    scores = step_scores + emission[lo:hi]
+                    steps.append((ping, lo))
+                    back.append(best_previous)
+                    previous = ping
+                    continue
+            # HMM break: finish the running segment and start over from this ping
+            if scores is not None:
+                close_segment(steps, scores, back)
+            steps, back, scores = [(ping, lo)], [None], emission[lo:hi].copy()
+            previous = ping
+        if scores is not None:
+            close_segment(steps, scores, back)
+
+        matched = frame.loc[[r[0] for r in rows], ['driver', 'timestamp', 'x', 'y', 'seconds']].reset_index(drop=True)
+        candidates = np.array([r[1] for r in rows], dtype=np.int64)
+        matched['segment'] = [r[2] for r in rows]
+        matched_edges = edge[candidates] if len(candidates) else np.zeros(0, dtype=np.int32)
+        graph = self.network.full_graph
+        matched['from_node'] = [self.edges[e][0] for e in matched_edges.tolist()]
+        matched['to_node'] = [self.edges[e][1] for e in matched_edges.tolist()]
+        matched['edge_id'] = [graph[u][v]['edge_id'] for u, v in zip(matched['from_node'], matched['to_node'])]
+        matched['street_name'] = [graph[u][v]['street_name'] for u, v in zip(matched['from_node'], matched['to_node'])]
+        matched['position'] = position[candidates] if len(candidates) else []
+        matched['snap_distance'] = distance[candidates] if len(candidates) else []
+
+        # Speed of every hop inside a segment, spread over the edges it covered
+        route_distance = np.full(len(matched), np.nan)
+        speeds = np.full(len(matched), np.nan)
+        segments = matched['segment'].to_numpy()
+        match_seconds = matched['seconds'].to_numpy()
+        match_drivers = matched['driver'].to_numpy()
+        for i in range(1, len(matched)):
+            if segments[i] != segments[i - 1]:
+                continue
+            a, b = candidates[i - 1], candidates[i]
+            elapsed = match_seconds[i] - match_seconds[i - 1]
+            route_distance[i] = self._route_distance(edge_list[a], position_list[a], edge_list[b], position_list[b],
+                                                     self.max_speed * max(elapsed, 1.0))
+            if elapsed <= 0:
+                continue
+            speed = speeds[i] = route_distance[i] / elapsed
+            if speed <= 0:
+                continue  # Standing still says nothing about the speed on the street
+            for graph_edge, metres in self._traversed(edge_list[a], position_list[a], edge_list[b],
+                                                      position_list[b], route_distance[i]):
+                if metres > 0:
+                    traversals.append((match_drivers[i], graph_edge, metres, metres / speed))
+        matched['route_distance'] = route_distance
+        matched['speed'] = speeds
+        return matched.drop(columns=['seconds']), traversals
+
+    def match(self, pings: pd.DataFrame) -> pd.DataFrame:
+        """Snap pings (driver, latitude/longitude or x/y, timestamp) to their most likely edges.
+
+        Returns one row per matched ping with the edge, the position along it, the trace
+        segment (a new one starts after a gap or an impossible hop) and the speed
+        since the previous ping of the segment.
+        """
+        matched, _ = self._match(pings)
+        return matched
+
+    def observed_traffic(self, pings: pd.DataFrame, min_distance: float = 10.0) -> pd.DataFrame:
+        """Per-edge observed speeds as a TransportNetwork.update_traffic frame.
+
+        mean_speed is the space-mean speed (metres driven / seconds spent) over all
+        matched hops. vehicle_count is the number of distinct drivers. occupancy is
+        estimated as the percentage shortfall of mean_speed against the speed limit.
+        Edges with less than min_distance metres of observations are left out.
+        """
+        return self.match_traffic(pings, min_distance)[1]
+
+    def match_traffic(self, pings: pd.DataFrame, min_distance: float = 10.0) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """match() and observed_traffic() from a single matching pass."""
+        matched, traversals = self._match(pings)
+        metres = defaultdict(float)
+        seconds = defaultdict(float)
+        drivers = defaultdict(set)
+        samples = defaultdict(int)
+        graph = self.network.full_graph
+        for driver, (u, v), driven, spent in traversals:
+            edge_id = graph[u][v]['edge_id']
+            metres[edge_id] += driven
+            seconds[edge_id] += spent
+            drivers[edge_id].add(driver)
+            samples[edge_id] += 1
+        speed_limits = {}
+        for u, v, data in graph.edges(data=True):
+            speed_limits.setdefault(data['edge_id'], data['speed_limit'])
+
+        records = []
+        for edge_id, driven in metres.items():
+            if driven < min_distance or seconds[edge_id] <= 0:
+                continue
+            mean_speed = driven / seconds[edge_id]
+            records.append({
+                'edge_id': edge_id,
+                'mean_speed': mean_speed,
+                'occupancy': float(np.clip(100 * (1 - mean_speed / speed_limits[edge_id]), 0, 100)),
+                'vehicle_count': len(drivers[edge_id]),
+                'samples': samples[edge_id],
+                'distance': driven
+            })
+        return matched, pd.DataFrame(records, columns=['edge_id', 'mean_speed', 'occupancy', 'vehicle_count',
+                                                       'samples', 'distance'])
+
+# ----------------------- TrafficRefresh -----------------------
+class TrafficRefresher:
+    """Applies traffic updates on a background thread while routes keep being served.
+
+    Each update is built on copies of the routing graphs (TransportNetwork.prepare_traffic),
+    the planner's street overlay for the new weights is built next, and only then is
+    the new version published with a single swap under the network's publish lock.
+    Queries inside ImprovedRoutePlanner.query_context finish on the version they
+    started on; queries started after the swap see the new one. Updates queued while
+    a rebuild runs are coalesced into the next one, later rows winning.
+    """
+
+    def __init__(self, planner: ImprovedRoutePlanner, networks: Optional[List[TransportNetwork]] = None):
+        self.planner = planner
+        # Other networks (e.g. the logistics optimizer's copy) get the same rows
+        self.networks = [planner.network] + [n for n in (networks or []) if n is not planner.network]
+        self._queue: "queue.Queue[Optional[pd.DataFrame]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self.last_error: Optional[Exception] = None
+        self.published = 0  # Versions published by this refresher
+
+    def refresh(self, traffic_data: pd.DataFrame) -> int:
+        """Prepare, warm and publish one update on the calling thread; returns the new version."""
+        for network in self.networks:
+            while True:
+                start_time = time.time()
+                prepared = network.prepare_traffic(traffic_data)
+                if network is self.planner.network:
+                    self.planner.warm_traffic(prepared)
+                if network.publish_traffic(prepared):
+                    break
+                print("Traffic was published meanwhile, rebuilding on the new version")
+            print(f"Published traffic version {prepared.version}: {len(prepared.changed)} routing edges "
+                  f"changed, built in {time.time() - start_time:.2f}s")
+        self.published += 1
+        return self.planner.network.traffic_version
+
+    def submit(self, traffic_data: pd.DataFrame) -> None:
+        """Queue an update for the background thread (started on first use)."""
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='traffic-refresh', daemon=True)
+            self._thread.start()
+        self._queue.put(traffic_data)
+
+    def _run(self) -> None:
+        while True:
+            items = [self._queue.get()]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            frames = [item for item in items if item is not None and not item.empty]
+            try:
+                if frames:
+                    self.refresh(pd.concat(frames, ignore_index=True))
+            except Exception as e:
+                self.last_error = e
+                print(f"Traffic refresh failed: {str(e)}")
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+            if any(item is None for item in items):
+                return
+
+    def wait(self) -> None:
+        """Block until every submitted update has been published (or has failed)."""
+        self._queue.join()
+
+    def close(self) -> None:
+        """Publish what is queued, then stop the background thread."""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._thread = None
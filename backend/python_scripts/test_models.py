@@ -0,0 +1,236 @@
+import contextlib
+import io
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+
+from models import (AllocationJob, DepotPartition, ImprovedRLAgent, ImprovedRoutePlanner, LogisticsDestination,
+                    LogisticsRequest, StateEncoder, TraceMatcher, TrafficRefresher, TrafficState, TransportNetwork,
+                    edge_travel_time)
+
+
+def grid_network(tmp_path, size=5, block=1):
+    """Two-way size x size grid with streets Row_<i> and Col_<j>.
+
+    Junction n<i>_<j> sits at x = 100 j, y = 100 i. With block > 1 each block is split
+    into `block` edges, so its inner nodes form chains.
+    """
+    edges = []
+    positions = {}
+
+    def add(edge_id, from_node, to_node, name):
+        edges.append(f'<edge id="{edge_id}" from="{from_node}" to="{to_node}" name="{name}">'
+                     f'<lane id="{edge_id}_0" speed="13.89" length="{100.0 / block}"/></edge>')
+
+    def add_block(prefix, from_node, to_node, name, start, step):
+        nodes = [from_node] + [f"{prefix}_m{k}" for k in range(1, block)] + [to_node]
+        for k, node in enumerate(nodes):
+            positions[node] = (start[0] + step[0] * k / block, start[1] + step[1] * k / block)
+        for k, (u, v) in enumerate(zip(nodes, nodes[1:])):
+            edge_id = prefix if block == 1 else f"{prefix}_{k}"
+            add(edge_id, u, v, name)
+            add(f"-{edge_id}", v, u, name)
+
+    for i in range(size):
+        for j in range(size - 1):
+            add_block(f"r{i}_{j}", f"n{i}_{j}", f"n{i}_{j + 1}", f"Row_{i}", (100.0 * j, 100.0 * i), (100.0, 0.0))
+            add_block(f"c{i}_{j}", f"n{j}_{i}", f"n{j + 1}_{i}", f"Col_{i}", (100.0 * i, 100.0 * j), (0.0, 100.0))
+    junctions = [f'<junction id="{node}" x="{x}" y="{y}"/>' for node, (x, y) in positions.items()]
+    path = tmp_path / "grid.net.xml"
+    path.write_text("<net>\n" + "\n".join(junctions + edges) + "\n</net>\n")
+    network = TransportNetwork()
+    with contextlib.redirect_stdout(io.StringIO()):
+        network.load_network(str(path))
+    return network
+
+
+def assert_rows_match_nodes(planner, states, actions):
+    """Every packed state must decode to a node whose current encoding it is, and every action to a successor."""
+    encoder = planner.state_encoder
+    graph = planner.network.graph
+    for state, row_actions in zip(states.tolist(), actions):
+        node_index = state >> StateEncoder.TRAFFIC_BITS
+        assert node_index < len(encoder.nodes)
+        node = encoder.nodes[node_index]
+        assert encoder.encode(graph, node) == state
+        for action in row_actions.tolist():
+            if action >= 0:
+                assert graph.has_edge(node, encoder.nodes[action])
+
+
+def severe_traffic(edge_id):
+    """One traffic row that puts edge_id in the worst traffic state."""
+    return pd.DataFrame([{'edge_id': edge_id, 'mean_speed': 0.0, 'occupancy': 100.0, 'vehicle_count': 10}])
+
+
+def test_parallel_find_route_keeps_parent_state_ids(tmp_path):
+    planner = ImprovedRoutePlanner(grid_network(tmp_path), ImprovedRLAgent())
+    planner.parallel_attempts = 4
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        route = planner.find_route('Row_0', 'Row_4')
+
+    assert "worker processes" in output.getvalue()
+    assert route.success
+    assert nx.is_path(planner.network.full_graph, route.path)
+
+    q_table = planner.agent.q_table
+    assert len(q_table) > 0
+    assert_rows_match_nodes(planner, *q_table.export_rows(list(q_table._rows))[:2])
+    assert len(planner.policy_cache) > 0
+    for policy in planner.policy_cache.entries.values():
+        assert_rows_match_nodes(planner, *policy.q_slice[:2])
+
+
+def test_alternative_routes_between_touching_streets(tmp_path):
+    planner = ImprovedRoutePlanner(grid_network(tmp_path), ImprovedRLAgent())
+    with contextlib.redirect_stdout(io.StringIO()):
+        routes = planner.find_alternative_routes('Row_1', 'Col_3')
+        fastest = planner.find_route('Row_1', 'Col_3')
+
+    assert routes
+    assert abs(routes[0].total_time - fastest.total_time) < 1e-6
+    for route in routes:
+        assert len(route.path) >= 2
+        assert nx.is_path(planner.network.full_graph, route.path)
+
+
+def test_contracted_route_expands_to_full_graph_path(tmp_path):
+    network = grid_network(tmp_path, size=4, block=3)
+    assert network.graph.number_of_edges() < network.full_graph.number_of_edges()
+    planner = ImprovedRoutePlanner(network, ImprovedRLAgent())
+    with contextlib.redirect_stdout(io.StringIO()):
+        route = planner.find_route('Row_0', 'Row_3')
+
+    assert route.success
+    assert nx.is_path(network.full_graph, route.path)
+    assert any(node not in network.graph for node in route.path)
+
+
+def test_traffic_on_chain_interior_edge_reweights_chain_edge(tmp_path):
+    network = grid_network(tmp_path, size=4, block=3)
+    chain = network.chain_of[('r0_0_m1', 'r0_0_m2')]
+    assert chain == ('n0_0', 'n0_1')
+    before = edge_travel_time(network.graph[chain[0]][chain[1]])
+
+    network.update_traffic(severe_traffic('r0_0_1'))
+
+    data = network.graph[chain[0]][chain[1]]
+    assert data['traffic_state'] == TrafficState.SEVERE
+    nodes = (chain[0],) + data['via'] + (chain[1],)
+    parts = sum(edge_travel_time(network.full_graph[u][v]) for u, v in zip(nodes, nodes[1:]))
+    assert edge_travel_time(data) > before
+    assert abs(edge_travel_time(data) - parts) < 1e-9
+
+
+def test_trace_along_a_row_matches_its_edges(tmp_path):
+    network = grid_network(tmp_path, size=4, block=3)
+    # One driver at 10 m/s along Row_0 (y = 0), 2 m off the centreline
+    pings = pd.DataFrame({'driver': 'd1', 'x': [10.0 + 20 * k for k in range(15)], 'y': 2.0,
+                          'timestamp': [2.0 * k for k in range(15)]})
+    matched, traffic = TraceMatcher(network).match_traffic(pings)
+
+    assert len(matched) == len(pings)
+    assert set(matched['street_name']) == {'Row_0'}
+    assert list(matched['edge_id']) == sorted(matched['edge_id'])  # Forward edges, in driving order
+    assert set(traffic['edge_id']) == {f"r0_{j}_{k}" for j in range(3) for k in range(3)}
+    assert ((traffic['mean_speed'] - 10.0).abs() < 1e-3).all()
+
+
+def test_publish_traffic_rejects_a_stale_base_version(tmp_path):
+    network = grid_network(tmp_path)
+    first = network.prepare_traffic(severe_traffic('r0_0'))
+    second = network.prepare_traffic(severe_traffic('r1_0'))
+    live_graph = network.graph
+
+    assert network.publish_traffic(first)
+    assert network.traffic_version == 1
+    assert live_graph['n0_0']['n0_1']['traffic_state'] == TrafficState.LIGHT  # Old snapshot untouched
+    assert not network.publish_traffic(second)
+    assert network.traffic_version == 1
+    assert network.graph['n1_0']['n1_1']['traffic_state'] == TrafficState.LIGHT
+
+    network.update_traffic(severe_traffic('r1_0'))
+    assert network.traffic_version == 2
+    assert network.graph['n0_0']['n0_1']['traffic_state'] == TrafficState.SEVERE
+    assert network.graph['n1_0']['n1_1']['traffic_state'] == TrafficState.SEVERE
+
+
+def test_refresher_submit_then_wait_publishes_a_version(tmp_path):
+    planner = ImprovedRoutePlanner(grid_network(tmp_path), ImprovedRLAgent())
+    refresher = TrafficRefresher(planner)
+    with contextlib.redirect_stdout(io.StringIO()):
+        refresher.submit(severe_traffic('r2_1'))
+        refresher.wait()
+        refresher.close()
+
+    assert refresher.last_error is None
+    assert planner.network.traffic_version == 1
+    assert planner.network.graph['n2_1']['n2_2']['traffic_state'] == TrafficState.SEVERE
+
+
+def min_cost_flow_optimum(costs, supply, demand):
+    """Optimal cost of the transportation problem (excess supply unused) by network simplex."""
+    flow = nx.DiGraph()
+    flow.add_node('unused', demand=int(sum(supply) - sum(demand)))
+    for i, amount in enumerate(supply):
+        flow.add_node(('s', i), demand=-int(amount))
+        flow.add_edge(('s', i), 'unused', weight=0)
+        for j in range(len(demand)):
+            flow.add_edge(('s', i), ('d', j), weight=int(costs[i, j]))
+    for j, amount in enumerate(demand):
+        flow.add_node(('d', j), demand=int(amount))
+    return nx.min_cost_flow_cost(flow)
+
+
+def test_allocation_job_deltas_reach_lp_optimum():
+    rng = np.random.default_rng(7)
+    costs = rng.integers(10, 500, (4, 6)).astype(float)
+    supply = [40, 35, 50, 30]
+    demand = [20, 15, 25, 10, 30, 20]
+    job = AllocationJob.create('job', [LogisticsRequest(f"S{i}", c) for i, c in enumerate(supply)],
+                               [LogisticsDestination(f"D{j}", d) for j, d in enumerate(demand)], costs)
+    assert abs(job.total_cost() - min_cost_flow_optimum(costs, supply, demand)) < 1e-6
+
+    # S2 drops below what it currently ships, so the repair needs dual pivots
+    assert job.apply_deltas(capacity_deltas={'S2': -30, 'S0': 10}, demand_deltas={'D1': 12, 'D4': -15}) > 0
+    supply = [50, 35, 20, 30]
+    demand = [20, 27, 25, 10, 15, 20]
+    assert abs(job.total_cost() - min_cost_flow_optimum(costs, supply, demand)) < 1e-6
+    assert not job.unmet_demand()
+    assert (job.flows >= -1e-9).all()
+    assert np.allclose(job.flows[:4, :6].sum(axis=0), demand)
+
+
+def test_depot_partition_refresh_matches_rebuild(tmp_path):
+    network = grid_network(tmp_path)
+    depots = ['Row_0', 'Col_4']
+    with contextlib.redirect_stdout(io.StringIO()):
+        network.update_traffic(pd.concat([severe_traffic(f"c2_{j}") for j in range(4)]))
+        partition = DepotPartition(network, depots)
+        # Slow down edges on the search tree and clear the earlier jam, so some edges get faster
+        jam = pd.concat([severe_traffic(edge_id) for edge_id in ('c0_0', 'c0_1', 'r1_3', '-r1_3')])
+        cleared = pd.DataFrame([{'edge_id': f"c2_{j}", 'mean_speed': 13.89, 'occupancy': 0.0,
+                                 'vehicle_count': 0} for j in range(4)])
+        network.update_traffic(pd.concat([jam, cleared]))
+        settled = partition.refresh()
+        rebuilt = DepotPartition(network, depots)
+
+    assert 0 < settled < len(rebuilt.times)  # Repaired in place, not rebuilt
+    assert partition.traffic_version == rebuilt.traffic_version
+    assert partition.times.keys() == rebuilt.times.keys()
+    for node, arrival in rebuilt.times.items():
+        assert abs(partition.times[node] - arrival) < 1e-9
+    assert partition.street_time.keys() == rebuilt.street_time.keys()
+    for street, arrival in rebuilt.street_time.items():
+        assert abs(partition.street_time[street] - arrival) < 1e-9
+    # Nodes as far from both depots may keep either label, as long as it reaches them that fast
+    with contextlib.redirect_stdout(io.StringIO()):
+        single = {depot: DepotPartition(network, [depot]) for depot in depots}
+    for node, depot in partition.node_depot.items():
+        assert abs(single[depot].times[node] - rebuilt.times[node]) < 1e-9
+    ties = [node for node in rebuilt.times
+            if abs(single['Row_0'].times[node] - single['Col_4'].times[node]) < 1e-9]
+    assert all(partition.node_depot[node] == rebuilt.node_depot[node]
+               for node in rebuilt.node_depot if node not in ties)